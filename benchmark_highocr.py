@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# --- Configuration Variables ---
+DEFAULT_WORK_DIR = "/tmp/highocr_benchmark"
+MOCK_LATENCY_ENV = "HIGHOCR_MOCK_LATENCY"  # Seconds per image the mock predictor sleeps
+MOCK_CALL_LATENCY_ENV = "HIGHOCR_MOCK_CALL_LATENCY"  # Fixed seconds per predict call
+REGRESSION_TOLERANCE = 0.10  # Relative slowdown vs. the baseline that counts as a regression
+STARTUP_TOLERANCE = 0.25  # Time to first result includes process spawn and is noisier
+# --- End Configuration Variables ---
+
+# --- Mock Pipeline ---
+
+class MockResult(dict):
+    """Pipeline result stand-in with the fields and save_to_json of a PaddleX OCR result."""
+    def save_to_json(self, save_path, indent=4, ensure_ascii=False):
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump({key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in self.items()},
+                      f, indent=indent, ensure_ascii=ensure_ascii)
+
+class MockPipeline:
+    """Deterministic predictor: fixed sleep per call and per image, output derived from the pixels."""
+    def __init__(self, latency, call_latency):
+        self.latency = latency
+        self.call_latency = call_latency
+
+    def predict(self, inputs):
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        time.sleep(self.call_latency + self.latency * len(inputs))
+        for image in inputs:
+            if isinstance(image, str):
+                image = np.asarray(Image.open(image).convert("RGB"))
+            height, width = image.shape[:2]
+            checksum = zlib.crc32(np.ascontiguousarray(image[:: max(1, height // 16), :: max(1, width // 16)]).tobytes())
+            lines = 1 + checksum % 8
+            line_height = max(1, height // (lines + 1))
+            polys = np.array(
+                [[[0, i * line_height], [width - 1, i * line_height], [width - 1, (i + 1) * line_height], [0, (i + 1) * line_height]]
+                 for i in range(lines)],
+                dtype=np.int16,
+            )
+            yield MockResult(
+                input_path=None,
+                dt_polys=polys,
+                rec_polys=polys,
+                rec_text=[f"line {i} {checksum:08x}" for i in range(lines)],
+                rec_score=[0.99] * lines,
+            )
+
+def create_mock_pipeline(config_path, hpi_params=None):
+    """Drop-in for pdx.create_pipeline; latencies come from the environment so spawned workers see them."""
+    return MockPipeline(float(os.environ.get(MOCK_LATENCY_ENV, "0.01")), float(os.environ.get(MOCK_CALL_LATENCY_ENV, "0.0")))
+
+# --- Synthetic Tree ---
+
+def generate_tree(root, directories, depth, images_per_directory, width, height):
+    """Writes a reproducible tree of noisy PNG pages; reuses it when the layout matches."""
+    layout = {"directories": directories, "depth": depth, "images_per_directory": images_per_directory, "width": width, "height": height}
+    marker_path = os.path.join(root, ".layout.json")
+    if os.path.exists(marker_path):
+        with open(marker_path, "r", encoding="utf-8") as f:
+            if json.load(f) == layout:
+                return directories * images_per_directory
+    shutil.rmtree(root, ignore_errors=True)
+    rng = np.random.default_rng(0)
+    for d in range(directories):
+        # Nest every directory `depth` levels deep: book_0003/part_0/part_1/...
+        directory = os.path.join(root, f"book_{d:04d}", *[f"part_{level}" for level in range(depth - 1)])
+        os.makedirs(directory, exist_ok=True)
+        for i in range(images_per_directory):
+            page = np.full((height, width, 3), 255, dtype=np.uint8)
+            page[rng.random((height, width)) < 0.05] = 0  # Speckle so pages differ and compress realistically
+            Image.fromarray(page).save(os.path.join(directory, f"page_{i:04d}.png"))
+    with open(marker_path, "w", encoding="utf-8") as f:
+        json.dump(layout, f)
+    return directories * images_per_directory
+
+def directory_bytes(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, file))
+            except OSError:
+                pass
+    return total
+
+# --- Benchmark ---
+
+def run_benchmark(args):
+    if not args.real_pipeline:
+        os.environ["HIGHOCR_PIPELINE_FACTORY"] = "benchmark_highocr:create_mock_pipeline"
+    os.environ[MOCK_LATENCY_ENV] = str(args.latency)
+    os.environ[MOCK_CALL_LATENCY_ENV] = str(args.call_latency)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))  # Spawned workers import this module by name
+    import highocr3_f2
+
+    image_root = os.path.join(args.work_dir, "images")
+    output_root = os.path.join(args.work_dir, "output")
+    log_dir = os.path.join(args.work_dir, "logs")
+    images = generate_tree(image_root, args.directories, args.depth, args.images_per_directory, args.width, args.height)
+    shutil.rmtree(output_root, ignore_errors=True)
+    shutil.rmtree(log_dir, ignore_errors=True)
+
+    overrides = {
+        "num_processes": args.processes,
+        "batch_mode": not args.single,
+        "images_per_task": args.images_per_task,
+        "worker_options": {"result_sink": args.result_sink, "predict_batch_size": args.predict_batch_size},
+    }
+    if args.cpu_layout:
+        overrides["device_map"] = f"cpu={args.cpu_layout}"
+        if not args.real_pipeline:
+            # Device slots write a pinned copy of the config; the mock needs only one to copy
+            highocr3_f2.config_path = os.path.join(args.work_dir, "mock_config.yaml")
+            with open(highocr3_f2.config_path, "w", encoding="utf-8") as f:
+                f.write("Global:\n  device: cpu\n")
+    first = highocr3_f2.main(image_root, output_root, log_dir, overrides)
+    output_bytes = directory_bytes(output_root)
+    log_bytes = directory_bytes(log_dir)
+    resume = highocr3_f2.main(image_root, output_root, log_dir, overrides)
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("save_baseline", "compare", "sweep")},
+        "images": images,
+        "processed": first["processed"],
+        "errors": first["errors"],
+        "images_per_sec": first["processed"] / first["total_time"] if first["total_time"] else 0.0,
+        "total_time": first["total_time"],
+        "first_result_time": first["first_result_time"],
+        "resume_scan_time": resume["scan_time"],
+        "resume_total_time": resume["total_time"],
+        "resume_reprocessed": resume["processed"],
+        "output_bytes": output_bytes,
+        "output_bytes_per_image": output_bytes / max(1, first["processed"]),
+        "log_bytes": log_bytes,
+    }
+
+def run_sweep(args):
+    """Runs the benchmark once per processes x threads layout, each in a fresh interpreter, and prints images/sec.
+
+    A fresh process per layout keeps the thread settings the OpenMP runtime
+    read at import time from leaking into the next layout.
+    """
+    argv = list(sys.argv[1:])
+    for index, arg in enumerate(argv):
+        if arg == "--sweep" or arg.startswith("--sweep="):
+            del argv[index:index + (2 if arg == "--sweep" else 1)]
+            break
+    rows = []
+    for layout in args.sweep.split(","):
+        processes, _, threads = layout.strip().partition("x")
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            result_path = f.name
+        try:
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), *argv, "--cpu-layout", layout.strip(), "--save-baseline", result_path],
+                stdout=subprocess.DEVNULL
+            )
+            with open(result_path, "r", encoding="utf-8") as f:
+                result = json.load(f) if completed.returncode == 0 and os.path.getsize(result_path) else None
+        finally:
+            os.remove(result_path)
+        rows.append((layout.strip(), int(processes), int(threads), result["images_per_sec"] if result else None))
+        print(f"{layout.strip()}: {f'{rows[-1][3]:.2f} images/sec' if result else 'failed'}", flush=True)
+    best = max((row for row in rows if row[3] is not None), key=lambda row: row[3], default=None)
+    print(f"\n{'layout':>8} {'processes':>9} {'threads':>7} {'images/sec':>10}")
+    for row in rows:
+        rate = f"{row[3]:.2f}" if row[3] is not None else "failed"
+        print(f"{row[0]:>8} {row[1]:>9} {row[2]:>7} {rate:>10}{'  best' if row is best else ''}")
+    return rows
+
+def compare_to_baseline(result, baseline):
+    """Prints the change of every metric; returns False on a throughput or latency regression."""
+    ok = True
+    checks = (
+        ("images_per_sec", True, REGRESSION_TOLERANCE),
+        ("first_result_time", False, STARTUP_TOLERANCE),
+        ("resume_scan_time", False, STARTUP_TOLERANCE),
+        ("output_bytes_per_image", False, REGRESSION_TOLERANCE),
+    )
+    for key, higher_is_better, tolerance in checks:
+        old, new = baseline.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        print(f"{key}: {old:.4g} -> {new:.4g} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+        ok = ok and not regressed
+    if baseline.get("config") != result["config"]:
+        print("Note: baseline was recorded with a different configuration.")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks highocr3_f2.py dispatch, I/O and serialization with a mock predictor.")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR)
+    parser.add_argument("--directories", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=2, help="Directory levels per book")
+    parser.add_argument("--images-per-directory", type=int, default=50)
+    parser.add_argument("--width", type=int, default=1240)
+    parser.add_argument("--height", type=int, default=1754)
+    parser.add_argument("--latency", type=float, default=0.01, help="Mock predict seconds per image")
+    parser.add_argument("--call-latency", type=float, default=0.0, help="Mock predict seconds per call")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--images-per-task", type=int, default=64)
+    parser.add_argument("--predict-batch-size", type=int, default=16)
+    parser.add_argument("--result-sink", choices=("json", "shard"), default="json")
+    parser.add_argument("--single", action="store_true", help="One image per task instead of batch mode")
+    parser.add_argument("--cpu-layout", metavar="PxT", help="Pinned CPU workers: P processes with T threads each")
+    parser.add_argument("--sweep", metavar="PxT,...", help="Compare images/sec over CPU layouts, e.g. 2x16,4x8,8x4,16x2")
+    parser.add_argument("--real-pipeline", action="store_true", help="Run the PaddleX pipeline instead of the mock predictor")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the result as the new baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare with a saved baseline; exit 1 on regression")
+    args = parser.parse_args()
+
+    if args.sweep:
+        run_sweep(args)
+        return
+
+    result = run_benchmark(args)
+    print(json.dumps(result, indent=4))
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare_to_baseline(result, baseline):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
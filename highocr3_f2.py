@@ -1,23 +1,58 @@
-import paddlex as pdx
 import time
+process_start_time = time.time()  # For the startup breakdown
+import atexit
 import json
 import os
 from multiprocessing import Pool, cpu_count, get_context
-import paddle
+import multiprocessing.util
 import yaml
 from datetime import datetime, timedelta
 import shutil
-from PIL import Image
+import signal
+from PIL import Image, ImageOps
+import numpy as np
+import cv2
+import io
+import socket
+import sqlite3
+import tempfile
 import sys  # Import sys for stdout manipulation
 import logging
+from ocr_result_store import (COMPLETION_MARKER, RUN_MARKER, ShardResultIndex, ShardResultWriter, compact_record, load_result,
+                              read_marker, remove_marker, sort_pages, source_checksum, to_jsonable, write_marker)
+from ocr_sources import (SOURCE_SEPARATOR, is_container, is_virtual, join_source_path, list_container, output_relative_path,
+                         pdf_lock, read_source, split_source_path)
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import bisect
+import difflib
+import hashlib
+import functools
+import importlib
+import itertools
+import math
+import queue
+import threading
+import zlib
 
 logging.disable(logging.DEBUG)  # 关闭DEBUG日志的打印
 logging.disable(logging.WARNING)  # 关闭WARNING日志的打印
-# Disable Paddle's signal handler
-paddle.disable_signal_handler()
+
+# paddlex/paddle are imported by the workers only (import_paddle); the parent never runs inference
+pdx = None
+paddle = None
+HEAVY_MODULES = ("paddle", "paddlex")  # Preloaded once by the forkserver in all-CPU runs, inherited by every worker
+TEMP_ENV_VARS = ("TMPDIR", "TEMP", "TMP")  # Read by tempfile (and paddle) when first resolving the temp dir
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")  # Thread pools of Paddle's CPU runtimes
 
 # Global configuration
 config_path = "/media/tmzn/DATA5/ocr_paddle/config_paddle/OCR.yaml"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+SCAN_CONTAINERS = True  # Also OCR images inside zip/tar archives and the pages of PDFs, without extracting them
+IMAGE_VALIDATION = "full"  # "full": strict PIL decode; "header": header check + fast OpenCV decode
+PIPELINE_FACTORY_ENV = "HIGHOCR_PIPELINE_FACTORY"  # "module:function" used instead of pdx.create_pipeline (benchmarks)
+PDF_SPILL_PAGES = 50  # Fused PDF mode: rendered pages a directory holds in memory before they go to a chunk file (as CHUNK_SIZE)
+PDF_BUFFER_MB = 256  # Fused PDF mode: bound of the pages all unfinished directories hold in memory together
 
 # --- Utility Functions ---
 
@@ -27,21 +62,103 @@ def get_beijing_time():
     beijing_time = utc_now + timedelta(hours=8)
     return beijing_time.strftime("%Y-%m-%d %H:%M:%S")
 
+COLORS = {
+    "green": "\033[92m",
+    "red": "\033[91m",
+    "yellow": "\033[93m",
+    "blue": "\033[94m",
+    "reset": "\033[0m",
+}
+LOG_LEVELS = {"red": "error", "yellow": "warning"}  # Level in JSON log lines, "info" otherwise
+LOG_FLUSH_INTERVAL = 0.5  # Seconds the log listener buffers records before writing them
+LOG_BATCH_SIZE = 512  # Records written at most per listener flush
+log_sink = None  # Queue to a LogListener; while set, colored_output only enqueues
+
 def colored_output(text, color="green", log_file=None):
     """Prints colored text and logs."""
-    colors = {
-        "green": "\033[92m",
-        "red": "\033[91m",
-        "yellow": "\033[93m",
-        "blue": "\033[94m",
-        "reset": "\033[0m",
-    }
-    colored_text = f"{colors.get(color, colors['reset'])}{text}{colors['reset']}"
+    if log_sink is not None:
+        log_sink.put((time.time(), os.getpid(), color, text, log_file))
+        return
+    colored_text = f"{COLORS.get(color, COLORS['reset'])}{text}{COLORS['reset']}"
     print(colored_text)
     if log_file:
         with open(log_file, "a") as f:
             f.write(text + "\n")
 
+class LogListener:
+    """Writes the log records of all processes from one thread in the parent.
+
+    Workers and the parent put records on one multiprocessing queue; the
+    listener collects them for up to LOG_FLUSH_INTERVAL seconds and writes
+    each batch with a single console write and a single append per log
+    file, which stays open for the whole run.  With ``log_format="json"``
+    the log file gets one JSON object per line instead of plain text.
+    """
+    def __init__(self, log_queue, log_format="text"):
+        self.queue = log_queue
+        self.log_format = log_format
+        self.files = {}
+        self.thread = threading.Thread(target=self._run, name="log-listener", daemon=True)
+
+    def start(self):
+        global log_sink
+        self.thread.start()
+        log_sink = self.queue
+        atexit.register(self.stop)  # Still flush when main() exits with an exception
+        return self
+
+    def stop(self):
+        """Writes everything still queued and returns colored_output to direct mode."""
+        global log_sink
+        if not self.thread.is_alive():
+            return
+        log_sink = None
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            records = []
+            deadline = time.time() + LOG_FLUSH_INTERVAL
+            while len(records) < LOG_BATCH_SIZE:
+                try:
+                    record = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                records.append(record)
+            if records:
+                try:
+                    self._write(records)
+                except Exception as e:
+                    print(f"Log listener failed to write {len(records)} records: {e}")
+        for f in self.files.values():
+            f.close()
+
+    def _write(self, records):
+        console = []
+        file_lines = {}
+        for created, pid, color, text, log_file in records:
+            console.append(f"{COLORS.get(color, COLORS['reset'])}{text}{COLORS['reset']}\n")
+            if not log_file:
+                continue
+            if self.log_format == "json":
+                line = json.dumps({"ts": round(created, 3), "pid": pid, "level": LOG_LEVELS.get(color, "info"), "message": text}, ensure_ascii=False)
+            else:
+                line = text
+            file_lines.setdefault(log_file, []).append(line + "\n")
+        sys.stdout.write("".join(console))
+        sys.stdout.flush()
+        for path, lines in file_lines.items():
+            f = self.files.get(path)
+            if f is None:
+                f = self.files[path] = open(path, "a", encoding="utf-8")
+            f.write("".join(lines))
+            f.flush()
+
 def format_timedelta(delta):
     """Formats a timedelta object."""
     total_seconds = int(delta.total_seconds())
@@ -50,18 +167,452 @@ def format_timedelta(delta):
     seconds = total_seconds % 60
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
-def clear_cache():
-    """Clears the PaddleX cache."""
-    cache_dir = os.path.expanduser("~/.paddlex/temp")
+# --- Downscaling ---
+
+GEOMETRY_KEYS = ("dt_polys", "rec_polys", "dt_boxes", "rec_boxes")  # Result fields in image coordinates
+
+def downscale_image(image, max_long_edge=None, max_pixels=None):
+    """Shrinks an image to the long-edge/pixel caps.
+
+    Returns (image, scale) where scale is the (x, y) factor applied, or None
+    when the image was already within the caps.
+    """
+    height, width = image.shape[:2]
+    factor = 1.0
+    if max_long_edge and max(height, width) > max_long_edge:
+        factor = max_long_edge / max(height, width)
+    if max_pixels and height * width * factor * factor > max_pixels:
+        factor = min(factor, math.sqrt(max_pixels / (height * width)))
+    if factor >= 1.0:
+        return image, None
+    new_width = max(1, round(width * factor))
+    new_height = max(1, round(height * factor))
+    resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    # Per-axis factors from the rounded size keep the back-mapping exact
+    return resized, (new_width / width, new_height / height)
+
+def scale_coordinates(value, scale_x, scale_y):
+    """Divides points (..., 2) or boxes (..., 4) by the downscale factors."""
     try:
-        if os.path.exists(cache_dir):
-            shutil.rmtree(cache_dir)
-            os.makedirs(cache_dir, exist_ok=True)
-            colored_output(f"[{get_beijing_time()}] Cache cleared.", "green")
+        coords = np.asarray(value, dtype=np.float64)
+    except ValueError:  # Ragged list of polygons
+        return [scale_coordinates(v, scale_x, scale_y) for v in value]
+    if coords.size == 0:
+        return value
+    if coords.shape[-1] == 2:
+        coords = coords / (scale_x, scale_y)
+    elif coords.shape[-1] == 4:
+        coords = coords / (scale_x, scale_y, scale_x, scale_y)
+    else:
+        return value
+    return np.round(coords).astype(np.int32)
+
+def map_result_to_original(res, scale):
+    """Rescales the geometry of a result predicted on a downscaled image back to the original."""
+    scale_x, scale_y = scale
+    for key in GEOMETRY_KEYS:
+        if key in res and res[key] is not None:
+            res[key] = scale_coordinates(res[key], scale_x, scale_y)
+    return res
+
+def measure_downscale_sample(full_image, scaled_image, scale):
+    """Predicts one image at both resolutions; returns timing and text agreement."""
+    with RedirectStdout():
+        scaled_start = time.time()
+        scaled_res = list(global_pipeline.predict(scaled_image))[0]
+        scaled_time = time.time() - scaled_start
+        full_start = time.time()
+        full_res = list(global_pipeline.predict(full_image))[0]
+        full_time = time.time() - full_start
+    scaled_text = "\n".join(scaled_res.get("rec_text", []))
+    full_text = "\n".join(full_res.get("rec_text", []))
+    return {
+        "downscale_samples": 1,
+        "downscale_sample_time_full": full_time,
+        "downscale_sample_time_scaled": scaled_time,
+        "downscale_sample_similarity": difflib.SequenceMatcher(None, full_text, scaled_text).ratio() if full_text or scaled_text else 1.0,
+        "downscale_sample_boxes_full": len(full_res.get("rec_text", [])),
+        "downscale_sample_boxes_scaled": len(scaled_res.get("rec_text", [])),
+    }
+
+def prepare_for_predict(image, image_path, scales, samples):
+    """Applies the configured downscaling and picks accuracy samples."""
+    global downscaled_count
+    resize_start = time.perf_counter()
+    image, scale = downscale_image(image, worker_options["max_long_edge"], worker_options["max_pixels"])
+    if scale is not None:
+        record_stage("downscale", time.perf_counter() - resize_start)
+        scales[image_path] = scale
+        downscaled_count += 1
+        if samples is not None and worker_options["downscale_sample_every"] and (downscaled_count - 1) % worker_options["downscale_sample_every"] == 0:
+            samples[image_path] = True
+    return image
+
+# --- Tiled Detection ---
+
+def tile_origins(length, tile_size, overlap):
+    """Start offsets along one axis: tiles of tile_size sharing overlap pixels, the last one flush with the edge."""
+    if length <= tile_size:
+        return [0]
+    step = max(1, tile_size - overlap)
+    origins = list(range(0, length - tile_size, step))
+    origins.append(length - tile_size)
+    return origins
+
+def needs_tiling(image):
+    return bool(worker_options["tile_above_pixels"]) and image.shape[0] * image.shape[1] > worker_options["tile_above_pixels"]
+
+def suppress_tile_duplicates(polys, tile_ids, cut, iou_threshold):
+    """Greedy NMS across tiles; returns the indices of the boxes to keep.
+
+    Two boxes from different tiles are the same text when their bounding
+    rectangles overlap by ``iou_threshold`` of the smaller one (the piece
+    of a line cut by a tile edge lies inside the whole line found by the
+    neighbouring tile).  Whole boxes win over cut ones, larger over smaller.
+    """
+    if not polys:
+        return []
+    rects = np.array([(p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()) for p in polys], dtype=np.float64)
+    areas = np.maximum(rects[:, 2] - rects[:, 0], 1) * np.maximum(rects[:, 3] - rects[:, 1], 1)
+    tile_ids = np.asarray(tile_ids)
+    order = sorted(range(len(polys)), key=lambda i: (cut[i], -areas[i]))
+    kept = []
+    for i in order:
+        if kept:
+            others = np.asarray(kept)
+            others = others[tile_ids[others] != tile_ids[i]]
+            if others.size:
+                width = np.minimum(rects[others, 2], rects[i, 2]) - np.maximum(rects[others, 0], rects[i, 0])
+                height = np.minimum(rects[others, 3], rects[i, 3]) - np.maximum(rects[others, 1], rects[i, 1])
+                overlap = np.clip(width, 0, None) * np.clip(height, 0, None) / np.minimum(areas[others], areas[i])
+                if (overlap >= iou_threshold).any():
+                    continue
+        kept.append(i)
+    return kept
+
+def join_seam_text(left, right, min_repeat=2):
+    """Joins the texts of two pieces of a line; characters both read in the tile overlap are kept once."""
+    for size in range(min(len(left), len(right)), min_repeat - 1, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return left + right
+
+def merge_seam_pieces(polys, texts, scores, sides, kept):
+    """Joins the pieces of lines longer than the tile overlap that NMS kept side by side.
+
+    Such a line has no whole box in any tile: each tile reads the part it
+    holds, cut at the seam.  A piece cut on its right continues with a
+    piece from another tile that is cut on its left, lies in the same row
+    band and starts before the first one ends.  Chains become one
+    rectangle with the joined text and the mean score.  Returns the merged
+    (polys, texts, scores).
+    """
+    rects = {i: (polys[i][:, 0].min(), polys[i][:, 1].min(), polys[i][:, 0].max(), polys[i][:, 1].max()) for i in kept}
+    chains = []
+    for i in sorted(kept, key=lambda i: rects[i][0]):
+        x0, y0, x1, y1 = rects[i]
+        for chain in chains:
+            last = chain[-1]
+            lx0, ly0, lx1, ly1 = rects[last]
+            shared_rows = min(y1, ly1) - max(y0, ly0)
+            if (sides[last][2] and sides[i][0] and x0 <= lx1 < x1
+                    and shared_rows >= 0.5 * min(y1 - y0, ly1 - ly0)):
+                chain.append(i)
+                break
         else:
-            colored_output(f"[{get_beijing_time()}] Cache directory not found.", "yellow")
+            chains.append([i])
+    merged_polys, merged_texts, merged_scores = [], [], []
+    for chain in chains:
+        if len(chain) == 1:
+            merged_polys.append(polys[chain[0]])
+            merged_texts.append(texts[chain[0]])
+            merged_scores.append(scores[chain[0]])
+            continue
+        x0 = min(rects[i][0] for i in chain)
+        y0 = min(rects[i][1] for i in chain)
+        x1 = max(rects[i][2] for i in chain)
+        y1 = max(rects[i][3] for i in chain)
+        merged_polys.append(np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=np.int64))
+        merged_texts.append(functools.reduce(join_seam_text, (texts[i] for i in chain)))
+        merged_scores.append(sum(scores[i] for i in chain) / len(chain))
+    return merged_polys, merged_texts, merged_scores
+
+def predict_tiled(image):
+    """Predicts an oversized image tile by tile and merges the boxes into one compact record.
+
+    Tiles are views of the decoded image, copied ``tile_batch`` at a time
+    into a predict call, so the pipeline's working memory depends on the
+    tile size rather than on the image.  Box coordinates are shifted back
+    to the full image, duplicates found in the overlaps are removed and
+    the pieces of lines longer than the overlap are joined again.
+    """
+    tile_size = worker_options["tile_size"]
+    overlap = worker_options["tile_overlap"]
+    height, width = image.shape[:2]
+    tiles = [(x, y) for y in tile_origins(height, tile_size, overlap) for x in tile_origins(width, tile_size, overlap)]
+    polys, texts, scores, tile_ids, sides = [], [], [], [], []
+    edge = 2  # Pixels from an inner tile border within which a box counts as cut
+    predict_start = time.perf_counter()
+    for start in range(0, len(tiles), worker_options["tile_batch"]):
+        group = tiles[start:start + worker_options["tile_batch"]]
+        crops = [np.ascontiguousarray(image[y:y + tile_size, x:x + tile_size]) for x, y in group]
+        with RedirectStdout():
+            output = list(global_pipeline.predict(crops))
+        if len(output) != len(group):
+            raise RuntimeError(f"Expected {len(group)} tile results, got {len(output)}")
+        for offset, ((x, y), crop, res) in enumerate(zip(group, crops, output)):
+            tile_height, tile_width = crop.shape[:2]
+            inner = (x > 0, y > 0, x + tile_width < width, y + tile_height < height)
+            for poly, text, score in zip(res.get("dt_polys", []), res.get("rec_text", []), res.get("rec_score", [])):
+                poly = np.asarray(poly, dtype=np.int64).reshape(-1, 2)
+                touches = (poly[:, 0].min() <= edge, poly[:, 1].min() <= edge,
+                           poly[:, 0].max() >= tile_width - 1 - edge, poly[:, 1].max() >= tile_height - 1 - edge)
+                polys.append(poly + (x, y))
+                texts.append(text)
+                scores.append(float(score))
+                tile_ids.append(start + offset)
+                sides.append(tuple(side and border for side, border in zip(touches, inner)))  # Cut at (left, top, right, bottom)
+        del crops, output
+    record_stage("predict", time.perf_counter() - predict_start)
+    kept = suppress_tile_duplicates(polys, tile_ids, [any(cut) for cut in sides], worker_options["tile_nms_threshold"])
+    tile_counts["tile_duplicates"] += len(polys) - len(kept)
+    polys, texts, scores = merge_seam_pieces(polys, texts, scores, sides, kept)
+    # Reading order of the merged page: top to bottom, then left to right
+    order = sorted(range(len(polys)), key=lambda i: (polys[i][:, 1].min(), polys[i][:, 0].min()))
+    tile_counts["tiled_images"] += 1
+    tile_counts["tiles"] += len(tiles)
+    return {
+        "dt_polys": [polys[i].tolist() for i in order],
+        "rec_text": [texts[i] for i in order],
+        "rec_score": [scores[i] for i in order],
+        "tiles": {"count": len(tiles), "size": tile_size, "overlap": overlap},
+    }
+
+def process_tiled(image_path, output_dir, image, error_dir, log_file_path):
+    """Tiled predict and save of one image; returns success like process_image."""
+    try:
+        record = predict_tiled(image)
+        write_record(image_path, output_dir, record)
+        cached = cache_keys.pop(image_path, None)
+        if cached is not None:
+            key, width, height = cached
+            dedup_cache.put(key, width, height, record)
+        return True
     except Exception as e:
-        colored_output(f"[{get_beijing_time()}] Error clearing cache: {e}", "red")
+        handle_image_error(image_path, e, error_dir, log_file_path)
+        return False
+
+# --- Blank Page Detection ---
+
+def blank_page_metrics(image, thumbnail_edge):
+    """Measures a downsampled grayscale copy of a page: (edge pixel density, brightness standard deviation)."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    height, width = gray.shape
+    factor = max(1, max(height, width) // thumbnail_edge)  # Integer factors take OpenCV's fast area path
+    if factor > 1:
+        gray = cv2.resize(gray, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (3, 3), 0), 50, 150)
+    return np.count_nonzero(edges) / edges.size, float(gray.std())
+
+# --- Scratch Space ---
+
+class ScratchSpace:
+    """Per-worker scratch directory for pipeline temp files, with a byte budget.
+
+    Lives under a fast path (tmpfs by default) and belongs to exactly one
+    worker, so cleanup never races another process.  ``enforce`` evicts the
+    least recently used files once the directory grows past its budget.
+    """
+    def __init__(self, root, budget_bytes):
+        self.path = os.path.join(root, f"worker_{os.getpid()}")
+        self.budget_bytes = budget_bytes
+        self.seen = {}  # path -> size of files already counted as written
+        self.bytes_written = 0
+        self.bytes_evicted = 0
+        self.files_evicted = 0
+
+    def activate(self):
+        """Creates the directory and points temp file creation at it, PaddleX's included."""
+        os.makedirs(self.path, exist_ok=True)
+        os.environ["TMPDIR"] = self.path
+        tempfile.tempdir = self.path
+        if "paddlex" not in sys.modules:
+            return
+        # PaddleX keeps its temp dir in paddlex.utils.cache.TEMP_DIR, next to the model cache (so its
+        # env var can't move it alone); modules that imported the name hold their own copy
+        try:
+            default_temp = importlib.import_module("paddlex.utils.cache").TEMP_DIR
+        except (ImportError, AttributeError):
+            return
+        for name, module in list(sys.modules.items()):
+            if name.split(".")[0] == "paddlex" and getattr(module, "TEMP_DIR", None) == default_temp:
+                module.TEMP_DIR = self.path
+
+    def enforce(self):
+        """Updates the counters and evicts LRU files beyond the budget."""
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if self.seen.get(path) != stat.st_size:
+                    self.bytes_written += max(0, stat.st_size - self.seen.get(path, 0))
+                    self.seen[path] = stat.st_size
+                files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+                total += stat.st_size
+        if total <= self.budget_bytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total <= self.budget_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.seen.pop(path, None)
+            total -= size
+            self.bytes_evicted += size
+            self.files_evicted += 1
+
+    def take_stats(self):
+        """Returns and resets the byte counters."""
+        stats = {"scratch_bytes_written": self.bytes_written, "scratch_bytes_evicted": self.bytes_evicted,
+                 "scratch_files_evicted": self.files_evicted}
+        self.bytes_written = 0
+        self.bytes_evicted = 0
+        self.files_evicted = 0
+        return stats
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+# --- Stage Timing ---
+
+stage_times = {}  # Worker-side stage -> durations (seconds) since the last finished task
+
+def record_stage(stage, seconds):
+    """Records one duration; safe to call from prefetch threads."""
+    stage_times.setdefault(stage, []).append(seconds)
+
+def take_stage_times():
+    global stage_times
+    taken, stage_times = stage_times, {}
+    return taken
+
+# --- Image Loading ---
+
+def decode_image(data, validation=IMAGE_VALIDATION):
+    """Validates image bytes and decodes them to a BGR ndarray for predict."""
+    try:
+        img = Image.open(io.BytesIO(data))  # Parses the header only
+        if validation == "full":
+            img.load()  # Full decode, rejects truncated files
+            # Upright like cv2.imread (and the "header" path) return it: phone scans carry an EXIF rotation
+            array = np.asarray(ImageOps.exif_transpose(img).convert("RGB"))[:, :, ::-1]
+            img.close()
+            return np.ascontiguousarray(array)
+        img.close()
+    except (IOError, SyntaxError) as e:
+        raise Exception(f"Image validation failed: {e}")
+    array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if array is None:
+        raise Exception("Image validation failed: could not decode image data")
+    return array
+
+def load_image(image_path, validation=IMAGE_VALIDATION):
+    """Reads an image (a file, or a member of an archive or PDF) once and decodes it."""
+    read_start = time.perf_counter()
+    data = read_source(image_path)
+    decode_start = time.perf_counter()
+    record_stage("read", decode_start - read_start)
+    try:
+        image = decode_image(data, validation)
+    finally:
+        record_stage("decode", time.perf_counter() - decode_start)
+    if dedup_cache is not None:
+        cache_keys[image_path] = (content_key(data, image, worker_options["dedup"]), image.shape[1], image.shape[0])
+    if worker_options["pdf_pages"]:
+        page_images[image_path] = data  # Embedded in the PDF page as read, no second read
+    return image
+
+class ImagePrefetcher:
+    """Reads and decodes images ahead of predict on a small thread pool.
+
+    At most ``depth`` images are in flight at once and, with ``max_bytes``,
+    no more than that many decoded bytes as estimated from the image
+    headers (an image larger than the budget is read only when nothing
+    else is pending).  Every time the consumer has to block on an image
+    that is not decoded yet, the wait is counted so that starvation of the
+    accelerator can be reported.
+    """
+    def __init__(self, executor, depth, max_bytes=None):
+        self.executor = executor
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.largest = 0  # Largest decoded image so far, the estimate for images without a readable header
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def estimate(self, image_path):
+        size = read_image_size(image_path)
+        return size[0] * size[1] * 3 if size else self.largest
+
+    def iterate(self, batch):
+        """Yields ((image_path, output_dir), image, error) in batch order."""
+        pending = deque()  # (item, future, estimated bytes)
+        items = iter(batch)
+        held = []  # Next item, its estimate over the byte budget
+        pending_bytes = 0
+
+        def fill():
+            nonlocal pending_bytes
+            while len(pending) < self.depth:
+                item, estimate = held.pop() if held else (next(items, None), None)
+                if item is None:
+                    return
+                if self.max_bytes:
+                    estimate = self.estimate(item[0]) if estimate is None else estimate
+                    if pending and pending_bytes + estimate > self.max_bytes:
+                        held.append((item, estimate))
+                        return
+                    pending_bytes += estimate
+                if self.executor is None:
+                    future = Future()
+                    try:
+                        future.set_result(load_image(item[0]))
+                    except Exception as e:
+                        future.set_exception(e)
+                else:
+                    future = self.executor.submit(load_image, item[0])
+                pending.append((item, future, estimate or 0))
+
+        fill()
+        while pending:
+            item, future, estimate = pending.popleft()
+            if not future.done():
+                self.waits += 1
+                wait_start = time.time()
+                wait([future])
+                self.wait_time += time.time() - wait_start
+            error = future.exception()
+            image = None if error is not None else future.result()
+            if image is not None:
+                self.largest = max(self.largest, image.nbytes)
+            pending_bytes -= estimate
+            fill()
+            yield item, image, error
+
+    def take_waits(self):
+        """Returns and resets the wait counters."""
+        waits, wait_time = self.waits, self.wait_time
+        self.waits = 0
+        self.wait_time = 0.0
+        return waits, wait_time
 
 # --- Dummy Stream for Silencing Output ---
 
@@ -94,12 +645,173 @@ class RedirectStdout:
 
 # --- Multiprocessing Worker Functions ---
 
-def init_worker(config_path, batch_size):
-    """Initializes worker process."""
+DEFAULT_WORKER_OPTIONS = {
+    "predict_batch_size": 16,  # Images per predict call in batch mode
+    "prefetch_depth": 32,  # Images read/decoded ahead of predict
+    "prefetch_threads": 4,  # Reader/decoder threads per worker, 0 disables prefetch
+    "prefetch_max_mb": 1024,  # Decoded bytes read ahead, and per predict group, at most; None: only the counts bound them
+    "result_sink": "json",  # "json": one *_result.json per image; "shard": compact per-directory shards; None: no result files
+    "scratch_budget_mb": 512,  # Per-worker scratch budget before LRU eviction
+    "scratch_check_interval": 5.0,  # Seconds between scratch budget checks
+    "max_long_edge": None,  # Downscale images whose long edge exceeds this before predict
+    "max_pixels": None,  # Downscale images with more pixels than this before predict
+    "downscale_sample_every": 200,  # Also predict every Nth downscaled image at full size for the report
+    "tile_above_pixels": None,  # Predict images with more pixels than this as overlapping tiles (not downscaled)
+    "tile_size": 2048,  # Edge of a square tile
+    "tile_overlap": 256,  # Pixels neighbouring tiles share; keep above the tallest text line
+    "tile_batch": 4,  # Tiles per predict call, bounds the pipeline's memory per worker
+    "tile_nms_threshold": 0.5,  # Boxes from different tiles overlapping this share of the smaller one are duplicates
+    "dedup": None,  # "exact": reuse results of byte-identical images; "perceptual": also of re-saved/re-scaled copies
+    "dedup_cache_mb": 1024,  # Bound of the stored compact results, least recently used evicted beyond it
+    "blank_filter": False,  # Write an empty result for pages without likely text instead of predicting
+    "blank_max_edge_density": 0.0005,  # Blank below this share of edge pixels in the thumbnail...
+    "blank_max_std": 3.0,  # ...or below this brightness standard deviation (uniform sheet)
+    "blank_thumbnail_edge": 512,  # Minimum long edge of the thumbnail the check runs on
+    "copy_errors": True,  # Copy failed images to error_dir; off in a first pass whose failures are retried
+    "warmup": True,  # One predict on a synthetic page before the worker takes tasks
+    "pdf_pages": False,  # Render each page with its text layer for the parent's DirectoryTracker (fused PDF mode)
+    "pdf_y_offset": 30,  # Text layer shift, as Y_OFFSET in pdf_creator_with_text_layer6.py
+    "ignore_sigint": False,  # Leave Ctrl-C to the parent (ocr_watch.py): a worker killed while idle deadlocks the pool's task queue
+}
+
+def import_paddle():
+    """Imports paddlex/paddle into this process on first use; a missing install is left to create_pipeline."""
+    global pdx, paddle
+    if pdx is not None:
+        return
+    try:
+        import paddle as paddle_module
+        import paddlex as pdx_module
+    except ImportError:
+        return
+    paddle_module.disable_signal_handler()  # Disable Paddle's signal handler
+    pdx, paddle = pdx_module, paddle_module
+
+def warmup_pipeline():
+    """Runs one predict call on a synthetic page so the first real batch doesn't pay for lazy initialisation."""
+    page = np.full((960, 720, 3), 255, dtype=np.uint8)
+    for line, y in enumerate(range(80, 900, 60)):
+        cv2.putText(page, f"Warm-up line {line} 0123456789", (40, y), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 0), 2)
+    with RedirectStdout():
+        list(global_pipeline.predict([page] * worker_options["predict_batch_size"]))
+
+def create_pipeline(config_path, batch_size, cpu_threads=None):
+    """Creates the OCR pipeline, or a stand-in named by the HIGHOCR_PIPELINE_FACTORY env var.
+
+    ``cpu_threads`` sets the intra-op threads of a CPU worker's predictors.
+    """
+    factory_spec = os.environ.get(PIPELINE_FACTORY_ENV)
+    if factory_spec:
+        module_name, _, function_name = factory_spec.partition(":")
+        factory = getattr(importlib.import_module(module_name), function_name)
+    else:
+        import_paddle()
+        if pdx is None:
+            raise ImportError(f"paddlex is not installed and {PIPELINE_FACTORY_ENV} is not set")
+        factory = pdx.create_pipeline
+        option = cpu_predictor_option(cpu_threads) if cpu_threads else None
+        if option is not None:
+            return factory(config_path, pp_option=option, hpi_params={"batch_size": batch_size})
+    return factory(config_path, hpi_params={"batch_size": batch_size})
+
+def cpu_predictor_option(threads):
+    """PaddleX predictor option for CPU inference with ``threads`` threads, or None if this PaddleX has none.
+
+    Without it the thread environment variables set for the worker are all
+    that limits Paddle's CPU math library.
+    """
+    try:
+        from paddlex.inference.utils.pp_option import PaddlePredictorOption
+        option = PaddlePredictorOption()
+        option.device = "cpu"
+        option.cpu_threads = threads
+    except (ImportError, AttributeError, ValueError):
+        return None
+    return option
+
+def init_worker(config_path, batch_size, options=None, run_paths=None, worker_slots=None, slot_pids=None, log_queue=None,
+                events_queue=None):
+    """Initializes worker process.
+
+    ``run_paths`` carries the run's root directories once per worker, so
+    work items only need the image path relative to image_root_dir.  With
+    ``worker_slots`` the worker claims a slot and loads that slot's
+    device-pinned config instead of ``config_path``.  With ``log_queue``
+    all output goes to the parent's LogListener.  ``events_queue`` is the
+    parent's WatchedPool channel for task start announcements.
+    """
     global global_pipeline
+    global log_sink
+    global worker_options
+    global prefetch_executor
+    global result_writer
+    global scratch
+    global dedup_cache
+    global image_root_dir, output_root_dir, error_dir, log_file_path
+    global task_events
+    log_sink = log_queue
+    task_events = events_queue
+    global startup_times
     try:
-        global_pipeline = pdx.create_pipeline(config_path, hpi_params={"batch_size": batch_size})
-        colored_output(f"[{get_beijing_time()}] Worker process initialized (PID: {os.getpid()})", "green")
+        if run_paths:
+            image_root_dir = run_paths["image_root_dir"]
+            output_root_dir = run_paths["output_root_dir"]
+            error_dir = run_paths["error_dir"]
+            log_file_path = run_paths["log_file_path"]
+        worker_options = {**DEFAULT_WORKER_OPTIONS, **(options or {})}
+        if worker_options["ignore_sigint"]:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        device = None
+        if worker_slots:
+            slot = worker_slots[claim_worker_slot(slot_pids)]
+            config_path = slot["config"]
+            device = slot["device"]
+            if slot["threads"]:
+                for var in THREAD_ENV_VARS:
+                    os.environ[var] = str(slot["threads"])
+            if slot.get("cpus"):
+                os.sched_setaffinity(0, slot["cpus"])  # Threads started from here on inherit the core set
+        import_start = time.time()
+        import_paddle()
+        setup_start = time.time()
+        threads = worker_options["prefetch_threads"]
+        prefetch_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prefetch") if threads > 0 else None
+        result_writer = ShardResultWriter() if worker_options["result_sink"] == "shard" else None
+        if worker_options["dedup"] and run_paths and run_paths.get("dedup_cache_path"):
+            dedup_cache = ResultCache(run_paths["dedup_cache_path"], worker_options["dedup_cache_mb"] * 1024 * 1024)
+            multiprocessing.util.Finalize(None, dedup_cache.close, exitpriority=10)
+        if run_paths and run_paths.get("scratch_dir"):
+            scratch = ScratchSpace(run_paths["scratch_dir"], worker_options["scratch_budget_mb"] * 1024 * 1024)
+            scratch.activate()
+            # Pool workers skip atexit handlers, so register with multiprocessing's finalizers
+            multiprocessing.util.Finalize(None, scratch.remove, exitpriority=10)
+        pipeline_start = time.time()
+        cpu_threads = slot["threads"] if device and device.startswith("cpu") else None
+        global_pipeline = create_pipeline(config_path, batch_size, cpu_threads)
+        warmup_start = time.time()
+        if worker_options["warmup"]:
+            try:
+                warmup_pipeline()
+            except Exception as e:
+                colored_output(f"[{get_beijing_time()}] Warm-up predict failed in worker {os.getpid()}: {e}", "yellow")
+        ready = time.time()
+        startup_times = {
+            "import": setup_start - import_start,
+            "pipeline": warmup_start - pipeline_start,
+            "warmup": ready - warmup_start,
+            "ready_at": ready,
+        }
+        if task_events is not None:
+            task_events.put((None, os.getpid(), ready))  # WatchedPool times lost tasks from worker readiness
+        device_str = f", slot {slot['slot']} on {device}" if device else ""
+        if device and slot.get("cpus"):
+            numa_str = f", NUMA node {slot['numa_node']}" if slot["numa_node"] is not None else ""
+            device_str += f", cores {format_cpu_list(slot['cpus'])}{numa_str}"
+        colored_output(
+            f"[{get_beijing_time()}] Worker process initialized (PID: {os.getpid()}{device_str}) in {ready - import_start:.1f}s: "
+            f"imports {startup_times['import']:.1f}s, pipeline {startup_times['pipeline']:.1f}s, warm-up {startup_times['warmup']:.1f}s",
+            "green"
+        )
     except Exception as e:
         colored_output(f"[{get_beijing_time()}] Error initializing worker: {e}", "red")
         raise
@@ -113,157 +825,2280 @@ def process_image(image_info):
         raise RuntimeError("Pipeline not initialized!")
 
     try:
-        # Validate with PIL
-        try:
-            img = Image.open(image_path)
-            img.verify()
-            img.close()
-        except (IOError, SyntaxError) as e:
-            raise Exception(f"Image validation failed: {e}")
+        # Read, validate and decode once; the pipeline gets the array
+        image = load_image(image_path)
+        if worker_options["blank_filter"] and skip_blank_page(image_path, output_dir, image):
+            return True
+        if reuse_cached_result(image_path, output_dir):
+            return True
+        if needs_tiling(image):
+            return process_tiled(image_path, output_dir, image, error_dir, log_file_path)
+        scales = {}
+        image = prepare_for_predict(image, image_path, scales, None)
 
         # Redirect stdout *during* PaddleOCR prediction
+        predict_start = time.perf_counter()
         with RedirectStdout():  # Use the context manager
-            output = global_pipeline.predict(image_path)
-
-        base_name = os.path.splitext(os.path.basename(image_path))[0]
+            output = list(global_pipeline.predict(image))
+        record_stage("predict", time.perf_counter() - predict_start)
 
         for res in output:
-            res.save_to_json(
-                save_path=os.path.join(output_dir, f"{base_name}_result.json"),
-                indent=4,
-                ensure_ascii=False,
-            )
+            if image_path in scales:
+                map_result_to_original(res, scales[image_path])
+            save_result(res, image_path, output_dir)
         return True
 
     except Exception as e:
-        colored_output(f"[{get_beijing_time()}] Error processing {image_path}: {e}", "red", log_file_path)
+        handle_image_error(image_path, e, error_dir, log_file_path)
+        return False
+
+created_output_dirs = set()
+result_writer = None  # ShardResultWriter when worker_options["result_sink"] == "shard"
+scratch = None  # ScratchSpace when the run provides a scratch directory
+downscaled_count = 0
+last_scratch_check = 0.0
+dedup_cache = None  # ResultCache when worker_options["dedup"] is set
+cache_keys = {}  # image_path -> (content key, width, height), filled by load_image
+dedup_counts = {"dedup_hits": 0, "dedup_misses": 0}
+blank_counts = {"blank_pages": 0}
+tile_counts = {"tiled_images": 0, "tiles": 0, "tile_duplicates": 0}
+task_events = None  # WatchedPool start announcements, set by init_worker
+page_images = {}  # image_path -> file bytes until the page is rendered (fused PDF mode)
+pdf_pages = {}  # image_path -> one-page PDF with text layer, sent to the parent with the task stats
+startup_times = None  # Worker startup breakdown, sent to the parent with the first finished task
+
+def task_finished(stats, task_start):
+    """Per-task housekeeping: flushes shards, keeps scratch within budget and attaches stage timings.
+
+    Summable counters stay at the top level of ``stats``; ``stats["metrics"]``
+    carries the per-task timings the parent feeds into its RunMetrics.
+    """
+    global last_scratch_check
+    global startup_times
+    if result_writer is not None:
+        result_writer.flush()
+    if dedup_cache is not None:
+        dedup_cache.flush()
+        for key in dedup_counts:
+            stats[key] = stats.get(key, 0) + dedup_counts[key]
+            dedup_counts[key] = 0
+    if blank_counts["blank_pages"]:
+        stats["blank_pages"] = stats.get("blank_pages", 0) + blank_counts["blank_pages"]
+        blank_counts["blank_pages"] = 0
+    for key in tile_counts:
+        if tile_counts[key]:
+            stats[key] = stats.get(key, 0) + tile_counts[key]
+            tile_counts[key] = 0
+    if scratch is not None and time.time() - last_scratch_check >= worker_options["scratch_check_interval"]:
+        last_scratch_check = time.time()
+        enforce_start = time.perf_counter()
+        scratch.enforce()
+        record_stage("scratch_enforce", time.perf_counter() - enforce_start)
+        stats.update(scratch.take_stats())
+    stats["metrics"] = {
+        "pid": os.getpid(),
+        "started": task_start,
+        "task_time": time.time() - task_start,
+        "stages": take_stage_times(),
+    }
+    if startup_times is not None:
+        stats["metrics"]["startup"] = startup_times
+        startup_times = None
+    if pdf_pages:
+        stats["pdf_pages"] = {os.path.relpath(image_path, image_root_dir): page for image_path, page in pdf_pages.items()}
+        pdf_pages.clear()
+    return stats
+
+def ensure_output_dir(output_dir):
+    """Creates an output directory once per worker instead of once per image."""
+    if output_dir not in created_output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+        created_output_dirs.add(output_dir)
+
+def render_pdf_page(image_path, record, log_file_path):
+    """Renders the image with its text layer as a one-page PDF for the parent (fused PDF mode)."""
+    data = page_images.pop(image_path, None)
+    if data is None:
+        return
+    render_start = time.perf_counter()
+    import fitz
+    from pdf_creator_with_text_layer6 import add_text_page
+    with pdf_lock:
+        doc = fitz.open()
         try:
-            relative_path = os.path.relpath(image_path, image_root_dir)
-            error_image_path = os.path.join(error_dir, relative_path)
-            os.makedirs(os.path.dirname(error_image_path), exist_ok=True)
-            shutil.copy2(image_path, error_image_path)
-        except Exception as copy_error:
-            colored_output(f"[{get_beijing_time()}] Error copying file {image_path}: {copy_error}", "red", log_file_path)
+            add_text_page(doc, data, record.get("dt_polys", []), record.get("rec_text", []), worker_options["pdf_y_offset"])
+            pdf_pages[image_path] = doc.tobytes(deflate=True)
+        except Exception as e:
+            # The OCR result stands; the directory PDF reports the page as missing
+            colored_output(f"[{get_beijing_time()}] Could not render PDF page for {image_path}: {e}", "yellow", log_file_path)
+        finally:
+            doc.close()
+    record_stage("render", time.perf_counter() - render_start)
+
+def save_result(res, image_path, output_dir):
+    """Writes one result to the configured sink (per-image JSON, directory shards or none) and PDF page."""
+    save_start = time.perf_counter()
+    base_name = os.path.splitext(split_source_path(image_path)[1])[0]
+    record = compact_record(res) if result_writer is not None or dedup_cache is not None or worker_options["pdf_pages"] else None
+    if result_writer is not None:
+        ensure_output_dir(output_dir)
+        result_writer.write(output_dir, base_name, record)
+    elif worker_options["result_sink"] == "json":
+        ensure_output_dir(output_dir)
+        res.save_to_json(
+            save_path=os.path.join(output_dir, f"{base_name}_result.json"),
+            indent=4,
+            ensure_ascii=False,
+        )
+    cached = cache_keys.pop(image_path, None)
+    if cached is not None:
+        key, width, height = cached
+        dedup_cache.put(key, width, height, record)
+    record_stage("save", time.perf_counter() - save_start)
+    if worker_options["pdf_pages"]:
+        render_pdf_page(image_path, record, log_file_path)
+
+def reuse_cached_result(image_path, output_dir):
+    """Writes the cached result of an identical image instead of predicting; returns True on a hit."""
+    cached = cache_keys.get(image_path)
+    if cached is None:
         return False
+    key, width, height = cached
+    entry = dedup_cache.get(key, width, height)
+    if entry is None:
+        dedup_counts["dedup_misses"] += 1
+        return False
+    del cache_keys[image_path]
+    cached_width, cached_height, record = entry
+    if (cached_width, cached_height) != (width, height):
+        # Perceptual hit on a copy saved at another resolution
+        record = to_jsonable(map_result_to_original(record, (cached_width / width, cached_height / height)))
+    write_record(image_path, output_dir, record)
+    dedup_counts["dedup_hits"] += 1
+    return True
+
+def skip_blank_page(image_path, output_dir, image):
+    """Writes an empty result instead of predicting when the page shows no likely text; returns True if so."""
+    check_start = time.perf_counter()
+    edge_density, std = blank_page_metrics(image, worker_options["blank_thumbnail_edge"])
+    record_stage("blank_check", time.perf_counter() - check_start)
+    if edge_density >= worker_options["blank_max_edge_density"] and std >= worker_options["blank_max_std"]:
+        return False
+    cache_keys.pop(image_path, None)
+    write_record(image_path, output_dir, {
+        "dt_polys": [], "dt_scores": [], "rec_text": [], "rec_score": [],
+        "blank_page": {"edge_density": round(edge_density, 6), "std": round(std, 2)},
+    })
+    blank_counts["blank_pages"] += 1
+    return True
+
+def write_record(image_path, output_dir, record):
+    """Writes a result that did not come from predict (a compact record) to the configured sink."""
+    save_start = time.perf_counter()
+    base_name = os.path.splitext(split_source_path(image_path)[1])[0]
+    if result_writer is not None:
+        ensure_output_dir(output_dir)
+        result_writer.write(output_dir, base_name, record)
+    elif worker_options["result_sink"] == "json":
+        ensure_output_dir(output_dir)
+        with open(os.path.join(output_dir, f"{base_name}_result.json"), "w", encoding="utf-8") as f:
+            json.dump({"input_path": image_path, **record}, f, indent=4, ensure_ascii=False)
+    record_stage("save", time.perf_counter() - save_start)
+    if worker_options["pdf_pages"]:
+        render_pdf_page(image_path, record, log_file_path)
+
+def handle_image_error(image_path, error, error_dir, log_file_path, copy=None):
+    """Logs a failed image and copies it into the error directory.
+
+    Workers of a first pass whose failures get retried (copy_errors off)
+    only log; the copy is left to the final attempt.
+    """
+    cache_keys.pop(image_path, None)
+    page_images.pop(image_path, None)
+    if copy is None:
+        copy = worker_options["copy_errors"]
+    if not copy:
+        colored_output(f"[{get_beijing_time()}] Error processing {image_path}: {error} (will retry)", "yellow", log_file_path)
+        return
+    colored_output(f"[{get_beijing_time()}] Error processing {image_path}: {error}", "red", log_file_path)
+    try:
+        relative_path = os.path.relpath(image_path, image_root_dir)
+        error_image_path = os.path.join(error_dir, output_relative_path(relative_path))
+        os.makedirs(os.path.dirname(error_image_path), exist_ok=True)
+        if is_virtual(image_path):
+            with open(error_image_path, "wb") as f:
+                f.write(read_source(image_path))
+        else:
+            shutil.copy2(image_path, error_image_path)
+    except Exception as copy_error:
+        colored_output(f"[{get_beijing_time()}] Error copying file {image_path}: {copy_error}", "red", log_file_path)
+
+def predict_and_save(valid, images, error_dir, log_file_path, results, scales=None):
+    """Runs one predict call over decoded images and saves each result.
+
+    A failure of the batched predict falls back to per-image processing so
+    that one bad image never fails the whole group.  Results of images in
+    ``scales`` (downscaled before predict) are mapped back to original
+    coordinates before saving.
+    """
+    try:
+        predict_start = time.perf_counter()
+        with RedirectStdout():
+            output = list(global_pipeline.predict(images))
+        predict_time = time.perf_counter() - predict_start
+        record_stage("predict_call", predict_time)
+        record_stage("predict", predict_time / len(images))  # Per-image share, comparable with single mode
+        if len(output) != len(valid):
+            raise RuntimeError(f"Expected {len(valid)} results, got {len(output)}")
+    except Exception as e:
+        colored_output(f"[{get_beijing_time()}] Batch predict failed ({e}), retrying images one by one.", "yellow", log_file_path)
+        for image_path, output_dir in valid:
+            results[image_path] = process_image((image_path, output_dir, error_dir, log_file_path))
+        return
+
+    # Arrays have no input_path, so results are matched by input order.
+    for (image_path, output_dir), res in zip(valid, output):
+        try:
+            if scales and image_path in scales:
+                map_result_to_original(res, scales[image_path])
+            save_result(res, image_path, output_dir)
+            results[image_path] = True
+        except Exception as e:
+            handle_image_error(image_path, e, error_dir, log_file_path)
+            results[image_path] = False
+
+def resolve_work_item(relative_path):
+    """Maps a work item (image path relative to image_root_dir) to (image_path, output_dir).
+
+    Members of archives and PDFs ("vol1.zip::scans/p1.png") get the output
+    directory mirroring them as if the container were extracted ("vol1/scans").
+    """
+    image_path = os.path.join(image_root_dir, relative_path)
+    output_dir = os.path.join(output_root_dir, os.path.dirname(output_relative_path(relative_path)))
+    return image_path, output_dir
+
+def process_batch(batch):
+    """Processes a group of images in batched predict calls.
+
+    ``batch`` is a list of image paths relative to image_root_dir.  Images are
+    read and decoded by the worker's prefetcher while the previous predict
+    call runs.  Returns (relative_path, success) for every image, in the
+    order of the batch, and the worker stats for this task.
+    """
+    global global_pipeline
+
+    if global_pipeline is None:
+        raise RuntimeError("Pipeline not initialized!")
+
+    task_start = time.time()
+    stats = {"predict_batches": 0, "starved_batches": 0, "prefetch_wait_time": 0.0}
+    results = {}
+    items = [resolve_work_item(relative_path) for relative_path in batch]
+    # Decoded images held ahead of predict and in the current group each stay within the byte budget
+    max_bytes = worker_options["prefetch_max_mb"] * 1024 * 1024 if worker_options["prefetch_max_mb"] else None
+    prefetcher = ImagePrefetcher(prefetch_executor, worker_options["prefetch_depth"], max_bytes)
+    for group in batched_by_bytes(prefetcher.iterate(items), worker_options["predict_batch_size"], max_bytes):
+        valid = []
+        images = []
+        scales = {}
+        samples = {}
+        copies = []  # Exact copies of an image predicted in this group; they reuse its result afterwards
+        predicted_keys = set()
+        for (image_path, output_dir), image, error in group:
+            key = cache_keys.get(image_path, (None,))[0]
+            if error is not None:
+                handle_image_error(image_path, error, error_dir, log_file_path)
+                results[image_path] = False
+            elif worker_options["blank_filter"] and skip_blank_page(image_path, output_dir, image):
+                results[image_path] = True
+            elif key is not None and key in predicted_keys:
+                copies.append(((image_path, output_dir), image))
+            elif reuse_cached_result(image_path, output_dir):
+                results[image_path] = True
+            elif needs_tiling(image):
+                results[image_path] = process_tiled(image_path, output_dir, image, error_dir, log_file_path)
+            else:
+                scaled = prepare_for_predict(image, image_path, scales, samples)
+                if image_path in samples:
+                    samples[image_path] = (image, scaled, scales[image_path])
+                images.append(scaled)
+                valid.append((image_path, output_dir))
+                if key is not None:
+                    predicted_keys.add(key)
+        stats["downscaled_images"] = stats.get("downscaled_images", 0) + len(scales)
+
+        # Decoding finished behind predict unless the prefetcher had to block
+        waits, wait_time = prefetcher.take_waits()
+        stats["prefetch_wait_time"] += wait_time
+
+        if valid:
+            stats["predict_batches"] += 1
+            stats["starved_batches"] += 1 if waits else 0  # Counted per predict call, like predict_batches
+            predict_and_save(valid, images, error_dir, log_file_path, results, scales)
+        for (image_path, output_dir), image in copies:
+            if reuse_cached_result(image_path, output_dir):
+                results[image_path] = True
+            else:  # Its copy failed: predict it on its own
+                stats["predict_batches"] += 1
+                predict_and_save([(image_path, output_dir)], [prepare_for_predict(image, image_path, scales, None)],
+                                 error_dir, log_file_path, results, scales)
+        for image_path, sample in samples.items():
+            try:
+                for key, value in measure_downscale_sample(*sample).items():
+                    stats[key] = stats.get(key, 0) + value
+            except Exception as e:
+                colored_output(f"[{get_beijing_time()}] Downscale sample failed for {image_path}: {e}", "yellow", log_file_path)
+        del images, group, samples, copies
+
+    return [(relative_path, results[image_path]) for relative_path, (image_path, _) in zip(batch, items)], task_finished(stats, task_start)
+
+def process_single(relative_path):
+    """Processes one image with the same result shape as process_batch."""
+    task_start = time.time()
+    image_path, output_dir = resolve_work_item(relative_path)
+    return [(relative_path, process_image((image_path, output_dir, error_dir, log_file_path)))], task_finished({}, task_start)
+
+def batched(iterable, n, max_wait=None):
+    """Groups an iterable into lists of at most n items.
+
+    With ``max_wait``, a partial list is also yielded once the iterable has
+    been quiet for that many seconds (a work source that trickles items).
+    """
+    batch = []
+    for item in iterable if max_wait is None else background_iter(iterable, idle_timeout=max_wait):
+        if item is IDLE:
+            if batch:
+                yield batch
+                batch = []
+            continue
+        batch.append(item)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def batched_by_bytes(prefetched, n, max_bytes=None):
+    """Groups prefetched (item, image, error) tuples like batched, also capping a group's decoded bytes.
+
+    An image that would take a group over ``max_bytes`` starts the next
+    one, so images larger than the cap are processed one at a time.
+    """
+    batch = []
+    batch_bytes = 0
+    for entry in prefetched:
+        image_bytes = entry[1].nbytes if entry[1] is not None else 0
+        if batch and max_bytes and batch_bytes + image_bytes > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += image_bytes
+        if len(batch) >= n:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+# --- Directory Scanning ---
+
+def scan_directory(directory):
+    """Lists one directory: returns (directory, subdirectories, archives/PDFs, [(name, size, mtime_ns)])."""
+    subdirs = []
+    containers = []
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                elif SCAN_CONTAINERS and is_container(entry.name) and entry.is_file():
+                    containers.append(entry.path)
+    except OSError as e:
+        colored_output(f"[{get_beijing_time()}] Error scanning {directory}: {e}", "red", log_file_path)
+    files.sort()
+    return directory, subdirs, containers, files
+
+def scan_container(path):
+    """Lists an archive or PDF like a directory tree: returns [(virtual directory, files)].
+
+    Virtual directories are "<container>::<member directory>", so members
+    flow through resume, dispatch and output like files on disk.
+    """
+    skipped = []
+    try:
+        groups = list_container(path, IMAGE_EXTENSIONS, skipped)
+    except Exception as e:
+        colored_output(f"[{get_beijing_time()}] Error reading {path}: {e}", "red", log_file_path)
+        return []
+    if skipped:
+        colored_output(
+            f"[{get_beijing_time()}] Skipped {len(skipped)} members of {path} with absolute or escaping names, e.g. {skipped[0]!r}",
+            "yellow", log_file_path
+        )
+    return [(f"{path}{SOURCE_SEPARATOR}{member_dir}", sorted(files)) for member_dir, files in sorted(groups.items())]
+
+def scan_image_tree(root_dir, scan_threads=8, on_directory=None):
+    """Yields (directory, files) for every directory under root_dir.
+
+    Subdirectories are listed in parallel with os.scandir and each
+    directory is yielded as soon as it has been listed, so dispatch can
+    start long before the whole tree has been walked.  Archives and PDFs
+    are listed on the same threads and yield their virtual directories.
+    ``on_directory`` is called with every real directory before it is
+    listed (ocr_watch.py adds its inotify watches there).
+    """
+    with ThreadPoolExecutor(max_workers=scan_threads, thread_name_prefix="scan") as executor:
+        if on_directory is not None:
+            on_directory(root_dir)
+        pending = {executor.submit(scan_directory, root_dir)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if isinstance(result, list):  # From scan_container
+                    yield from result
+                    continue
+                directory, subdirs, containers, files = result
+                for subdir in subdirs:
+                    if on_directory is not None:
+                        on_directory(subdir)
+                    pending.add(executor.submit(scan_directory, subdir))
+                for container in containers:
+                    pending.add(executor.submit(scan_container, container))
+                if files:
+                    yield directory, files
+
+def scan_work_items(image_root_dir, output_root_dir, manifest, pending_files, scan_progress, scan_threads, log_file_path, start_time,
+                    tracker=None):
+    """Streams work items (paths relative to image_root_dir) while the tree is being scanned.
+
+    Images recorded in ``manifest`` with an unchanged size and mtime are
+    skipped.  Every yielded item is entered in ``pending_files`` with its
+    (size, mtime_ns) until its result lands; ``scan_progress`` counts the
+    items found and is marked done at the end.  A DirectoryTracker learns
+    each directory's images before its first item is yielded.
+    """
+    skipped_count = 0
+    changed_count = 0
+    for directory, files in scan_image_tree(image_root_dir, scan_threads):
+        relative_dir = os.path.relpath(directory, image_root_dir)
+        output_dir = os.path.join(output_root_dir, output_relative_path(relative_dir))
+        output_dir_exists = None
+        queued = []
+        for file, size, mtime_ns in files:
+            image_path = join_source_path(directory, file)
+            recorded = manifest.lookup(image_path)
+            if recorded == (size, mtime_ns):
+                skipped_count += 1
+                continue
+            if recorded is None:
+                # Results written before the manifest existed are adopted once
+                if output_dir_exists is None:
+                    output_dir_exists = os.path.isdir(output_dir)
+                base_name = os.path.splitext(file)[0]
+                if output_dir_exists and os.path.exists(os.path.join(output_dir, f"{base_name}_result.json")):
+                    manifest.mark_complete(image_path, size, mtime_ns)
+                    skipped_count += 1
+                    continue
+            else:
+                changed_count += 1
+            queued.append((file, size, mtime_ns))
+        if tracker is not None:
+            tracker.expect(relative_dir, files, [file for file, _, _ in queued])
+        for file, size, mtime_ns in queued:
+            relative_path = os.path.normpath(join_source_path(relative_dir, file))
+            pending_files[relative_path] = (size, mtime_ns)
+            scan_progress["found"] += 1
+            yield relative_path
+    manifest.flush()
+    scan_progress["done"] = True
+    scan_progress["time"] = time.time() - start_time
+    colored_output(f"[{get_beijing_time()}] Scan finished: {scan_progress['found']} images to process.", "blue", log_file_path)
+    if skipped_count > 0:
+        colored_output(f"[{get_beijing_time()}] Skipped {skipped_count} completed files.", "yellow", log_file_path)
+    if changed_count > 0:
+        colored_output(f"[{get_beijing_time()}] Re-queued {changed_count} files changed since their OCR.", "yellow", log_file_path)
+
+# --- Completion Manifest ---
+
+def manifest_key(image_root, relative_path):
+    """The manifest path of a work item, as the scan looks it up ("./a.png" in the root is "<root>/a.png")."""
+    return os.path.join(image_root, os.path.normpath(relative_path))
+
+class CompletionManifest:
+    """SQLite record of finished images keyed by path, size and mtime.
+
+    Resume looks images up here instead of stat-ing their result files, and
+    an image whose size or mtime changed since it was OCR'd is picked up
+    again.  Completions are buffered and committed in one transaction every
+    few seconds, so a crash loses at most the last few records (which are
+    then simply redone).  The scanner thread and the result loop share one
+    connection, guarded by a lock.
+    """
+    def __init__(self, db_path, commit_interval=2.0, commit_every=500):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS completed ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, finished_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+        self.commit_interval = commit_interval
+        self.commit_every = commit_every
+        self.pending = {}  # path -> (size, mtime_ns, finished_at) not committed yet
+        self.last_commit = time.time()
+
+    def lookup(self, path):
+        """Returns the (size, mtime_ns) recorded for path, or None."""
+        with self.lock:
+            pending = self.pending.get(path)
+            if pending is not None:
+                return pending[:2]
+            return self.conn.execute("SELECT size, mtime_ns FROM completed WHERE path = ?", (path,)).fetchone()
+
+    def mark_complete(self, path, size, mtime_ns):
+        with self.lock:
+            self.pending[path] = (size, mtime_ns, time.time())
+            if len(self.pending) >= self.commit_every or time.time() - self.last_commit >= self.commit_interval:
+                self._commit()
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        if self.pending:
+            with self.conn:  # One atomic transaction
+                self.conn.executemany("INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?)",
+                                      [(path, *record) for path, record in self.pending.items()])
+            self.pending = {}
+        self.last_commit = time.time()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+# --- Directory Completion ---
+
+class DirectoryTracker:
+    """Follows each directory's outstanding images and finishes the directory with its last result.
+
+    A finished directory gets a completion marker (COMPLETION_MARKER in its
+    output directory) with its image counts and source checksum, written
+    atomically; pdf_creator_with_text_layer6.py --follow builds PDFs as
+    these appear.  A directory queued again removes its marker first.
+
+    With a ``pdf_root`` (fused mode) the directory's searchable PDF is
+    saved before the marker.  Workers render every page with its text
+    layer (render_pdf_page) and send it back with the task stats, so
+    nothing is read back from disk except pages finished in an earlier
+    run, which take the old result-file route.  Pages wait in memory only
+    up to PDF_SPILL_PAGES per directory and PDF_BUFFER_MB in all; beyond
+    that they are appended to chunk PDFs in a temporary directory under
+    ``pdf_root`` and copied from there on assembly.  Failed pages are left out
+    and logged, like pdf_creator_with_text_layer6.py does.  In fused mode a
+    directory's images enter the manifest only once its PDF is saved: an
+    interrupted directory is redone as a whole and never depends on result
+    files that were not kept.  Markers and assembly run on one background
+    thread so dispatch is not held up.
+    """
+    def __init__(self, image_root, output_root, manifest, result_sink, log_file_path, pdf_root=None, y_offset=30):
+        self.image_root = image_root
+        self.output_root = output_root
+        self.manifest = manifest
+        self.result_sink = result_sink
+        self.log_file_path = log_file_path
+        self.pdf_root = pdf_root
+        self.y_offset = y_offset
+        self.lock = threading.Lock()
+        self.directories = {}  # relative dir -> {"files", "checksum", "queued", "waiting", "pages", "page_bytes", "spilled", "finished"}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="directory-finish")
+        self.buffered_bytes = 0  # Rendered pages held in memory by unfinished directories
+        self.spill_dir = None  # Chunk PDFs of spilled pages, created on first use
+        self.spill_ids = itertools.count()
+        self.markers = 0
+        self.saved = 0
+        self.failed = 0
+
+    def marker_path(self, relative_dir):
+        return os.path.join(self.output_root, output_relative_path(relative_dir), COMPLETION_MARKER)
+
+    def expect(self, relative_dir, files, queued):
+        """Registers a directory: all of its images as (name, size, mtime_ns), and the names queued for OCR in this run.
+
+        A directory with nothing queued is finished right away unless its
+        marker is already up to date.
+        """
+        directory = {"files": files, "checksum": source_checksum(files), "queued": set(queued), "waiting": set(queued),
+                     "pages": {}, "page_bytes": 0, "spilled": {}, "finished": []}
+        marker_path = self.marker_path(relative_dir)
+        if queued:
+            remove_marker(marker_path)
+            with self.lock:
+                self.directories[relative_dir] = directory
+            return
+        marker = read_marker(marker_path)
+        if marker is None or marker.get("source_checksum") != directory["checksum"]:
+            self.executor.submit(self._finish, relative_dir, directory)
+
+    def add_page(self, relative_path, size, mtime_ns, success, page):
+        """Records the final result of an image; ``page`` is its rendered PDF page, if any."""
+        if success and not self.pdf_root:
+            self.manifest.mark_complete(manifest_key(self.image_root, relative_path), size, mtime_ns)
+        relative_dir, file = split_source_path(relative_path)
+        relative_dir = relative_dir or "."
+        with self.lock:
+            directory = self.directories.get(relative_dir)
+            if directory is None:
+                return
+            directory["waiting"].discard(file)
+            directory["finished"].append((file, size, mtime_ns, success))
+            if success and page is not None:
+                directory["pages"][file] = page
+                directory["page_bytes"] += len(page)
+                self.buffered_bytes += len(page)
+            if not directory["waiting"]:
+                del self.directories[relative_dir]
+                self.buffered_bytes -= directory["page_bytes"]
+                self.executor.submit(self._finish, relative_dir, directory)
+                return
+            spills = [directory] if len(directory["pages"]) >= PDF_SPILL_PAGES else []
+            if self.buffered_bytes > PDF_BUFFER_MB * 1024 * 1024:
+                spills.append(max(self.directories.values(), key=lambda d: d["page_bytes"]))
+            for spilled in spills:
+                if spilled["pages"]:
+                    pages, spilled["pages"] = spilled["pages"], {}
+                    self.buffered_bytes -= spilled["page_bytes"]
+                    spilled["page_bytes"] = 0
+                    self.executor.submit(self._spill, spilled, pages)
+
+    def _spill(self, directory, pages):
+        """Writes buffered pages to one chunk PDF; runs on the finish thread, so before the directory's assembly."""
+        import fitz
+        with pdf_lock:
+            doc = fitz.open()
+            try:
+                for page in pages.values():
+                    with fitz.open("pdf", page) as page_doc:
+                        doc.insert_pdf(page_doc)
+                if self.spill_dir is None:
+                    os.makedirs(self.pdf_root, exist_ok=True)
+                    self.spill_dir = tempfile.mkdtemp(prefix=".ocr_pages_", dir=self.pdf_root)
+                chunk_path = os.path.join(self.spill_dir, f"chunk_{next(self.spill_ids)}.pdf")
+                doc.save(chunk_path)
+            except Exception as e:
+                colored_output(f"[{get_beijing_time()}] Could not spill {len(pages)} PDF pages to disk, kept in memory: {e}", "yellow", self.log_file_path)
+                with self.lock:
+                    directory["pages"].update(pages)
+                return
+            finally:
+                doc.close()
+        for index, file in enumerate(pages):
+            directory["spilled"][file] = (chunk_path, index)
+
+    def _finish(self, relative_dir, directory):
+        if self.pdf_root and directory["queued"] and not self._assemble(relative_dir, directory):
+            return
+        failed = sorted(file for file, _, _, success in directory["finished"] if not success)
+        marker = {
+            "directory": relative_dir,
+            "images": len(directory["files"]),
+            "succeeded": len(directory["files"]) - len(failed),
+            "failed": failed,
+            "processed_this_run": len(directory["finished"]),
+            "source_checksum": directory["checksum"],
+            "result_sink": self.result_sink,
+            "finished_at": get_beijing_time(),
+        }
+        marker_path = self.marker_path(relative_dir)
+        try:
+            os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+            write_marker(marker_path, marker)
+            self.markers += 1
+        except OSError as e:
+            colored_output(f"[{get_beijing_time()}] Error writing completion marker {marker_path}: {e}", "red", self.log_file_path)
+
+    def pdf_path(self, relative_dir):
+        name = output_relative_path(relative_dir).rstrip("/") if relative_dir != "." else os.path.basename(os.path.normpath(self.image_root))
+        return os.path.join(self.pdf_root, f"{name}_searchable.pdf")
+
+    def _assemble(self, relative_dir, directory):
+        """Saves the directory's PDF; False if it could not be saved."""
+        with pdf_lock:  # MuPDF is not thread-safe; the scan lists PDFs with fitz too
+            return self._build(relative_dir, directory)
+
+    def _build(self, relative_dir, directory):
+        import fitz
+        from pdf_creator_with_text_layer6 import add_text_page
+
+        assemble_start = time.time()
+        image_dir = os.path.join(self.image_root, relative_dir)
+        output_dir = os.path.join(self.output_root, output_relative_path(relative_dir))
+        pdf_path = self.pdf_path(relative_dir)
+        shard_index = None
+        missing = []
+        kept = False
+        chunks = {}  # chunk path -> open chunk PDF of spilled pages
+        doc = fitz.open()
+        try:
+            for file in sort_pages(file for file, _, _ in directory["files"]):
+                page = directory["pages"].pop(file, None)
+                try:
+                    if page is not None:
+                        with fitz.open("pdf", page) as page_doc:
+                            doc.insert_pdf(page_doc)
+                        continue
+                    if file in directory["spilled"]:
+                        chunk_path, index = directory["spilled"][file]
+                        if chunk_path not in chunks:
+                            chunks[chunk_path] = fitz.open(chunk_path)
+                        doc.insert_pdf(chunks[chunk_path], from_page=index, to_page=index)
+                        continue
+                    if file in directory["queued"]:  # Failed in this run
+                        missing.append(file)
+                        continue
+                    # OCR'd in an earlier run
+                    if shard_index is None:
+                        shard_index = ShardResultIndex(output_dir)
+                    data = load_result(output_dir, os.path.splitext(file)[0], shard_index)
+                    if data is None or "dt_polys" not in data or "rec_text" not in data:
+                        missing.append(file)
+                        continue
+                    image_path = join_source_path(image_dir, file)
+                    add_text_page(doc, read_source(image_path) if is_virtual(image_path) else image_path,
+                                  data["dt_polys"], data["rec_text"], self.y_offset)
+                except Exception as e:
+                    colored_output(f"[{get_beijing_time()}] PDF page {file} of {relative_dir} failed: {e}", "red", self.log_file_path)
+                    missing.append(file)
+            existing_pages = 0
+            if os.path.exists(pdf_path):
+                with fitz.open(pdf_path) as existing:
+                    existing_pages = existing.page_count
+            if doc.page_count == 0 and not existing_pages:
+                colored_output(f"[{get_beijing_time()}] No pages for {pdf_path}, not written.", "yellow", self.log_file_path)
+                self.failed += 1
+                return False
+            if doc.page_count <= existing_pages and missing:
+                # Re-run over a directory whose earlier pages have no result files (result_sink None)
+                colored_output(
+                    f"[{get_beijing_time()}] Kept {pdf_path} ({existing_pages} pages) over a rebuild with {doc.page_count} pages.",
+                    "yellow", self.log_file_path
+                )
+                kept = True
+            else:
+                os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+                temp_path = pdf_path + ".tmp"
+                doc.save(temp_path, garbage=4, deflate=True)
+                os.replace(temp_path, pdf_path)
+        except Exception as e:
+            colored_output(f"[{get_beijing_time()}] Error saving PDF {pdf_path}: {e}", "red", self.log_file_path)
+            self.failed += 1
+            return False
+        finally:
+            doc.close()
+            for chunk in chunks.values():
+                chunk.close()
+            for chunk_path in {chunk_path for chunk_path, _ in directory["spilled"].values()}:
+                try:
+                    os.remove(chunk_path)
+                except OSError:
+                    pass
+
+        for file, size, mtime_ns, success in directory["finished"]:
+            if success:
+                self.manifest.mark_complete(manifest_key(self.image_root, join_source_path(relative_dir, file)), size, mtime_ns)
+        if kept:
+            return True
+        self.saved += 1
+        if missing:
+            colored_output(
+                f"[{get_beijing_time()}] PDF created: {pdf_path} without {len(missing)} pages: {', '.join(missing[:10])}",
+                "yellow", self.log_file_path
+            )
+        else:
+            colored_output(f"[{get_beijing_time()}] PDF created: {pdf_path} in {time.time() - assemble_start:.2f} seconds", "green", self.log_file_path)
+        return True
+
+    def close(self):
+        """Waits for pending markers and assemblies; directories still waiting for images are left unmarked."""
+        self.executor.shutdown(wait=True)
+        for relative_dir, directory in self.directories.items():
+            colored_output(
+                f"[{get_beijing_time()}] No completion marker for {relative_dir}: {len(directory['waiting'])} images never finished.",
+                "yellow", self.log_file_path
+            )
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+# --- Deduplication Cache ---
+
+DHASH_SIZE = 16  # Perceptual key: (DHASH_SIZE+1) x DHASH_SIZE grayscale thumbnail -> 256-bit difference hash
+DHASH_BANDS = 16  # Hash split into 16-bit bands for candidate lookup; any distance < 16 shares a band
+DHASH_MAX_DISTANCE = 10  # Differing bits (of 256) still treated as the same page
+DHASH_MAX_ASPECT_DIFF = 0.01  # Relative aspect ratio difference still treated as the same page
+
+def content_key(data, image, mode):
+    """Cache key of an image: blake2b of the file bytes, or a difference hash of the pixels."""
+    if mode == "perceptual":
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        thumbnail = cv2.resize(gray, (DHASH_SIZE + 1, DHASH_SIZE), interpolation=cv2.INTER_AREA)
+        bits = np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1])
+        return "p" + bits.tobytes().hex()
+    return "b" + hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def dhash_bands(key):
+    """Splits a perceptual key into (band index, hex value) pairs, skipping blank bands."""
+    digits = key[1:]
+    width = len(digits) // DHASH_BANDS
+    bands = ((band, digits[band * width:(band + 1) * width]) for band in range(DHASH_BANDS))
+    return [(band, value) for band, value in bands if value.strip("0")]  # All-zero bands come from empty margins
+
+class ResultCache:
+    """Content-addressed store of compact OCR results, shared by all workers.
+
+    One SQLite database (WAL, so workers read while another writes) maps a
+    content key to the zlib-compressed compact record and the size of the
+    image it was predicted on.  Perceptual keys are also indexed by hash
+    band, so a near-identical page (a few bits off, same aspect ratio) is
+    found without scanning.  Inserts are buffered (and found by this
+    worker's lookups at once) and committed every ``commit_interval``
+    seconds and at the end of each task, so other workers see them while
+    the run goes on; when the stored records exceed ``max_bytes`` the least recently used
+    ones are deleted (SQLite reuses the freed pages, so the file stays
+    around the budget).
+    """
+    def __init__(self, db_path, max_bytes, evict_check_every=500, commit_interval=2.0):
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, width INTEGER NOT NULL, height INTEGER NOT NULL, "
+                "record BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, value TEXT NOT NULL, key TEXT NOT NULL)")
+            if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'bands_unique'").fetchone():
+                # Caches written before the unique index hold a band row per put of the same hash
+                self.conn.execute("DELETE FROM bands WHERE rowid NOT IN (SELECT MIN(rowid) FROM bands GROUP BY band, value, key)")
+                self.conn.execute("DROP INDEX IF EXISTS bands_value")  # Covered by bands_unique
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS bands_unique ON bands (band, value, key)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (key)")
+        self.max_bytes = max_bytes
+        self.evict_check_every = evict_check_every
+        self.commit_interval = commit_interval
+        self.pending = {}  # key -> row not committed yet
+        self.touched = []
+        self.inserted = 0
+        self.last_commit = time.time()
+
+    def get(self, key, width, height):
+        """Returns (width, height, record) stored for key (or a near-identical perceptual key), or None."""
+        row = self._lookup(key)
+        if key.startswith("p") and (row is None or abs(row[0] / row[1] - width / height) > DHASH_MAX_ASPECT_DIFF * width / height):
+            key, row = self._find_similar(key, width / height)
+        if row is None:
+            return None
+        self.touched.append((time.time(), key))
+        return row[0], row[1], json.loads(zlib.decompress(row[2]))
+
+    def _lookup(self, key):
+        pending = self.pending.get(key)
+        if pending is not None:
+            return pending[1:4]
+        return self.conn.execute("SELECT width, height, record FROM results WHERE key = ?", (key,)).fetchone()
+
+    def _find_similar(self, key, aspect):
+        value = int(key[1:], 16)
+        candidates = set()
+        for band, band_value in dhash_bands(key):
+            for (candidate,) in self.conn.execute("SELECT key FROM bands WHERE band = ? AND value = ? LIMIT 256", (band, band_value)):
+                candidates.add(candidate)
+        candidates.update(candidate for candidate in self.pending if candidate.startswith("p"))
+        best = (DHASH_MAX_DISTANCE + 1, None)
+        for candidate in candidates:
+            distance = bin(value ^ int(candidate[1:], 16)).count("1")
+            if distance < best[0]:
+                best = (distance, candidate)
+        if best[1] is None:
+            return None, None
+        row = self._lookup(best[1])
+        if row is None or abs(row[0] / row[1] - aspect) > DHASH_MAX_ASPECT_DIFF * aspect:
+            return None, None
+        return best[1], row
+
+    def put(self, key, width, height, record):
+        blob = zlib.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+        self.pending[key] = (key, width, height, blob, len(blob), time.time())
+        if time.time() - self.last_commit >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_commit = time.time()
+        if not self.pending and not self.touched:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", self.pending.values())
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO bands VALUES (?, ?, ?)",
+                [(band, value, key) for key in self.pending if key.startswith("p") for band, value in dhash_bands(key)],
+            )
+            self.conn.executemany("UPDATE results SET last_used = ? WHERE key = ?", self.touched)
+        self.inserted += len(self.pending)
+        self.pending = {}
+        self.touched = []
+        if self.inserted >= self.evict_check_every:
+            self.inserted = 0
+            self.evict()
+
+    def evict(self):
+        """Deletes least recently used records until the total is 10% under the budget."""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - self.max_bytes * 0.9
+        doomed = []
+        for key, size in self.conn.execute("SELECT key, size FROM results ORDER BY last_used"):
+            doomed.append((key,))
+            target -= size
+            if target <= 0:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM results WHERE key = ?", doomed)
+            self.conn.executemany("DELETE FROM bands WHERE key = ?", doomed)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+# --- Dispatch Flow Control ---
+
+IDLE = object()  # Yielded by background_iter when its source has been quiet for idle_timeout
+
+def background_iter(iterable, idle_timeout=None):
+    """Drains an iterable on a daemon thread so its producer is never throttled by the consumer."""
+    items = queue.Queue()
+    done = object()
+
+    def drain():
+        try:
+            for item in iterable:
+                items.put(item)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=drain, name="scan-feeder", daemon=True).start()
+    while True:
+        try:
+            item = items.get(timeout=idle_timeout)
+        except queue.Empty:
+            yield IDLE
+            continue
+        if item is done:
+            return
+        yield item
+
+# --- Watchdog ---
+
+task_ids = itertools.count()  # Unique across every WatchedPool of the run
+
+def run_watched_task(job):
+    """Worker side of WatchedPool: announces the task, then runs it."""
+    task_id, func, task = job
+    if task_events is not None:
+        task_events.put((task_id, os.getpid(), time.time()))
+    return task_id, func(task)
+
+class WatchedPool:
+    """Runs tasks on a Pool with per-task deadlines and crash detection.
+
+    Pool.imap_unordered waits forever for a task whose worker hung or died.
+    Here every task is submitted with apply_async and workers announce the
+    tasks they start on ``events``.  A task running longer than
+    ``base_timeout + item_timeout * images`` gets its worker killed, and a
+    task whose worker disappeared is failed; Pool starts replacement
+    workers on its own.  Tasks no worker takes up for ``base_timeout``
+    after the last activity or worker readiness (announced by init_worker,
+    so a slow model load does not count) are failed as lost.  ``run``
+    yields (task, result, error) with exactly one of result/error set, so
+    no item is ever lost.
+    """
+    def __init__(self, pool, events, item_timeout, base_timeout):
+        self.pool = pool
+        self.events = events
+        self.item_timeout = item_timeout
+        self.base_timeout = base_timeout
+        self.failed_workers = 0  # Workers killed on timeout or found dead
+        self.abandoned = 0  # Tasks given up as lost, which the pool may still run
+
+    def shutdown(self):
+        """Closes the pool; terminates it instead if tasks were abandoned (Pool.join would wait for them forever)."""
+        if self.failed_workers or self.abandoned:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+    def run(self, func, tasks):
+        completions = queue.Queue()
+        submitted = {}  # task_id -> task
+        running = {}  # task_id -> (pid, started)
+        dead_since = {}  # task_id -> when its worker was first found gone
+
+        def feed():
+            try:
+                for task in tasks:
+                    task_id = next(task_ids)
+                    submitted[task_id] = task
+                    self.pool.apply_async(
+                        run_watched_task, ((task_id, func, task),),
+                        callback=lambda result: completions.put(("done",) + result),
+                        error_callback=lambda error, task_id=task_id: completions.put(("error", task_id, error)),
+                    )
+            except Exception as e:
+                completions.put(("feed_error", None, e))
+            completions.put(("fed", None, None))
+
+        threading.Thread(target=feed, name="task-feeder", daemon=True).start()
+        fed = False
+        last_activity = time.time()
+        worker_ready = False
+        while not fed or submitted:
+            try:
+                kind, task_id, payload = completions.get(timeout=1.0)
+            except queue.Empty:
+                kind = None
+            while True:
+                try:
+                    started_id, pid, started = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                if started_id is None:  # A worker finished loading its model
+                    worker_ready = True
+                    last_activity = max(last_activity, started)
+                elif started_id in submitted:
+                    running[started_id] = (pid, started)
+                    last_activity = time.time()
+            if kind == "fed":
+                fed = True
+            elif kind == "feed_error":
+                raise payload
+            elif kind is not None and task_id in submitted:  # Late results of abandoned tasks are dropped
+                last_activity = time.time()
+                running.pop(task_id, None)
+                dead_since.pop(task_id, None)
+                task = submitted.pop(task_id)
+                yield (task, payload, None) if kind == "done" else (task, None, payload)
+
+            now = time.time()
+            for task_id, (pid, started) in list(running.items()):
+                task = submitted[task_id]
+                deadline = started + self.base_timeout + self.item_timeout * (len(task) if isinstance(task, list) else 1)
+                if now > deadline:
+                    error = TimeoutError(f"worker {pid} exceeded {deadline - started:.0f}s")
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                elif not pid_alive(pid):
+                    # The result of a worker that exited right after its last task may still be in transit
+                    first_seen = dead_since.setdefault(task_id, now)
+                    if now - first_seen < 5.0:
+                        continue
+                    error = RuntimeError(f"worker {pid} died")
+                else:
+                    continue
+                self.failed_workers += 1
+                dead_since.pop(task_id, None)
+                del running[task_id]
+                del submitted[task_id]
+                last_activity = now
+                yield task, None, error
+            if submitted and not running and worker_ready and now - last_activity > self.base_timeout:
+                # Taken off the pool queue by a worker that died before announcing it
+                for task_id in list(submitted):
+                    self.abandoned += 1
+                    yield submitted.pop(task_id), None, RuntimeError("task lost by the pool")
+                last_activity = now
+
+# --- Resolution Buckets ---
+
+def read_image_size(image_path):
+    """Returns (width, height) from the image header without decoding, or None."""
+    if is_virtual(image_path):
+        return None  # Would read the whole member; pages of one container are usually alike anyway
+    try:
+        with Image.open(image_path) as img:
+            return img.size
+    except Exception:
+        return None
+
+def resolution_bucket(size, ratio=1.5):
+    """Bucket key: orientation plus the pixel count on a geometric scale."""
+    if size is None:
+        return None
+    width, height = size
+    pixels = max(1, width * height)
+    return (width >= height, int(math.log(pixels, ratio)))
+
+class ResolutionBucketer:
+    """Groups work items into tasks of similarly sized images.
+
+    Header sizes are read on a small thread pool a bounded distance ahead of
+    the stream.  A bucket is dispatched when it holds ``images_per_task``
+    items, when its oldest item has waited ``max_wait`` seconds, or when
+    more than ``max_pending`` items are held back in total (the fullest
+    bucket goes first).  Once the stream has been quiet for ``idle_wait``
+    seconds (half of ``max_wait`` by default) every partial bucket goes out.
+    """
+    def __init__(self, images_per_task, max_wait=5.0, max_pending=4096, header_threads=8, lookahead=256, idle_wait=None):
+        self.images_per_task = images_per_task
+        self.max_wait = max_wait
+        self.idle_wait = max_wait / 2 if idle_wait is None else idle_wait
+        self.max_pending = max_pending
+        self.header_threads = header_threads
+        self.lookahead = lookahead
+        self.buckets = {}  # key -> (first_added_time, [relative paths])
+        self.pending = 0
+        self.flushes = {"full": 0, "aged": 0, "idle": 0, "overflow": 0, "final": 0}
+
+    def _add(self, relative_path, size):
+        key = resolution_bucket(size)
+        started, items = self.buckets.setdefault(key, (time.time(), []))
+        items.append(relative_path)
+        self.pending += 1
+        if len(items) >= self.images_per_task:
+            yield self._pop(key, "full")
+        elif self.pending > self.max_pending:
+            yield self._pop(max(self.buckets, key=lambda k: len(self.buckets[k][1])), "overflow")
+
+    def _pop(self, key, reason):
+        _, items = self.buckets.pop(key)
+        self.pending -= len(items)
+        self.flushes[reason] += 1
+        return items
+
+    def _flush_aged(self):
+        now = time.time()
+        for key in [k for k, (started, _) in self.buckets.items() if now - started >= self.max_wait]:
+            yield self._pop(key, "aged")
+
+    def tasks(self, work_items):
+        """Turns a stream of relative paths into a stream of bucketed tasks."""
+        with ThreadPoolExecutor(max_workers=self.header_threads, thread_name_prefix="header") as executor:
+            headers = deque()
+            for item in background_iter(work_items, idle_timeout=self.idle_wait):
+                if item is not IDLE:
+                    headers.append((item, executor.submit(read_image_size, os.path.join(image_root_dir, item))))
+                # Headers complete in order; block only when the lookahead is full or the stream is idle
+                while headers and (headers[0][1].done() or len(headers) >= self.lookahead or item is IDLE):
+                    relative_path, future = headers.popleft()
+                    yield from self._add(relative_path, future.result())
+                if item is IDLE:
+                    # Nothing else is coming for now: waiting for more of a size would only delay these
+                    for key in list(self.buckets):
+                        yield self._pop(key, "idle")
+                yield from self._flush_aged()
+            while headers:
+                relative_path, future = headers.popleft()
+                yield from self._add(relative_path, future.result())
+        for key in list(self.buckets):
+            yield self._pop(key, "final")
+
+class InflightGate:
+    """Caps the number of tasks handed to the pool but not yet returned.
+
+    At full limit the ``workers`` running tasks are followed by a queue that
+    keeps them fed.  ``back_off`` always takes away a running task (the
+    queue goes on the first step) and ``recover`` brings the queue back once
+    every worker runs again.
+    """
+    def __init__(self, limit, minimum=1, workers=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, limit)
+        self.limit = self.maximum
+        self.workers = min(workers or self.maximum, self.maximum)
+        self.inflight = 0
+        self.condition = threading.Condition()
+
+    def wrap(self, tasks):
+        for task in tasks:
+            with self.condition:
+                while self.inflight >= self.limit:
+                    self.condition.wait()
+                self.inflight += 1
+            yield task
+
+    def release(self):
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = min(self.maximum, max(self.minimum, limit))
+            self.condition.notify_all()
+        return self.limit
+
+    def back_off(self):
+        return self.set_limit(min(self.limit, self.workers) - 1)
+
+    def recover(self):
+        limit = self.limit + 1
+        return self.set_limit(self.maximum if limit >= self.workers else limit)
+
+# --- Autotuning ---
+
+def read_mem_available_mb():
+    """MemAvailable from /proc/meminfo in MB, or None off Linux."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def read_cpu_ticks():
+    """Returns (iowait, total) jiffies from /proc/stat, or None off Linux."""
+    try:
+        with open("/proc/stat") as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+        return values[4], sum(values)
+    except (OSError, IndexError, ValueError):
+        return None
+
+def children_rss_mb():
+    """Sum of the resident set sizes of this process's children, in MB."""
+    total = 0
+    for child in multiprocessing.active_children():
+        try:
+            with open(f"/proc/{child.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return total / 1024
+
+def process_batch_with_options(batch, overrides):
+    """Runs process_batch with temporary worker option overrides (used by calibration, bound with functools.partial)."""
+    saved = {key: worker_options[key] for key in overrides}
+    worker_options.update(overrides)
+    try:
+        return process_batch(batch)
+    finally:
+        worker_options.update(saved)
+
+def calibrate(start_pool, run_tasks, worker_options, work_items, collect_batches, process_candidates, batch_candidates,
+              images_per_task, sample_images, min_free_mb, log_file_path):
+    """Measures candidate (processes, predict batch size) pairs on real input.
+
+    Every candidate processes ``sample_images`` images taken from the run's
+    own work queue, so nothing is thrown away.  ``run_tasks(pool, func,
+    tasks)`` runs them under the run's watchdog, so a hung or dead worker
+    fails its task instead of stalling calibration.  Returns (best settings
+    or None, images processed, errors).
+    """
+    measurements = []
+    processed = 0
+    errors = 0
+    for processes in process_candidates:
+        with start_pool(processes, worker_options) as pool:
+            # Warm-up: the first task of every worker pays for model initialisation
+            warmup = list(itertools.islice(work_items, processes))
+            for success in collect_batches(run_tasks(pool, process_batch, [[item] for item in warmup])):
+                processed += 1
+                errors += 0 if success else 1
+            for predict_batch_size in batch_candidates:
+                sample = list(itertools.islice(work_items, sample_images))
+                if not sample:
+                    break
+                func = functools.partial(process_batch_with_options, overrides={"predict_batch_size": predict_batch_size})
+                tasks = list(batched(sample, images_per_task))
+                ticks_before = read_cpu_ticks()
+                peak_rss = 0.0
+                min_free = read_mem_available_mb()
+                last_sample = 0.0
+                measure_start = time.time()
+                for success in collect_batches(run_tasks(pool, func, tasks)):
+                    processed += 1
+                    errors += 0 if success else 1
+                    if time.time() - last_sample >= 0.5:
+                        last_sample = time.time()
+                        peak_rss = max(peak_rss, children_rss_mb())
+                        free = read_mem_available_mb()
+                        if free is not None:
+                            min_free = free if min_free is None else min(min_free, free)
+                elapsed = time.time() - measure_start
+                ticks_after = read_cpu_ticks()
+                iowait = None
+                if ticks_before and ticks_after and ticks_after[1] > ticks_before[1]:
+                    iowait = (ticks_after[0] - ticks_before[0]) / (ticks_after[1] - ticks_before[1])
+                measurement = {
+                    "num_processes": processes,
+                    "predict_batch_size": predict_batch_size,
+                    "images_per_sec": len(sample) / elapsed if elapsed > 0 else 0.0,
+                    "peak_rss_mb": round(peak_rss, 1),
+                    "min_free_mb": round(min_free, 1) if min_free is not None else None,
+                    "iowait": round(iowait, 4) if iowait is not None else None,
+                }
+                measurement["safe"] = min_free is None or min_free >= min_free_mb
+                measurements.append(measurement)
+                colored_output(
+                    f"[{get_beijing_time()}] Autotune: {processes} processes x batch {predict_batch_size}: "
+                    f"{measurement['images_per_sec']:.2f} images/s, RSS {peak_rss:.0f} MB, "
+                    f"I/O wait {(iowait or 0):.1%}{'' if measurement['safe'] else ', memory pressure'}",
+                    "blue", log_file_path
+                )
+
+    candidates = [m for m in measurements if m["safe"]] or measurements
+    if not candidates:
+        return None, processed, errors
+    best_rate = max(m["images_per_sec"] for m in candidates)
+    # Within 3% of the best, prefer fewer processes (less memory, less contention)
+    best = min((m for m in candidates if m["images_per_sec"] >= best_rate * 0.97),
+               key=lambda m: (m["num_processes"], -m["images_per_sec"]))
+    settings = {key: best[key] for key in ("num_processes", "predict_batch_size", "images_per_sec")}
+    settings["host"] = socket.gethostname()
+    settings["calibrated_at"] = get_beijing_time()
+    settings["measurements"] = measurements
+    return settings, processed, errors
+
+def load_autotune_settings(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_json_atomic(path, settings):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(settings, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def build_downscale_report(stats):
+    """Summarizes the downscaling stats gathered by the workers."""
+    samples = stats.get("downscale_samples", 0)
+    report = {"downscaled_images": stats.get("downscaled_images", 0), "samples": samples}
+    if samples:
+        time_full = stats["downscale_sample_time_full"] / samples
+        time_scaled = stats["downscale_sample_time_scaled"] / samples
+        report.update({
+            "mean_predict_time_full": time_full,
+            "mean_predict_time_scaled": time_scaled,
+            "estimated_time_saved": report["downscaled_images"] * (time_full - time_scaled),
+            "mean_text_similarity": stats["downscale_sample_similarity"] / samples,
+            "boxes_full": stats["downscale_sample_boxes_full"],
+            "boxes_scaled": stats["downscale_sample_boxes_scaled"],
+        })
+    return report
+
+class ThroughputMonitor:
+    """Watches throughput and free memory during the run and adjusts the in-flight cap.
+
+    Two consecutive bad windows (throughput well below the calibrated rate,
+    or MemAvailable under the floor) take one running task away; three good
+    windows give it back.
+    """
+    def __init__(self, gate, expected_rate, min_free_mb, log_file_path, interval=30.0, tolerance=0.3):
+        self.gate = gate
+        self.expected_rate = expected_rate
+        self.min_free_mb = min_free_mb
+        self.log_file_path = log_file_path
+        self.interval = interval
+        self.tolerance = tolerance
+        self.window_start = time.time()
+        self.window_count = 0
+        self.bad_windows = 0
+        self.good_windows = 0
+
+    def update(self, processed_count, judge):
+        now = time.time()
+        if now - self.window_start < self.interval:
+            return
+        rate = (processed_count - self.window_count) / (now - self.window_start)
+        self.window_start = now
+        self.window_count = processed_count
+        free = read_mem_available_mb()
+        low_memory = free is not None and free < self.min_free_mb
+        slow = judge and rate < self.expected_rate * (1 - self.tolerance)
+        if low_memory or slow:
+            self.bad_windows += 1
+            self.good_windows = 0
+            if self.bad_windows >= 2:
+                self.bad_windows = 0
+                limit = self.gate.back_off()
+                reason = f"MemAvailable {free:.0f} MB" if low_memory else f"{rate:.2f} images/s vs {self.expected_rate:.2f} calibrated"
+                colored_output(f"[{get_beijing_time()}] Autotune: backing off to {limit} in-flight tasks ({reason}).", "yellow", self.log_file_path)
+        else:
+            self.bad_windows = 0
+            self.good_windows += 1
+            if self.good_windows >= 3 and self.gate.limit < self.gate.maximum:
+                self.good_windows = 0
+                limit = self.gate.recover()
+                colored_output(f"[{get_beijing_time()}] Autotune: recovered to {limit} in-flight tasks.", "blue", self.log_file_path)
+
+# --- Run Metrics ---
+
+LATENCY_BUCKETS = tuple(0.0005 * 1.5 ** i for i in range(36))  # Histogram upper bounds, 0.5 ms .. ~18 min
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram; quantiles are bucket upper bounds."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Last bucket: above the largest bound
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                return min(LATENCY_BUCKETS[index], self.max) if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class RunMetrics:
+    """Aggregates worker stage timings and throughput, and writes them out periodically.
+
+    Workers send raw per-stage durations with every task (``stats["metrics"]``);
+    they are folded into one LatencyHistogram per stage here.  The parent
+    adds ``queue_wait`` (task dispatched until a worker started it) and
+    ``result_wait`` (worker finished until the result was collected).
+    ``path`` is rewritten atomically every ``interval`` seconds as JSON or,
+    with ``output_format="prometheus"``, as a node-exporter textfile.
+    """
+    def __init__(self, path, output_format="json", interval=15.0):
+        self.path = path
+        self.output_format = output_format
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_write = 0.0
+        self.stages = {}
+        self.workers = {}  # pid -> {"images", "errors", "tasks", "busy_seconds"}
+        self.directories = {}  # relative directory -> {"images", "errors"}
+        self.dispatch_times = {}  # First relative path of a task -> dispatch time
+        self.first_worker_ready = None
+
+    def stamp_dispatch(self, tasks):
+        """Passes tasks through, remembering when each was handed to the pool."""
+        for task in tasks:
+            self.dispatch_times[task[0] if isinstance(task, list) else task] = time.time()
+            yield task
+
+    def observe(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = LatencyHistogram()
+        histogram.add(seconds)
+
+    def observe_task(self, metrics, batch_results):
+        now = time.time()
+        for stage, durations in metrics["stages"].items():
+            for seconds in durations:
+                self.observe(stage, seconds)
+        self.observe("task", metrics["task_time"])
+        startup = metrics.get("startup")
+        if startup is not None:
+            for phase in ("import", "pipeline", "warmup"):
+                self.observe(f"startup_{phase}", startup[phase])
+            if self.first_worker_ready is None or startup["ready_at"] < self.first_worker_ready:
+                self.first_worker_ready = startup["ready_at"]
+        dispatched = self.dispatch_times.pop(batch_results[0][0], None) if batch_results else None
+        if dispatched is not None:
+            self.observe("queue_wait", max(0.0, metrics["started"] - dispatched))
+        self.observe("result_wait", max(0.0, now - metrics["started"] - metrics["task_time"]))
+
+        worker = self.workers.setdefault(metrics["pid"], {"images": 0, "errors": 0, "tasks": 0, "busy_seconds": 0.0})
+        worker["tasks"] += 1
+        worker["busy_seconds"] += metrics["task_time"]
+        for relative_path, success in batch_results:
+            directory = self.directories.setdefault(os.path.dirname(relative_path), {"images": 0, "errors": 0})
+            for counts in (worker, directory):
+                counts["images"] += 1
+                counts["errors"] += 0 if success else 1
+
+    def snapshot(self):
+        elapsed = max(1e-9, time.time() - self.start_time)
+        images = sum(worker["images"] for worker in self.workers.values())
+        return {
+            "updated": get_beijing_time(),
+            "elapsed_seconds": elapsed,
+            "images": images,
+            "images_per_sec": images / elapsed,
+            "stages": {stage: histogram.summary() for stage, histogram in sorted(self.stages.items())},
+            "workers": {
+                str(pid): {**worker, "images_per_busy_sec": worker["images"] / worker["busy_seconds"] if worker["busy_seconds"] else None}
+                for pid, worker in self.workers.items()
+            },
+            "directories": {
+                directory: {**counts, "images_per_sec": counts["images"] / elapsed}
+                for directory, counts in self.directories.items()
+            },
+        }
+
+    def prometheus_text(self):
+        lines = ["# HELP highocr_stage_seconds Per-stage latency of the OCR run.", "# TYPE highocr_stage_seconds histogram"]
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'highocr_stage_seconds_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'highocr_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'highocr_stage_seconds_sum{{stage="{stage}"}} {histogram.total:.6f}')
+            lines.append(f'highocr_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, help_text, key in (("images", "Images processed", "images"), ("errors", "Images failed", "errors")):
+            lines.append(f"# HELP highocr_worker_{name}_total {help_text} per worker process.")
+            lines.append(f"# TYPE highocr_worker_{name}_total counter")
+            for pid, worker in sorted(self.workers.items()):
+                lines.append(f'highocr_worker_{name}_total{{pid="{pid}"}} {worker[key]}')
+            lines.append(f"# HELP highocr_directory_{name}_total {help_text} per directory.")
+            lines.append(f"# TYPE highocr_directory_{name}_total counter")
+            for directory, counts in sorted(self.directories.items()):
+                lines.append(f'highocr_directory_{name}_total{{directory="{prometheus_label(directory)}"}} {counts[key]}')
+        lines.append("# HELP highocr_worker_busy_seconds_total Seconds each worker spent on tasks.")
+        lines.append("# TYPE highocr_worker_busy_seconds_total counter")
+        for pid, worker in sorted(self.workers.items()):
+            lines.append(f'highocr_worker_busy_seconds_total{{pid="{pid}"}} {worker["busy_seconds"]:.3f}')
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        self.last_write = time.time()
+        if self.output_format == "prometheus":
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, self.path)
+        else:
+            save_json_atomic(self.path, self.snapshot())
+
+    def maybe_write(self):
+        if time.time() - self.last_write >= self.interval:
+            self.write()
 
 # --- Main Function ---
 
-def main():
+def main(image_root=None, output_root=None, log_dir=None, overrides=None):
+    """Runs the OCR over image_root_dir and returns a summary of the run.
+
+    The arguments replace the hardcoded directories and a few settings
+    (``overrides``: num_processes, batch_mode, images_per_task,
+    pdf_output_root, completion_markers, retry_failed and worker_options
+    entries) for callers such as benchmark_highocr.py.
+    ``overrides["work_source"]`` replaces the local scan and manifest with
+    an external queue of work items (ocr_cluster.py worker nodes,
+    ocr_watch.py); the caller owns and closes it.  A work source may
+    trickle items for as long as it likes: partial tasks are dispatched
+    once it has been quiet for source_idle_wait.
+    """
+    # The run hands temp locations and thread counts to the forkserver (and so to every worker) through the
+    # environment; callers that go on after main (benchmarks, cluster nodes, tests) get theirs back
+    saved_env = {name: os.environ.get(name) for name in TEMP_ENV_VARS + THREAD_ENV_VARS}
+    try:
+        return run_ocr(image_root, output_root, log_dir, overrides)
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def run_ocr(image_root, output_root, log_dir, overrides):
+    """The run behind main(), which restores the environment variables it sets."""
     global image_root_dir
+    global output_root_dir
     global error_dir
     global log_file_path
 
-    image_root_dir = "/media/tmzn/DATA5/music_picture/"
-    output_root_dir = "/media/tmzn/DATA5/ocr_paddle/output_music_picture_ocr_results"
-    log_and_error_dir = "/media/tmzn/DATA5/ocr_paddle/ocr_logs_and_errors"
+    image_root_dir = image_root or "/media/tmzn/DATA5/music_picture/"
+    output_root_dir = output_root or "/media/tmzn/DATA5/ocr_paddle/output_music_picture_ocr_results"
+    log_and_error_dir = log_dir or "/media/tmzn/DATA5/ocr_paddle/ocr_logs_and_errors"
     error_dir = os.path.join(log_and_error_dir, "error_images")
     log_file_path = os.path.join(log_and_error_dir, "ocr_log.txt")
+    manifest_path = os.path.join(log_and_error_dir, "ocr_manifest.sqlite")
 
     os.makedirs(output_root_dir, exist_ok=True)
     os.makedirs(error_dir, exist_ok=True)
     os.makedirs(log_and_error_dir, exist_ok=True)
 
+    # Workers fork from a server that has imported this module once (and paddle/paddlex in all-CPU runs, below)
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    mp_context = get_context(start_method)
+    log_format = "text"  # "json": one JSON object per line in the log file, for machine parsing
+    progress_interval = 2.0  # Seconds between progress lines
+    # Per-stage latency histograms and per-worker/per-directory throughput, rewritten every
+    # metrics_interval seconds; "prometheus" writes a node-exporter textfile instead of JSON
+    metrics_format = "json"
+    metrics_path = os.path.join(log_and_error_dir, "ocr_metrics.prom" if metrics_format == "prometheus" else "ocr_metrics.json")
+    metrics_interval = 15.0
+    # Every process logs through one queue; a thread in this process does the batched writing
+    log_listener = LogListener(mp_context.Queue(), log_format).start()
+
     start_time = time.time()
     start_time_str = get_beijing_time()
     colored_output(f"[{start_time_str}] OCR process started.", "green", log_file_path)
 
+    # Workers per device, e.g. "gpu:0=3,gpu:1=3" or "cpu=4x8" (4 workers x 8 threads).
+    # None keeps the single-config setup below (num_processes + use_cpu).
+    device_map = None
     num_processes = max(1, cpu_count() - 16)
     batch_size = 64
     use_cpu = False
+    # With use_cpu every worker gets cpu_threads cores of its own (NUMA node by node) and runs that many
+    # Paddle threads, instead of each runtime starting a thread per core; None splits the cores evenly
+    cpu_threads = None
+    batch_mode = True  # Send groups of images to each worker and predict them in batches
+    images_per_task = 64  # Images sent to a worker at once
+    worker_options = {
+        "predict_batch_size": 16,  # Images per predict call
+        "prefetch_depth": 32,  # Images read/decoded ahead while predict runs
+        "prefetch_threads": 4,  # Reader/decoder threads per worker, 0 disables prefetch
+        "prefetch_max_mb": 1024,  # Large posters are read ahead and grouped by decoded size, not just by count
+        "result_sink": "json",  # "shard": append dt_polys/rec_text/rec_score to per-directory shards
+        "scratch_budget_mb": 512,  # Per-worker temp file budget, oldest files evicted beyond it
+        "scratch_check_interval": 5.0,  # Seconds between budget checks
+        "max_long_edge": None,  # e.g. 4000: shrink larger scans before predict, boxes are mapped back
+        "max_pixels": None,  # e.g. 16_000_000: same, by pixel count
+        "downscale_sample_every": 200,  # Accuracy/time sample: every Nth downscaled image also runs at full size
+        "tile_above_pixels": None,  # e.g. 40_000_000: posters/panoramas are predicted as overlapping tiles and merged
+        "tile_size": 2048,
+        "tile_overlap": 256,  # More than the tallest text line, so every line is whole in some tile
+        "tile_batch": 4,  # Tiles per predict call: peak worker memory follows tile_size x tile_batch, not the image
+        "dedup": None,  # "exact": duplicate files reuse the cached result; "perceptual": also near-identical copies
+        "dedup_cache_mb": 1024,  # Disk bound of the dedup cache (ocr_dedup_cache.sqlite in the log directory)
+        "blank_filter": False,  # Blank pages/separator sheets get an empty result (marked "blank_page") without predict
+        "blank_max_edge_density": 0.0005,  # Raise to also skip near-empty pages (page numbers, stamps)
+        "blank_max_std": 3.0,
+    }
+    # Workers keep pipeline temp files in their own budgeted directory under here (tmpfs by default)
+    scratch_root = "/dev/shm/paddle_ocr_scratch" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "paddle_ocr_scratch")
+    scratch_dir = os.path.join(scratch_root, f"run_{os.getpid()}")
+    # In all-CPU runs the forkserver imports paddle/paddlex before any worker can activate its scratch space, so
+    # temp locations read at import must already point here. The parent resolves its own temp dir
+    # first: multiprocessing keeps the forkserver socket there, and scratch_dir is removed at the end
+    tempfile.gettempdir()
+    os.makedirs(scratch_dir, exist_ok=True)
+    os.environ.update(dict.fromkeys(TEMP_ENV_VARS, scratch_dir))
+    scan_threads = 8  # Directories listed in parallel while dispatching
+    bucket_by_resolution = True  # Group tasks by image size (read from headers) to avoid padding waste
+    bucket_max_wait = 5.0  # Seconds a partial bucket may wait before it is dispatched anyway
+    source_idle_wait = 0.2  # Work source runs: seconds of quiet after which partial tasks are dispatched
+    # Watchdog: a task running longer than base + per-image timeout gets its worker killed (and
+    # replaced); workers are also recycled after max_tasks_per_worker tasks to cap memory growth
+    task_base_timeout = 300.0
+    task_item_timeout = 120.0
+    max_tasks_per_worker = 200
+    # Images failing the first pass (errors, timeouts, crashed workers) are retried one per task on a
+    # fresh pool with safer settings; only images failing there too are copied to error_images
+    retry_failed = True
+    retry_use_cpu = False
+    retry_processes = None  # None: half of num_processes
+    retry_options = {"predict_batch_size": 1, "prefetch_depth": 2}
+    # Autotune: calibrate processes x predict batch size on a sample of the real input, save the
+    # winner per host and back off during the run if throughput or free memory degrades
+    autotune = False
+    autotune_recalibrate = False  # Ignore saved settings for this host
+    autotune_batch_sizes = [8, 16, 32]
+    autotune_sample_images = 256  # Images per candidate measurement
+    autotune_min_free_mb = 2048  # Candidates/runs dipping below this MemAvailable count as overloaded
+    autotune_path = os.path.join(log_and_error_dir, f"autotune_{socket.gethostname()}.json")
+    # Fused OCR-to-PDF: workers render each page with its text layer and <directory>_searchable.pdf is
+    # saved under pdf_output_root once the directory is done, instead of pdf_creator_with_text_layer6.py
+    # reading every result and image back later. worker_options["result_sink"] = None then skips the JSON.
+    pdf_output_root = None  # e.g. "/media/tmzn/DATA5/ocr_paddle/output_pdfs_text_layer4"
+    # Each output directory gets a completion marker once all of its images have results, and the output
+    # root a run marker at the end, so pdf_creator_with_text_layer6.py --follow can build PDFs during the run
+    completion_markers = True
+
+    overrides = overrides or {}
+    num_processes = overrides.get("num_processes", num_processes)
+    batch_mode = overrides.get("batch_mode", batch_mode)
+    images_per_task = overrides.get("images_per_task", images_per_task)
+    pdf_output_root = overrides.get("pdf_output_root", pdf_output_root)
+    completion_markers = overrides.get("completion_markers", completion_markers)
+    retry_failed = overrides.get("retry_failed", retry_failed)
+    max_tasks_per_worker = overrides.get("max_tasks_per_worker", max_tasks_per_worker)
+    device_map = overrides.get("device_map", device_map)
+    cpu_threads = overrides.get("cpu_threads", cpu_threads)
+    worker_options.update(overrides.get("worker_options", {}))
+    work_source = overrides.get("work_source")  # e.g. ocr_cluster.LeaseWorkSource on a worker node
+    if pdf_output_root and work_source is not None:
+        colored_output(f"[{get_beijing_time()}] Fused PDF mode needs the local scan; run pdf_creator_with_text_layer6.py afterwards.", "yellow", log_file_path)
+        pdf_output_root = None
+    worker_options["pdf_pages"] = bool(pdf_output_root)
 
     if use_cpu:
         config_to_use = modify_config_for_cpu(config_path)
     else:
         config_to_use = config_path
 
-    def image_path_generator(image_root_dir, output_root_dir, error_dir, log_file_path):
-        skipped_count = 0
-        for root, _, files in os.walk(image_root_dir):
-            for file in files:
-                if file.lower().endswith((".jpg", ".jpeg", ".png", ".bmp")):
-                    image_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(root, image_root_dir)
-                    output_dir = os.path.join(output_root_dir, relative_path)
-                    os.makedirs(output_dir, exist_ok=True)
-                    base_name = os.path.splitext(os.path.basename(image_path))[0]
-                    result_file = os.path.join(output_dir, f"{base_name}_result.json")
-                    if os.path.exists(result_file):
-                        skipped_count += 1
-                        continue
-                    yield (image_path, output_dir, error_dir, log_file_path)
-        if skipped_count > 0:
-            colored_output(f"[{get_beijing_time()}] Skipped {skipped_count} existing files.", "yellow", log_file_path)
+    if use_cpu and not device_map:
+        device_map = [{"device": "cpu", "workers": num_processes, "threads": cpu_threads}]
+
+    worker_slots = None
+    slot_pids = None
+    if device_map:
+        worker_slots = build_worker_slots(config_path, device_map)
+        num_processes = len(worker_slots)
+        slot_pids = mp_context.Array("i", num_processes)
+        for entry in parse_device_map(device_map):
+            threads_str = f" x {entry['threads']} threads" if entry["threads"] else ""
+            colored_output(f"[{get_beijing_time()}] Device {entry['device']}: {entry['workers']} workers{threads_str}", "blue", log_file_path)
+        cpu_slots = [slot for slot in worker_slots if slot["device"].startswith("cpu")]
+        if cpu_slots:
+            pinned = [slot for slot in cpu_slots if slot["cpus"]]
+            nodes = sorted({slot["numa_node"] for slot in pinned if slot["numa_node"] is not None})
+            colored_output(
+                f"[{get_beijing_time()}] CPU workers: {len(cpu_slots)} x {cpu_slots[0]['threads']} threads, "
+                f"{len(pinned)} pinned to their own cores on NUMA nodes {nodes}",
+                "blue", log_file_path
+            )
+            if len(pinned) < len(cpu_slots):
+                colored_output(
+                    f"[{get_beijing_time()}] {len(cpu_slots) - len(pinned)} CPU workers unpinned: workers x threads exceeds the "
+                    f"{len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else cpu_count()} available cores.",
+                    "yellow", log_file_path
+                )
+            thread_counts = {slot["threads"] for slot in cpu_slots}
+            if len(thread_counts) == 1:
+                # In all-CPU runs the forkserver imports paddle before any worker exists; OpenMP reads these when it loads
+                for var in THREAD_ENV_VARS:
+                    os.environ[var] = str(cpu_slots[0]["threads"])
+
+    if start_method == "forkserver":
+        # Importing paddle initialises the CUDA driver (device count, CUPTI), and CUDA fails in a child forked
+        # after that: only all-CPU runs preload paddle/paddlex, GPU workers import them in init_worker
+        cpu_only = bool(worker_slots) and all(slot["device"].startswith("cpu") for slot in worker_slots)
+        mp_context.set_forkserver_preload(["__main__", *HEAVY_MODULES] if cpu_only else ["__main__"])
+
+    manifest = CompletionManifest(manifest_path)
+    directory_tracker = None
+    if work_source is None and (completion_markers or pdf_output_root):
+        directory_tracker = DirectoryTracker(image_root_dir, output_root_dir, manifest, worker_options["result_sink"], log_file_path,
+                                             pdf_output_root, worker_options.get("pdf_y_offset", 30))
+        remove_marker(os.path.join(output_root_dir, RUN_MARKER))
+    if pdf_output_root:
+        colored_output(f"[{get_beijing_time()}] Searchable PDFs go to {pdf_output_root} as directories finish.", "blue", log_file_path)
+    pending_files = {}  # relative path -> (size, mtime_ns) until its result lands
+    scan_progress = {"found": 0, "done": False}
+
+    run_paths = {
+        "image_root_dir": image_root_dir,
+        "output_root_dir": output_root_dir,
+        "error_dir": error_dir,
+        "log_file_path": log_file_path,
+        "scratch_dir": scratch_dir,
+        "dedup_cache_path": os.path.join(log_and_error_dir, "ocr_dedup_cache.sqlite"),
+    }
+    worker_stats = {"predict_batches": 0, "starved_batches": 0, "prefetch_wait_time": 0.0}
+    metrics = RunMetrics(metrics_path, metrics_format, metrics_interval)
+
+    task_events = mp_context.Queue()  # Task start announcements for the WatchedPool
+
+    def start_pool(processes, options, slots=None, pids=None):
+        """Starts a worker pool on the run's device slots, or on ``slots``/``pids`` (retry pass)."""
+        if slots is None:
+            slots, pids = worker_slots, slot_pids
+        while True:  # Readiness announcements of earlier pools (calibration) would count for this one
+            try:
+                task_events.get_nowait()
+            except queue.Empty:
+                break
+        return mp_context.Pool(
+            processes=processes,
+            initializer=init_worker,
+            initargs=(config_to_use, batch_size, options, run_paths, slots, pids, log_listener.queue, task_events),
+            maxtasksperchild=max_tasks_per_worker,
+        )
+
+    def collect_batches(task_results, on_task=None, retry=None):
+        """Records task results and yields one success flag per image.
+
+        With a ``retry`` list, failed images are appended to it instead of
+        being reported.
+        """
+        for batch_results, stats in task_results:
+            if on_task is not None:
+                on_task()
+            task_metrics = stats.pop("metrics", None)
+            if task_metrics is not None:
+                metrics.observe_task(task_metrics, batch_results)
+            pages = stats.pop("pdf_pages", {})
+            for key, value in stats.items():
+                worker_stats[key] = worker_stats.get(key, 0) + value
+            for relative_path, success in batch_results:
+                if not success and retry is not None:
+                    retry.append(relative_path)
+                    continue
+                size, mtime_ns = pending_files.pop(relative_path)
+                if work_source is not None:
+                    work_source.complete(relative_path, success)
+                elif directory_tracker is not None:
+                    directory_tracker.add_page(relative_path, size, mtime_ns, success, pages.get(relative_path))
+                elif success:
+                    manifest.mark_complete(manifest_key(image_root_dir, relative_path), size, mtime_ns)
+                yield success
+
+    if work_source is None:
+        # The scan runs ahead in its own thread so the total is known early even when dispatch is throttled
+        work_items = background_iter(scan_work_items(
+            image_root_dir, output_root_dir, manifest, pending_files, scan_progress, scan_threads, log_file_path, start_time,
+            directory_tracker
+        ))
+    else:
+        work_items = background_iter(work_source.items(pending_files, scan_progress))
 
-    image_generator = image_path_generator(image_root_dir, output_root_dir, error_dir, log_file_path)
-    image_list = list(image_generator)
-    num_images = len(image_list)
+    def watched_results(watched, func, tasks, final):
+        """Turns WatchedPool failures (timeouts, dead workers) into failed results for every image of the task."""
+        for task, result, error in watched.run(func, tasks):
+            if error is None:
+                yield result
+                continue
+            relative_paths = task if isinstance(task, list) else [task]
+            colored_output(f"[{get_beijing_time()}] Task of {len(relative_paths)} images failed: {error}", "yellow", log_file_path)
+            if final:  # No worker got to copy them
+                for relative_path in relative_paths:
+                    handle_image_error(os.path.join(image_root_dir, relative_path), error, error_dir, log_file_path, copy=True)
+            yield [(relative_path, False) for relative_path in relative_paths], {"worker_failures": 1}
+
+    def run_watched(pool, func, tasks):
+        """Calibration tasks, under the same watchdog as the run."""
+        return watched_results(WatchedPool(pool, task_events, task_item_timeout, task_base_timeout), func, tasks, True)
+
+    processed_count = 0
+    error_count = 0
+    first_result_time = None
+    last_progress_time = 0.0
+    tuned = None
+    if autotune and batch_mode:
+        tuned = load_autotune_settings(autotune_path) if not autotune_recalibrate else None
+        if tuned is not None and worker_slots and tuned["num_processes"] != num_processes:
+            # The pool cannot grow or shrink past the device slots (claim_worker_slot)
+            colored_output(
+                f"[{get_beijing_time()}] Autotune: saved settings in {autotune_path} are for {tuned['num_processes']} processes, "
+                f"the device map has {num_processes} slots; recalibrating.",
+                "yellow", log_file_path
+            )
+            tuned = None
+        if tuned is not None:
+            colored_output(f"[{get_beijing_time()}] Autotune: using saved settings from {autotune_path}", "blue", log_file_path)
+        else:
+            process_candidates = [num_processes] if worker_slots else sorted({max(1, num_processes // 4), max(1, num_processes // 2), num_processes})
+            tuned, processed_count, error_count = calibrate(
+                start_pool, run_watched, worker_options, work_items, collect_batches, process_candidates, autotune_batch_sizes,
+                images_per_task, autotune_sample_images, autotune_min_free_mb, log_file_path,
+            )
+            if tuned is not None:
+                save_json_atomic(autotune_path, tuned)
+        if tuned is not None:
+            num_processes = tuned["num_processes"]
+            worker_options["predict_batch_size"] = tuned["predict_batch_size"]
+            colored_output(
+                f"[{get_beijing_time()}] Autotune: {num_processes} processes, predict batch {tuned['predict_batch_size']} "
+                f"(calibrated at {tuned['images_per_sec']:.2f} images/s)",
+                "green", log_file_path
+            )
 
     colored_output(f"[{get_beijing_time()}] Using {num_processes} processes.", "blue", log_file_path)
     colored_output(f"[{get_beijing_time()}] Batch size: {batch_size}", "blue", log_file_path)
-    colored_output(f"[{get_beijing_time()}] Total images to process: {num_images}", "blue", log_file_path)
+    if batch_mode:
+        colored_output(
+            f"[{get_beijing_time()}] Images per task: {images_per_task}, per predict call: {worker_options['predict_batch_size']}, "
+            f"prefetch depth: {worker_options['prefetch_depth']} ({worker_options['prefetch_threads']} threads)",
+            "blue", log_file_path
+        )
+    colored_output(f"[{get_beijing_time()}] Scanning {image_root_dir} with {scan_threads} threads, dispatching as images are found.", "blue", log_file_path)
+
+    retry_queue = [] if retry_failed else None
+    first_pass_options = {**worker_options, "copy_errors": not retry_failed}
+
+    with start_pool(num_processes, first_pass_options) as pool:
+        watched = WatchedPool(pool, task_events, task_item_timeout, task_base_timeout)
+        # In-flight tasks are capped so the monitor can back off an overloaded machine
+        gate = InflightGate(num_processes * 2, minimum=1, workers=num_processes)
+        monitor = None
+        bucketer = None
+        if tuned is not None:
+            monitor = ThroughputMonitor(gate, tuned["images_per_sec"], autotune_min_free_mb, log_file_path)
+        if batch_mode:
+            if bucket_by_resolution:
+                bucketer = ResolutionBucketer(images_per_task, max_wait=bucket_max_wait,
+                                              idle_wait=source_idle_wait if work_source is not None else None)
+                tasks = metrics.stamp_dispatch(gate.wrap(bucketer.tasks(work_items)))
+            else:
+                tasks = metrics.stamp_dispatch(gate.wrap(batched(work_items, images_per_task, source_idle_wait if work_source is not None else None)))
+            results = collect_batches(watched_results(watched, process_batch, tasks, not retry_failed), gate.release, retry_queue)
+        else:
+            tasks = metrics.stamp_dispatch(gate.wrap(work_items))
+            results = collect_batches(watched_results(watched, process_single, tasks, not retry_failed), gate.release, retry_queue)
+
+        def retry_results():
+            """Second pass over the first pass's failures, on a fresh pool with the retry settings."""
+            if not retry_queue:
+                return
+            watched.shutdown()
+            processes = retry_processes or max(1, num_processes // 2)
+            # Retry workers keep the device placement and core pinning of the first pass
+            retry_slots = None
+            if retry_use_cpu:
+                retry_slots = build_worker_slots(config_path, [{"device": "cpu", "workers": processes, "threads": None}])
+            elif worker_slots:
+                retry_slots = spread_slots(worker_slots, processes)
+            retry_pids = None
+            if retry_slots:
+                processes = len(retry_slots)
+                retry_pids = mp_context.Array("i", processes)
+            colored_output(
+                f"[{get_beijing_time()}] Retrying {len(retry_queue)} failed images with {processes} processes "
+                f"({'CPU, ' if retry_use_cpu else ''}{retry_options})",
+                "yellow", log_file_path
+            )
+            with start_pool(processes, {**worker_options, **retry_options, "copy_errors": True}, retry_slots, retry_pids) as retry_pool:
+                retry_watched = WatchedPool(retry_pool, task_events, task_item_timeout, task_base_timeout)
+                retry_tasks = [[relative_path] for relative_path in retry_queue]
+                yield from collect_batches(watched_results(retry_watched, process_batch, retry_tasks, True))
+                retry_watched.shutdown()
 
-    with get_context("spawn").Pool(
-        processes=num_processes,
-        initializer=init_worker,
-        initargs=(config_to_use, batch_size),
-    ) as pool:
-        results = pool.imap_unordered(process_image, image_list)
+        results = itertools.chain(results, retry_results())
 
-        processed_count = 0
-        error_count = 0
         for result in results:
             processed_count += 1
             if not result:
                 error_count += 1
+            if processed_count == 1:
+                first_result_time = time.time() - start_time
+                colored_output(f"[{get_beijing_time()}] First result after {first_result_time:.2f} seconds.", "blue", log_file_path)
+                if metrics.first_worker_ready is not None:
+                    colored_output(
+                        f"[{get_beijing_time()}] Startup: parent imports {start_time - process_start_time:.2f}s, "
+                        f"first worker ready after {metrics.first_worker_ready - start_time:.2f}s ({start_method}), "
+                        f"first result after {first_result_time:.2f}s",
+                        "blue", log_file_path
+                    )
+            num_images = scan_progress["found"]
+            metrics.maybe_write()
+            if monitor is not None:
+                # A draining queue is not a slowdown: only judge while plenty of work is left
+                monitor.update(processed_count, num_images - processed_count > num_processes * images_per_task)
 
-            if processed_count % 10 == 0 or processed_count == num_images:
+            now = time.time()
+            if now - last_progress_time >= progress_interval or (scan_progress["done"] and processed_count == num_images):
+                last_progress_time = now
                 elapsed_time = time.time() - start_time
                 speed = elapsed_time / processed_count if processed_count > 0 else 0
                 remaining_time = (num_images - processed_count) * speed
                 eta = datetime.now() + timedelta(seconds=remaining_time)
                 remaining_formatted = format_timedelta(timedelta(seconds=remaining_time))
+                # Until the scan finishes the total (and so the ETA) is a lower bound
+                total_str = f"{num_images}" if scan_progress["done"] else f">={num_images} (scanning)"
 
                 colored_output(
-                    f"[{get_beijing_time()}] Processed {processed_count}/{num_images} images... ({speed:.3f} seconds/image), ETA: {eta.strftime('%Y-%m-%d %H:%M:%S')} ({remaining_formatted}), Errors: {error_count}",
+                    f"[{get_beijing_time()}] Processed {processed_count}/{total_str} images... ({speed:.3f} seconds/image), ETA: {eta.strftime('%Y-%m-%d %H:%M:%S')} ({remaining_formatted}), Errors: {error_count}",
                     "blue", log_file_path
                 )
-            if processed_count % 100 == 0:
-                clear_cache()
 
     pool.close()
     pool.join()
+    if directory_tracker is not None:
+        directory_tracker.close()
+        colored_output(f"[{get_beijing_time()}] Completion markers: {directory_tracker.markers} directories finished", "blue", log_file_path)
+        if pdf_output_root:
+            colored_output(f"[{get_beijing_time()}] PDFs: {directory_tracker.saved} created, {directory_tracker.failed} failed", "blue", log_file_path)
+        # Every directory marker is written by now: this tells followers that no more are coming
+        os.makedirs(output_root_dir, exist_ok=True)
+        write_marker(os.path.join(output_root_dir, RUN_MARKER), {
+            "directories": directory_tracker.markers,
+            "processed": processed_count,
+            "errors": error_count,
+            "finished_at": get_beijing_time(),
+        })
+    manifest.close()
+    shutil.rmtree(scratch_dir, ignore_errors=True)  # Leftovers of workers that died without cleanup
+
+    metrics.write()
+    for stage, summary in metrics.snapshot()["stages"].items():
+        colored_output(
+            f"[{get_beijing_time()}] Stage {stage}: n={summary['count']}, p50 {summary['p50'] * 1000:.1f} ms, "
+            f"p95 {summary['p95'] * 1000:.1f} ms, p99 {summary['p99'] * 1000:.1f} ms",
+            "blue", log_file_path
+        )
+    colored_output(f"[{get_beijing_time()}] Run metrics written to {metrics_path}", "blue", log_file_path)
+
+    if worker_stats.get("scratch_bytes_written"):
+        colored_output(
+            f"[{get_beijing_time()}] Scratch: {worker_stats['scratch_bytes_written'] / 1024 ** 2:.1f} MB written, "
+            f"{worker_stats.get('scratch_bytes_evicted', 0) / 1024 ** 2:.1f} MB evicted "
+            f"({worker_stats.get('scratch_files_evicted', 0)} files)",
+            "blue", log_file_path
+        )
+
+    if worker_stats.get("blank_pages"):
+        stages = metrics.snapshot()["stages"]
+        message = f"[{get_beijing_time()}] Blank pages: {worker_stats['blank_pages']} got empty results without predict ({worker_stats['blank_pages'] / max(1, processed_count):.1%} of images"
+        if stages.get("predict", {}).get("mean"):
+            saved = worker_stats["blank_pages"] * stages["predict"]["mean"]
+            message += f", ~{saved:.0f}s of inference saved at {stages['predict']['mean'] * 1000:.0f} ms/image"
+        if stages.get("blank_check", {}).get("mean"):
+            message += f", check {stages['blank_check']['mean'] * 1000:.1f} ms/image"
+        colored_output(message + ")", "blue", log_file_path)
+
+    if worker_stats.get("tiled_images"):
+        colored_output(
+            f"[{get_beijing_time()}] Tiling: {worker_stats['tiled_images']} oversized images predicted as {worker_stats['tiles']} tiles, "
+            f"{worker_stats.get('tile_duplicates', 0)} duplicate boxes from the overlaps removed",
+            "blue", log_file_path
+        )
 
-    if "paddle" in locals() or "paddle" in globals():
-        if paddle.device.is_compiled_with_cuda():
-            paddle.device.cuda.empty_cache()
+    dedup_lookups = worker_stats.get("dedup_hits", 0) + worker_stats.get("dedup_misses", 0)
+    if dedup_lookups:
+        colored_output(
+            f"[{get_beijing_time()}] Dedup cache: {worker_stats.get('dedup_hits', 0)} hits, {worker_stats.get('dedup_misses', 0)} misses "
+            f"({worker_stats.get('dedup_hits', 0) / dedup_lookups:.1%} of images skipped predict)",
+            "blue", log_file_path
+        )
 
-    if "paddlex" in locals() or "paddlex" in globals():
-          if pdx.env_info()["place"] == "gpu":
-            pdx.clear_memory()
-    clear_cache()
+    if worker_stats.get("worker_failures"):
+        colored_output(f"[{get_beijing_time()}] Watchdog: {worker_stats['worker_failures']} tasks lost to hung or crashed workers", "yellow", log_file_path)
+
+    if bucketer is not None:
+        flushes = ", ".join(f"{count} {reason}" for reason, count in bucketer.flushes.items())
+        colored_output(f"[{get_beijing_time()}] Resolution buckets dispatched: {flushes}", "blue", log_file_path)
+
+    if worker_stats.get("downscaled_images"):
+        report = build_downscale_report(worker_stats)
+        message = f"[{get_beijing_time()}] Downscaling: {report['downscaled_images']} images shrunk before predict"
+        if report["samples"]:
+            message += (
+                f"; {report['samples']} full-size samples: {report['mean_predict_time_full']:.3f}s -> {report['mean_predict_time_scaled']:.3f}s per image "
+                f"(~{report['estimated_time_saved']:.0f}s saved), text similarity {report['mean_text_similarity']:.1%}, "
+                f"boxes {report['boxes_full']} -> {report['boxes_scaled']}"
+            )
+        colored_output(message, "blue", log_file_path)
+        report_path = os.path.join(log_and_error_dir, f"downscale_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        save_json_atomic(report_path, report)
+
+    if batch_mode and worker_stats["predict_batches"]:
+        starved_ratio = worker_stats["starved_batches"] / worker_stats["predict_batches"]
+        colored_output(
+            f"[{get_beijing_time()}] Prefetch: accelerator starved before {worker_stats['starved_batches']}/{worker_stats['predict_batches']} "
+            f"predict calls ({starved_ratio:.1%}), {worker_stats['prefetch_wait_time']:.1f}s waiting on image reads",
+            "blue", log_file_path
+        )
 
     end_time = time.time()
     total_time = end_time - start_time
 
     colored_output(f"[{get_beijing_time()}] OCR results saved to: {output_root_dir}", "green", log_file_path)
     colored_output(f"[{get_beijing_time()}] Total processing time: {total_time:.2f} seconds", "green", log_file_path)
-    colored_output(f"[{get_beijing_time()}] Average time per image: {total_time / num_images:.3f} seconds", "green", log_file_path)
+    colored_output(f"[{get_beijing_time()}] Average time per image: {total_time / max(1, processed_count):.3f} seconds", "green", log_file_path)
     colored_output(f"[{get_beijing_time()}] Total errors: {error_count}", "red", log_file_path)
+    log_listener.stop()
+    return {
+        "processed": processed_count,
+        "errors": error_count,
+        "total_time": total_time,
+        "first_result_time": first_result_time,
+        "scan_time": scan_progress.get("time"),
+    }
 
 def modify_config_for_cpu(config_path):
     """Modifies config for CPU."""
+    return modify_config_for_device(config_path, "cpu")
+
+def modify_config_for_device(config_path, device):
+    """Writes a copy of the config pinned to one device ("cpu", "gpu:1", ...)."""
     base, ext = os.path.splitext(config_path)
-    new_config_path = f"{base}_cpu{ext}"
+    new_config_path = f"{base}_{device.replace(':', '')}{ext}"
     with open(config_path, "r") as f:
         config = yaml.safe_load(f)
-    config["Global"]["device"] = "cpu"
-    if "use_gpu" in config["Global"]:
-        del config["Global"]["use_gpu"]
-    if "gpu_id" in config["Global"]:
-        del config["Global"]["gpu_id"]
+    # CPU slots such as "cpu:1" are scheduling labels; Paddle itself only knows "cpu"
+    paddle_device = "cpu" if device.startswith("cpu") else device
+    config["Global"]["device"] = paddle_device
+    if isinstance(config.get("Pipeline"), dict) and "device" in config["Pipeline"]:
+        config["Pipeline"]["device"] = paddle_device
+    if paddle_device == "cpu":
+        if "use_gpu" in config["Global"]:
+            del config["Global"]["use_gpu"]
+        if "gpu_id" in config["Global"]:
+            del config["Global"]["gpu_id"]
     with open(new_config_path, "w") as f:
         yaml.dump(config, f)
     return new_config_path
 
+# --- Device Scheduling ---
+
+def parse_device_map(device_map):
+    """Parses a device map such as "gpu:0=3,gpu:1=3,cpu=4x8".
+
+    Each entry is ``device=workers`` or ``device=workersxthreads``; a list of
+    {"device", "workers", "threads"} dicts is accepted as-is.  CPU slots can
+    be numbered ("cpu:0=2,cpu:1=2") to exercise the scheduler on a box
+    without accelerators.
+    """
+    if not isinstance(device_map, str):
+        return [{"device": entry["device"], "workers": int(entry["workers"]), "threads": entry.get("threads")}
+                for entry in device_map]
+    entries = []
+    for part in device_map.split(","):
+        device, _, count = part.strip().partition("=")
+        workers, _, threads = count.partition("x")
+        if not device or not workers:
+            raise ValueError(f"Invalid device map entry: {part!r}")
+        entries.append({"device": device, "workers": int(workers), "threads": int(threads) if threads else None})
+    return entries
+
+def build_worker_slots(config_path, device_map):
+    """Expands a device map into one config per worker slot.
+
+    The pinned config for each device is written once, by extending what
+    modify_config_for_cpu does, and shared by all slots on that device.
+    """
+    slots = []
+    device_configs = {}
+    for entry in parse_device_map(device_map):
+        device = entry["device"]
+        if device not in device_configs:
+            device_configs[device] = modify_config_for_device(config_path, device)
+        for _ in range(entry["workers"]):
+            slots.append({"slot": len(slots), "device": device, "config": device_configs[device], "threads": entry["threads"],
+                          "cpus": None, "numa_node": None})
+    assign_cpu_cores(slots)
+    return slots
+
+def spread_slots(slots, count):
+    """Picks ``count`` slots taking each device in turn, for a pool smaller than the device map (retry pass)."""
+    by_device = {}
+    for slot in slots:
+        by_device.setdefault(slot["device"], []).append(slot)
+    picked = [slot for group in itertools.zip_longest(*by_device.values()) for slot in group if slot is not None]
+    return picked[:count]
+
+def parse_cpu_list(text):
+    """Parses a sysfs CPU list such as "0-15,32-47"."""
+    cpus = set()
+    for part in text.strip().split(","):
+        if part:
+            start, _, end = part.partition("-")
+            cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+def format_cpu_list(cpus):
+    """Inverse of parse_cpu_list, for logs."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{start}-{end}" if end > start else f"{start}" for start, end in ranges)
+
+def numa_nodes():
+    """Returns {NUMA node: CPUs} for the CPUs this process may run on; one node 0 where sysfs has no NUMA information."""
+    allowed = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(range(cpu_count()))
+    nodes = {}
+    node_root = "/sys/devices/system/node"
+    if os.path.isdir(node_root):
+        for name in os.listdir(node_root):
+            if not (name.startswith("node") and name[4:].isdigit()):
+                continue
+            try:
+                with open(os.path.join(node_root, name, "cpulist"), "r") as f:
+                    cpus = parse_cpu_list(f.read()) & allowed
+            except (OSError, ValueError):
+                continue
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    return nodes or {0: set(allowed)}
+
+def assign_cpu_cores(slots):
+    """Gives every CPU slot its own cores, as many as its thread count.
+
+    A slot without a thread count gets an even share of the allowed cores.
+    Each worker goes to the NUMA node with the most free cores that can
+    hold it whole, so its threads and (first-touch) memory stay on one
+    node and the workers spread over the nodes.  Only when no node has
+    room does a worker span nodes; once the cores run out the remaining
+    slots are left unpinned (``cpus`` None).
+    """
+    cpu_slots = [slot for slot in slots if slot["device"].startswith("cpu")]
+    if not cpu_slots or not hasattr(os, "sched_setaffinity"):
+        return
+    nodes = numa_nodes()
+    total = sum(len(cpus) for cpus in nodes.values())
+    for slot in cpu_slots:
+        if not slot["threads"]:
+            slot["threads"] = max(1, total // len(cpu_slots))
+    free = {node: sorted(cpus) for node, cpus in sorted(nodes.items())}
+    for slot in cpu_slots:
+        threads = slot["threads"]
+        fitting = [node for node, cpus in free.items() if len(cpus) >= threads]
+        if fitting:
+            node = max(fitting, key=lambda n: (len(free[n]), -n))
+            slot["cpus"], free[node] = free[node][:threads], free[node][threads:]
+            slot["numa_node"] = node
+        elif sum(len(cpus) for cpus in free.values()) >= threads:
+            cpus = []
+            for node in sorted(free, key=lambda n: -len(free[n])):
+                take = min(threads - len(cpus), len(free[node]))
+                cpus += free[node][:take]
+                free[node] = free[node][take:]
+            slot["cpus"] = cpus
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def claim_worker_slot(slot_pids):
+    """Claims the first slot that is unused or whose worker has exited.
+
+    Pool replaces dead workers with fresh processes; a replacement takes
+    over the slot (and so the device) of the worker it replaces.
+    """
+    with slot_pids.get_lock():
+        for index, pid in enumerate(slot_pids):
+            if pid == 0 or not pid_alive(pid):
+                slot_pids[index] = os.getpid()
+                return index
+    raise RuntimeError("No free worker slot")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,417 @@
+import argparse
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+
+import highocr3_f2 as ocr
+from highocr3_f2 import colored_output, get_beijing_time
+
+# --- Configuration Variables ---
+DEFAULT_PORT = 8765
+LEASE_SIZE = 64  # Images handed to a worker node per lease
+LEASE_TTL = 60.0  # Seconds a lease survives without renewal before its images are re-queued
+RECONNECT_TIMEOUT = 120.0  # Seconds a worker node keeps retrying an unreachable coordinator
+DONE_GRACE = 5.0  # Seconds the coordinator keeps answering "done" after the last result
+# --- End Configuration Variables ---
+
+# Protocol: one JSON object per line in each direction over a persistent TCP connection.
+#   {"op": "lease", "node": name, "max": n}  -> {"lease": id, "ttl": s, "items": [[path, size, mtime_ns], ...]}
+#                                              | {"wait": s[, "drained": true]} | {"done": true}
+#   {"op": "renew", "leases": [id, ...]}     -> {"expired": [id, ...]}
+#   {"op": "complete", "node": name, "lease": id, "results": [[path, success], ...]} -> {"ok": true}
+#   {"op": "config"}                         -> {"result_sink": sink}
+# Paths are relative to the image root, which every node mounts (and writes results next to) itself.
+# Each node keeps its log, manifest and dedup cache in its own subdirectory of the shared log directory:
+# SQLite's WAL must not be shared between hosts over a network filesystem.
+
+# --- Coordinator ---
+
+class Coordinator:
+    """Owns the scan and the completion manifest and leases work items to worker nodes.
+
+    Items of a lease that is neither completed nor renewed within its TTL
+    (the node died or lost its connection) go back to the front of the
+    queue for the next node that asks.  Results arriving late for an
+    already re-leased item are accepted once; the duplicate is ignored.
+    """
+    def __init__(self, image_root, output_root, log_dir, lease_size=LEASE_SIZE, lease_ttl=LEASE_TTL, scan_threads=8, result_sink="json"):
+        os.makedirs(log_dir, exist_ok=True)
+        self.image_root = image_root
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+        self.log_file_path = os.path.join(log_dir, "ocr_coordinator_log.txt")
+        self.manifest = ocr.CompletionManifest(os.path.join(log_dir, "ocr_manifest.sqlite"))
+        self.pending_files = {}  # relative path -> (size, mtime_ns) until a node reports it
+        self.scan_progress = {"found": 0, "done": False}
+        self.start_time = time.time()
+        self.result_sink = result_sink  # Every node writes its results this way (handed out by "config")
+        # Nodes write into the shared output tree; the coordinator marks directories complete there
+        self.tracker = ocr.DirectoryTracker(image_root, output_root, self.manifest, result_sink, self.log_file_path)
+        ocr.remove_marker(os.path.join(output_root, ocr.RUN_MARKER))
+        self.work_items = ocr.background_iter(ocr.scan_work_items(
+            image_root, output_root, self.manifest, self.pending_files, self.scan_progress, scan_threads,
+            self.log_file_path, self.start_time, self.tracker
+        ), idle_timeout=0.2)
+        self.lock = threading.Lock()
+        self.requeued = deque()
+        self.leases = {}  # lease id -> {"node", "items", "expires"}
+        self.lease_ids = itertools.count(1)
+        self.scan_exhausted = False
+        self.finished = threading.Event()
+        self.processed = 0
+        self.errors = 0
+        self.nodes = {}  # node name -> {"images", "errors", "leases", "expired"}
+
+    def handle(self, message):
+        op = message.get("op")
+        if op == "lease":
+            return self.lease(message["node"], int(message.get("max", self.lease_size)))
+        if op == "renew":
+            return self.renew(message.get("leases", []))
+        if op == "complete":
+            return self.complete(message["node"], message["lease"], message.get("results", []))
+        if op == "config":
+            return {"result_sink": self.result_sink}
+        return {"error": f"unknown op {op!r}"}
+
+    def lease(self, node, max_items):
+        with self.lock:
+            self._expire()
+            items = []
+            while self.requeued and len(items) < max_items:
+                relative_path = self.requeued.popleft()
+                if relative_path in self.pending_files:  # Not reported late by its previous node
+                    items.append(relative_path)
+            while not self.scan_exhausted and len(items) < max_items:
+                item = next(self.work_items, None)
+                if item is None:
+                    self.scan_exhausted = True
+                elif item is ocr.IDLE:
+                    break
+                else:
+                    items.append(item)
+            if not items:
+                if self.scan_exhausted and not self.requeued:
+                    if not self.leases:
+                        self.finished.set()
+                        return {"done": True}
+                    # Only leased work is left; it may still come back if its node dies
+                    return {"wait": 1.0, "drained": True}
+                return {"wait": 1.0}
+            lease_id = next(self.lease_ids)
+            self.leases[lease_id] = {"node": node, "items": set(items), "expires": time.time() + self.lease_ttl}
+            self._node(node)["leases"] += 1
+            return {
+                "lease": lease_id,
+                "ttl": self.lease_ttl,
+                "items": [[relative_path, *self.pending_files[relative_path]] for relative_path in items],
+            }
+
+    def renew(self, lease_ids):
+        with self.lock:
+            expired = []
+            for lease_id in lease_ids:
+                lease = self.leases.get(lease_id)
+                if lease is None:
+                    expired.append(lease_id)
+                else:
+                    lease["expires"] = time.time() + self.lease_ttl
+            return {"expired": expired}
+
+    def complete(self, node_name, lease_id, results):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            for relative_path, success in results:
+                if lease is not None:
+                    lease["items"].discard(relative_path)
+                entry = self.pending_files.pop(relative_path, None)
+                if entry is None:
+                    continue  # Second report of a re-leased item
+                self.tracker.add_page(relative_path, *entry, success, None)
+                node = self._node(node_name)
+                node["images"] += 1
+                self.processed += 1
+                if not success:
+                    node["errors"] += 1
+                    self.errors += 1
+            if lease is not None and not lease["items"]:
+                del self.leases[lease_id]
+            return {"ok": True}
+
+    def _node(self, name):
+        return self.nodes.setdefault(name, {"images": 0, "errors": 0, "leases": 0, "expired": 0})
+
+    def _expire(self):
+        now = time.time()
+        for lease_id, lease in list(self.leases.items()):
+            if lease["expires"] < now:
+                del self.leases[lease_id]
+                self.requeued.extendleft(sorted(lease["items"], reverse=True))
+                self._node(lease["node"])["expired"] += 1
+                colored_output(
+                    f"[{get_beijing_time()}] Lease {lease_id} of {lease['node']} expired; re-queued {len(lease['items'])} images.",
+                    "yellow", self.log_file_path
+                )
+
+    def expire_loop(self):
+        """Re-queues dead nodes' work even while no live node is asking for more."""
+        while not self.finished.is_set():
+            time.sleep(1.0)
+            with self.lock:
+                self._expire()
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.coordinator.handle(json.loads(line))
+            except Exception as e:
+                reply = {"error": str(e)}
+            self.wfile.write((json.dumps(reply, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def run_coordinator(host, port, image_root, output_root, log_dir, lease_size=LEASE_SIZE, lease_ttl=LEASE_TTL, progress_interval=10.0,
+                    result_sink="json"):
+    coordinator = Coordinator(image_root, output_root, log_dir, lease_size, lease_ttl, result_sink=result_sink)
+    server = CoordinatorServer((host, port), CoordinatorHandler)
+    server.coordinator = coordinator
+    threading.Thread(target=server.serve_forever, name="coordinator", daemon=True).start()
+    threading.Thread(target=coordinator.expire_loop, name="lease-expiry", daemon=True).start()
+    log_file_path = coordinator.log_file_path
+    colored_output(f"[{get_beijing_time()}] Coordinator listening on {host}:{port}, scanning {image_root}", "green", log_file_path)
+
+    while not coordinator.finished.wait(progress_interval):
+        with coordinator.lock:
+            found = coordinator.scan_progress["found"]
+            total_str = f"{found}" if coordinator.scan_progress["done"] else f">={found} (scanning)"
+            colored_output(
+                f"[{get_beijing_time()}] Processed {coordinator.processed}/{total_str} images, {len(coordinator.leases)} leases out "
+                f"to {len({lease['node'] for lease in coordinator.leases.values()})} nodes, errors: {coordinator.errors}",
+                "blue", log_file_path
+            )
+    time.sleep(DONE_GRACE)  # Let polling nodes hear "done"
+    server.shutdown()
+    server.server_close()
+    coordinator.tracker.close()
+    ocr.write_marker(os.path.join(output_root, ocr.RUN_MARKER), {
+        "directories": coordinator.tracker.markers,
+        "processed": coordinator.processed,
+        "errors": coordinator.errors,
+        "finished_at": get_beijing_time(),
+    })
+    coordinator.manifest.close()
+
+    total_time = time.time() - coordinator.start_time
+    for name, node in sorted(coordinator.nodes.items()):
+        colored_output(
+            f"[{get_beijing_time()}] Node {name}: {node['images']} images, {node['errors']} errors, "
+            f"{node['leases']} leases ({node['expired']} expired)",
+            "blue", log_file_path
+        )
+    colored_output(f"[{get_beijing_time()}] Total processing time: {total_time:.2f} seconds", "green", log_file_path)
+    colored_output(f"[{get_beijing_time()}] Total processed: {coordinator.processed}, errors: {coordinator.errors}", "green", log_file_path)
+    return coordinator.processed, coordinator.errors
+
+# --- Worker Node ---
+
+class CoordinatorClient:
+    """Line-delimited JSON requests over one connection, reconnecting while the coordinator is unreachable."""
+    def __init__(self, address, reconnect_timeout=RECONNECT_TIMEOUT):
+        self.address = address
+        self.reconnect_timeout = reconnect_timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.stream = None
+
+    def request(self, message):
+        with self.lock:
+            deadline = time.time() + self.reconnect_timeout
+            while True:
+                try:
+                    if self.sock is None:
+                        self.sock = socket.create_connection(self.address, timeout=60)
+                        self.stream = self.sock.makefile("rwb")
+                    self.stream.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+                    self.stream.flush()
+                    line = self.stream.readline()
+                    if not line:
+                        raise ConnectionError("coordinator closed the connection")
+                    return json.loads(line)
+                except OSError:
+                    self._disconnect()
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(1.0)
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.stream = None
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+
+class LeaseWorkSource:
+    """Work source for highocr3_f2.main() on a worker node.
+
+    Leases items from the coordinator only while fewer than
+    ``max_outstanding`` leased images are unfinished, reports each lease
+    back once all its images have a result, and renews open leases in the
+    background.  When the queue is drained while this node still holds
+    work, the item stream ends so main() can run its retry pass and report
+    the rest; ``finished`` tells whether the coordinator is done or main()
+    should run again for work re-queued from a dead node.
+    """
+    def __init__(self, address, node_name, lease_size=LEASE_SIZE, max_outstanding=256, log_file_path=None):
+        self.client = CoordinatorClient(address)
+        self.node_name = node_name
+        self.lease_size = lease_size
+        self.max_outstanding = max(max_outstanding, lease_size)
+        self.log_file_path = log_file_path
+        self.condition = threading.Condition()
+        self.outstanding = 0
+        self.item_leases = {}  # relative path -> lease id
+        self.open_leases = {}  # lease id -> {"remaining", "results"}
+        self.renew_interval = LEASE_TTL / 3  # Follows the TTL the coordinator announces
+        self.finished = False
+        self.closed = threading.Event()
+        threading.Thread(target=self._renew_loop, name="lease-renewal", daemon=True).start()
+
+    def items(self, pending_files, scan_progress):
+        start_time = time.time()
+        while True:
+            with self.condition:
+                while self.outstanding + self.lease_size > self.max_outstanding:
+                    self.condition.wait()
+            try:
+                reply = self.client.request({"op": "lease", "node": self.node_name, "max": self.lease_size})
+            except OSError as e:
+                colored_output(f"[{get_beijing_time()}] Coordinator unreachable, stopping: {e}", "red", self.log_file_path)
+                self.finished = True
+                break
+            if reply.get("done"):
+                self.finished = True
+                break
+            if "wait" in reply:
+                if reply.get("drained") and self.outstanding:
+                    break
+                time.sleep(reply["wait"])
+                continue
+            items = reply["items"]
+            self.renew_interval = reply["ttl"] / 3
+            with self.condition:
+                self.open_leases[reply["lease"]] = {"remaining": len(items), "results": []}
+                self.outstanding += len(items)
+                for relative_path, size, mtime_ns in items:
+                    self.item_leases[relative_path] = reply["lease"]
+                    pending_files[relative_path] = (size, mtime_ns)
+            scan_progress["found"] += len(items)
+            for relative_path, _, _ in items:
+                yield relative_path
+        scan_progress["done"] = True
+        scan_progress["time"] = time.time() - start_time
+
+    def complete(self, relative_path, success):
+        with self.condition:
+            lease_id = self.item_leases.pop(relative_path)
+            lease = self.open_leases[lease_id]
+            lease["results"].append([relative_path, bool(success)])
+            lease["remaining"] -= 1
+            self.outstanding -= 1
+            self.condition.notify_all()
+            if lease["remaining"]:
+                return
+            del self.open_leases[lease_id]
+        try:
+            self.client.request({"op": "complete", "node": self.node_name, "lease": lease_id, "results": lease["results"]})
+        except OSError as e:
+            colored_output(f"[{get_beijing_time()}] Could not report lease {lease_id}: {e}", "red", self.log_file_path)
+
+    def _renew_loop(self):
+        last_renewal = time.time()
+        while not self.closed.wait(1.0):
+            if time.time() - last_renewal < self.renew_interval:
+                continue
+            last_renewal = time.time()
+            with self.condition:
+                lease_ids = list(self.open_leases)
+            if not lease_ids:
+                continue
+            try:
+                expired = self.client.request({"op": "renew", "leases": lease_ids}).get("expired", [])
+            except OSError:
+                continue
+            if expired:
+                colored_output(f"[{get_beijing_time()}] Leases {expired} expired at the coordinator; their images may be redone elsewhere.", "yellow", self.log_file_path)
+
+    def close(self):
+        self.closed.set()
+        self.client.close()
+
+def run_worker_node(address, image_root, output_root, log_dir, num_processes=None, lease_size=LEASE_SIZE, node_id=None):
+    node_id = node_id or socket.gethostname()
+    node_name = f"{node_id}:{os.getpid()}"
+    log_dir = os.path.join(log_dir, "nodes", node_id)  # Own manifest and dedup cache, never opened by another node
+    # No local retry pass: failures held for it never reach complete(), and once they fill max_outstanding
+    # items() waits forever while the first pass never ends.  Failed images go back to the coordinator instead.
+    overrides = {"retry_failed": False}
+    if num_processes:
+        overrides["num_processes"] = num_processes
+    os.makedirs(log_dir, exist_ok=True)
+    # Enough leased work to keep every local worker busy, without hoarding the queue
+    max_outstanding = 2 * (num_processes or os.cpu_count() or 1) * lease_size
+    source = LeaseWorkSource(address, node_name, lease_size, max_outstanding, os.path.join(log_dir, "ocr_log.txt"))
+    overrides["work_source"] = source
+    try:
+        # Results go where the coordinator's completion markers say they are
+        overrides["worker_options"] = {"result_sink": source.client.request({"op": "config"})["result_sink"]}
+        while True:
+            result = ocr.main(image_root, output_root, log_dir, overrides)
+            if source.finished:
+                return result
+    finally:
+        source.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributes highocr3_f2.py over several machines sharing the image and output storage.")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    for mode in ("coordinator", "worker"):
+        sub = subparsers.add_parser(mode)
+        sub.add_argument("--image-root", required=True)
+        sub.add_argument("--output-root", required=True)
+        sub.add_argument("--log-dir", required=True)
+        sub.add_argument("--lease-size", type=int, default=LEASE_SIZE)
+        if mode == "coordinator":
+            sub.add_argument("--host", default="127.0.0.1", help="Interface to listen on; the protocol has no authentication")
+            sub.add_argument("--port", type=int, default=DEFAULT_PORT)
+            sub.add_argument("--lease-ttl", type=float, default=LEASE_TTL)
+            sub.add_argument("--result-sink", choices=("json", "shard"), default="json", help="How every node writes its results")
+        else:
+            sub.add_argument("--coordinator", default=f"127.0.0.1:{DEFAULT_PORT}", help="host:port")
+            sub.add_argument("--processes", type=int, help="Local worker processes (default: highocr3_f2 setting)")
+            sub.add_argument("--node-id", help="Names this node's subdirectory of --log-dir (default: host name); unique per node")
+    args = parser.parse_args()
+
+    if args.mode == "coordinator":
+        run_coordinator(args.host, args.port, args.image_root, args.output_root, args.log_dir, args.lease_size, args.lease_ttl,
+                        result_sink=args.result_sink)
+    else:
+        host, _, port = args.coordinator.rpartition(":")
+        run_worker_node((host, int(port)), args.image_root, args.output_root, args.log_dir, args.processes, args.lease_size, args.node_id)
+
+if __name__ == "__main__":
+    main()
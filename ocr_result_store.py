@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import re
+import socket
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# --- Configuration Variables ---
+SHARD_PREFIX = "_ocr_shard_"
+SHARD_DATA_EXT = ".jsonl"
+SHARD_INDEX_EXT = ".idx"
+RESULT_FIELDS = ("dt_polys", "rec_text", "rec_score")  # What the PDF creator needs
+MAX_OPEN_SHARDS = 64  # Directories with an open shard per worker
+COMPLETION_MARKER = "_ocr_complete.json"  # Written into an output directory once all of its images have results
+RUN_MARKER = "_ocr_run_complete.json"  # Written into the output root when a highocr3_f2.py run ends
+# --- End Configuration Variables ---
+
+# --- Record Conversion ---
+
+def to_jsonable(value):
+    """Converts numpy arrays/scalars inside a result to plain Python values."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {k: to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    return value
+
+def compact_record(res):
+    """Keeps only the fields needed downstream from a pipeline result."""
+    return {field: to_jsonable(res[field]) for field in RESULT_FIELDS if field in res}
+
+# --- Shard Writer ---
+
+class ShardResultWriter:
+    """Appends compact OCR results to per-directory shard files.
+
+    Every worker process writes its own shard in each output directory
+    (``_ocr_shard_<host>_<pid>.jsonl``), so no two processes ever append to
+    the same file.  Each record is one JSON line; a side ``.idx`` file holds
+    ``name<TAB>offset<TAB>length<TAB>time`` per record for random access.
+    The index line is written after the data, so a crash can leave a torn
+    data line but never an index entry pointing at one.
+    """
+    def __init__(self, max_open=MAX_OPEN_SHARDS):
+        self.shard_name = f"{SHARD_PREFIX}{socket.gethostname()}_{os.getpid()}"
+        self.max_open = max_open
+        self.open_shards = OrderedDict()  # output_dir -> (data_file, index_file)
+
+    def _get_shard(self, output_dir):
+        shard = self.open_shards.get(output_dir)
+        if shard is not None:
+            self.open_shards.move_to_end(output_dir)
+            return shard
+        if len(self.open_shards) >= self.max_open:
+            _, (data_file, index_file) = self.open_shards.popitem(last=False)
+            data_file.close()
+            index_file.close()
+        base = os.path.join(output_dir, self.shard_name)
+        shard = (open(base + SHARD_DATA_EXT, "ab"), open(base + SHARD_INDEX_EXT, "a", encoding="utf-8"))
+        self.open_shards[output_dir] = shard
+        return shard
+
+    def write(self, output_dir, name, record):
+        """Appends one result; ``name`` is the image base name."""
+        data_file, index_file = self._get_shard(output_dir)
+        line = (json.dumps({"name": name, **record}, ensure_ascii=False) + "\n").encode("utf-8")
+        offset = data_file.tell()
+        data_file.write(line)
+        data_file.flush()
+        index_file.write(f"{name}\t{offset}\t{len(line)}\t{time.time():.6f}\n")
+
+    def flush(self):
+        """Pushes buffered index lines to the OS; call before reporting results."""
+        for data_file, index_file in self.open_shards.values():
+            data_file.flush()
+            index_file.flush()
+
+    def close(self):
+        for data_file, index_file in self.open_shards.values():
+            data_file.close()
+            index_file.close()
+        self.open_shards.clear()
+
+# --- Shard Reader ---
+
+class ShardResultIndex:
+    """Random-access view over all result shards of one directory.
+
+    When an image was OCR'd more than once (e.g. it changed), the newest
+    record wins.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}  # name -> (time, data_path, offset, length)
+        try:
+            index_files = [f for f in os.listdir(directory) if f.startswith(SHARD_PREFIX) and f.endswith(SHARD_INDEX_EXT)]
+        except FileNotFoundError:
+            index_files = []
+        for index_file in index_files:
+            data_path = os.path.join(directory, index_file[:-len(SHARD_INDEX_EXT)] + SHARD_DATA_EXT)
+            with open(os.path.join(directory, index_file), "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 4:
+                        continue  # Torn last line after a crash
+                    name, offset, length, written_at = parts[0], int(parts[1]), int(parts[2]), float(parts[3])
+                    current = self.entries.get(name)
+                    if current is None or written_at >= current[0]:
+                        self.entries[name] = (written_at, data_path, offset, length)
+
+    def names(self):
+        return list(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def read(self, name):
+        """Returns the record for an image base name, or None."""
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        _, data_path, offset, length = entry
+        with open(data_path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode("utf-8"))
+
+def load_result(directory, name, shard_index=None):
+    """Loads an OCR result by image base name.
+
+    ``{name}_result.json`` is preferred when it exists; otherwise the
+    directory's result shards are consulted.  Returns None if neither has it.
+    """
+    json_path = os.path.join(directory, f"{name}_result.json")
+    if os.path.exists(json_path):
+        with open(json_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    if shard_index is None:
+        shard_index = ShardResultIndex(directory)
+    return shard_index.read(name)
+
+# --- Page Order ---
+
+def page_sort_key(filename):
+    """Book order of a page image: bok, leg, fow, "!" pages, numbered pages, cov, then the rest."""
+    filename_lower = filename.lower()
+    if filename_lower.startswith("bok"):		return (0, filename_lower)
+    elif filename_lower.startswith("leg"):	return (1, filename_lower)
+    elif filename_lower.startswith("fow"):	return (2, filename_lower)
+    elif filename_lower.startswith("!"):	return (3, filename_lower)
+    elif filename_lower[0].isdigit():
+        match = re.match(r"^\d+", filename_lower)
+        if match:	return (4, int(match.group(0)), filename_lower)
+        else:		return (4, 0, filename_lower)
+    elif filename_lower.startswith("cov"):	return (5, filename_lower)
+    else:			return (6, filename_lower)
+
+def sort_pages(filenames):
+    """Orders a directory's page images as its PDF pages (pdf_creator_with_text_layer6.py and fused mode)."""
+    from natsort import natsorted, ns
+    return natsorted(filenames, key=page_sort_key, alg=ns.IGNORECASE)
+
+# --- Completion Markers ---
+
+def source_checksum(files):
+    """Checksum of a directory's images given as (name, size, mtime_ns).
+
+    Changes when an image is added, removed or rewritten, so a marker can
+    be checked against the directory it describes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name, size, mtime_ns in sorted(files):
+        digest.update(f"{name}\0{size}\0{mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def write_marker(path, marker):
+    """Writes a marker atomically: readers see the old file, no file, or the whole new one."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(marker, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def read_marker(path):
+    """Returns a marker's contents, or None if it does not exist (yet)."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def remove_marker(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,232 @@
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+# --- Configuration Variables ---
+SOURCE_SEPARATOR = "::"  # "<archive or PDF path>::<member path>" names an image inside a container
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+PDF_EXTENSIONS = (".pdf",)
+PDF_PAGE_NAME = "page_{:04d}.png"  # Member name of a PDF page (1-based), the naming the PDF creator sorts by
+PDF_RENDER_DPI = 300  # Pages that are not one full-page embedded scan are rendered at this resolution
+PDF_IMAGE_FORMATS = ("png", "jpeg", "jpg", "bmp", "tiff", "tif")  # Embedded scans passed through as they are
+MAX_OPEN_CONTAINERS = 8  # Archive/PDF handles kept open per process
+# --- End Configuration Variables ---
+
+# MuPDF is not thread-safe; every use of fitz in a process goes through this lock
+pdf_lock = threading.RLock()
+
+# --- Virtual Paths ---
+
+def is_container(name):
+    return name.lower().endswith(ARCHIVE_EXTENSIONS + PDF_EXTENSIONS)
+
+def is_virtual(path):
+    return SOURCE_SEPARATOR in path
+
+def split_virtual(path):
+    """Returns (container path, member path) of a virtual path."""
+    container, _, member = path.partition(SOURCE_SEPARATOR)
+    return container, member
+
+def join_source_path(directory, name):
+    """Joins a directory, real or virtual ("vol1.zip::" or "vol1.zip::scans"), and a file name."""
+    if directory.endswith(SOURCE_SEPARATOR):
+        return directory + name
+    return os.path.join(directory, name)
+
+def split_source_path(path):
+    """Inverse of join_source_path: (directory, name)."""
+    if not is_virtual(path):
+        return os.path.split(path)
+    container, member = split_virtual(path)
+    member_dir, _, name = member.rpartition("/")
+    return f"{container}{SOURCE_SEPARATOR}{member_dir}", name
+
+def container_stem(path):
+    lower = path.lower()
+    for extension in ARCHIVE_EXTENSIONS + PDF_EXTENSIONS:
+        if lower.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+def output_relative_path(path):
+    """Maps a relative, possibly virtual path to the real path mirroring it in the output tree.
+
+    "books/vol1.zip::scans/p1.png" -> "books/vol1/scans/p1.png"
+    """
+    if not is_virtual(path):
+        return path
+    container, member = split_virtual(path)
+    return os.path.join(container_stem(container), member)
+
+def find_container(directory, name):
+    """Returns the archive or PDF in ``directory`` whose name without extension is ``name``, or None."""
+    for extension in ARCHIVE_EXTENSIONS + PDF_EXTENSIONS:
+        path = os.path.join(directory, name + extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+# --- Listing ---
+
+def member_name(name):
+    """Normalises an archive member name, or returns None for one that would leave the container's output directory.
+
+    "tar -C dir -cf vol.tar ." stores "./a/p1.png", listed and looked up as
+    "a/p1.png"; absolute names and names climbing out with ".." are refused.
+    """
+    name = posixpath.normpath(name)
+    if name.startswith("/") or name == ".." or name.startswith("../"):
+        return None
+    return name
+
+def list_container(path, extensions, skipped=None):
+    """Lists the images of an archive or PDF: {member directory: [(name, size, mtime_ns)]}.
+
+    Members carry their own size (the whole file's for PDF pages) and the
+    container's mtime, so a rewritten container is OCR'd again.  Members
+    member_name refuses are left out and, with ``skipped``, appended to it.
+    """
+    stat = os.stat(path)
+    groups = {}
+    if path.lower().endswith(PDF_EXTENSIONS):
+        import fitz
+        with pdf_lock, fitz.open(path) as doc:
+            groups[""] = [(PDF_PAGE_NAME.format(number + 1), stat.st_size, stat.st_mtime_ns) for number in range(doc.page_count)]
+        return groups
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            members = [(info.filename, info.file_size) for info in archive.infolist() if not info.is_dir()]
+    else:
+        with tarfile.open(path) as archive:
+            members = [(member.name, member.size) for member in archive.getmembers() if member.isfile()]
+    for raw_name, size in members:
+        name = member_name(raw_name)
+        if name is None:
+            if skipped is not None:
+                skipped.append(raw_name)
+            continue
+        if name.lower().endswith(extensions):
+            member_dir, _, file = name.rpartition("/")
+            groups.setdefault(member_dir, []).append((file, size, stat.st_mtime_ns))
+    return groups
+
+# --- Reading ---
+
+class OpenContainer:
+    """An open archive or PDF shared by the readers of one process.
+
+    ``readers`` counts the threads between open_container and
+    release_container; an entry evicted from the cache is closed by the
+    last of them, never under a reader.
+    """
+    def __init__(self, handle, lock, index):
+        self.handle = handle
+        self.lock = lock  # Serialises reads of the handle (pdf_lock for PDFs)
+        self.index = index  # Normalised member name -> raw ZipInfo/TarInfo, None for PDF
+        self.readers = 0
+        self.evicted = False
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
+
+open_containers = OrderedDict()  # container path -> OpenContainer
+open_containers_lock = threading.Lock()
+
+def open_container(path):
+    """Returns the OpenContainer of ``path`` with a reader registered; pair with release_container."""
+    # Opening and closing happen outside open_containers_lock: a thread holding pdf_lock may be waiting for it
+    with open_containers_lock:
+        entry = open_containers.get(path)
+        if entry is not None:
+            open_containers.move_to_end(path)
+            entry.readers += 1
+            return entry
+    lower = path.lower()
+    index = None
+    if lower.endswith(PDF_EXTENSIONS):
+        import fitz
+        with pdf_lock:
+            handle = fitz.open(path)
+        lock = pdf_lock
+    elif lower.endswith(".zip"):
+        handle = zipfile.ZipFile(path)
+        index = {member_name(info.filename): info for info in handle.infolist()}  # Raw ZipInfo kept for reading
+        lock = threading.Lock()
+    else:
+        handle = tarfile.open(path)
+        index = {member_name(member.name): member for member in handle.getmembers()}  # Raw TarInfo kept for extraction
+        lock = threading.Lock()
+    opened = OpenContainer(handle, lock, index)
+    to_close = []
+    with open_containers_lock:
+        entry = open_containers.get(path)
+        if entry is not None:  # Another thread opened it meanwhile
+            to_close.append(opened)
+        else:
+            entry = opened
+            open_containers[path] = entry
+            while len(open_containers) > MAX_OPEN_CONTAINERS:
+                evicted = open_containers.popitem(last=False)[1]
+                evicted.evicted = True
+                if evicted.readers == 0:
+                    to_close.append(evicted)
+        entry.readers += 1
+    for container in to_close:
+        container.close()
+    return entry
+
+def release_container(entry):
+    """Unregisters a reader; closes the entry if it was evicted meanwhile and this was its last reader."""
+    with open_containers_lock:
+        entry.readers -= 1
+        close = entry.evicted and entry.readers == 0
+    if close:
+        entry.close()
+
+def read_pdf_page(doc, member):
+    """Returns a page's embedded scan as stored, or renders the page when it is more than one image."""
+    page = doc[int(os.path.splitext(member)[0].rsplit("_", 1)[1]) - 1]
+    images = page.get_images(full=True)
+    if len(images) == 1:
+        bbox = page.get_image_bbox(images[0])
+        if bbox.width >= page.rect.width * 0.95 and bbox.height >= page.rect.height * 0.95:
+            extracted = doc.extract_image(images[0][0])
+            if extracted and extracted["ext"] in PDF_IMAGE_FORMATS:
+                return extracted["image"]
+    return page.get_pixmap(dpi=PDF_RENDER_DPI).tobytes("png")
+
+def read_source(path):
+    """Returns the bytes of an image file or of a virtual member of an archive or PDF."""
+    if not is_virtual(path):
+        with open(path, "rb") as f:
+            return f.read()
+    container, member = split_virtual(path)
+    entry = open_container(container)
+    try:
+        with entry.lock:
+            if isinstance(entry.handle, zipfile.ZipFile):
+                return entry.handle.read(entry.index[member])
+            if isinstance(entry.handle, tarfile.TarFile):
+                # A compressed tar seeks backwards by decompressing from the start: zip or plain tar suit random access
+                f = entry.handle.extractfile(entry.index[member])
+                return f.read()
+            return read_pdf_page(entry.handle, member)
+    finally:
+        release_container(entry)
+
+def close_containers():
+    """Closes every cached container; ones still being read are closed by their last reader."""
+    to_close = []
+    with open_containers_lock:
+        for entry in open_containers.values():
+            entry.evicted = True
+            if entry.readers == 0:
+                to_close.append(entry)
+        open_containers.clear()
+    for entry in to_close:
+        entry.close()
@@ -0,0 +1,384 @@
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import os
+import queue
+import select
+import signal
+import struct
+import threading
+import time
+from collections import deque
+
+import highocr3_f2 as ocr
+from highocr3_f2 import colored_output, get_beijing_time
+from ocr_sources import is_container, is_virtual, join_source_path, split_source_path, split_virtual
+
+# --- Configuration Variables ---
+DEBOUNCE_SECONDS = 5.0  # A file is OCR'd once its size and mtime have not changed for this long
+POLL_INTERVAL = 60.0  # Seconds between rescans of the whole tree when inotify is not available
+STATUS_INTERVAL = 2.0  # Seconds between rewrites of the status file
+LAG_WINDOW = 500  # Latest images the reported lag is computed over
+# --- End Configuration Variables ---
+
+# --- inotify ---
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")  # struct inotify_event: wd, mask, cookie, len (name follows)
+
+class Inotify:
+    """Minimal ctypes binding of Linux inotify: one watch per directory, events read with a timeout."""
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+        self.directories = {}  # watch descriptor -> directory
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_add_watch {directory}: {os.strerror(error)}")
+        self.directories[wd] = directory
+
+    def read(self, timeout):
+        """Returns the events of the next ``timeout`` seconds as [(directory, name, mask)].
+
+        A queue overflow comes back as (None, "", mask): events were lost.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, "", mask))
+            elif mask & IN_IGNORED:  # Directory deleted or unmounted
+                self.directories.pop(wd, None)
+            elif wd in self.directories:
+                events.append((self.directories[wd], name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+# --- Watch Work Source ---
+
+class WatchWorkSource:
+    """Work source for highocr3_f2.main() that keeps feeding new and changed images until stopped.
+
+    The tree is scanned once at start, picking up whatever arrived while
+    nothing was running; after that inotify reports new files.  Without
+    inotify (or once its watch limit is hit or its queue overflows) the
+    tree is rescanned every ``poll_interval`` seconds instead.  A file is
+    queued only after its size and mtime have stayed the same for
+    ``debounce`` seconds, so scans still being copied are not read half
+    written.  Results go into the completion manifest as they land; a
+    failed image is tried again only once it changes.  ``status_path`` is
+    rewritten every STATUS_INTERVAL seconds with queue depth and lag.
+    """
+    def __init__(self, image_root, log_dir, status_path, debounce=DEBOUNCE_SECONDS, poll_interval=POLL_INTERVAL,
+                 use_inotify=True, scan_threads=8, log_file_path=None):
+        self.image_root = image_root
+        self.status_path = status_path
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.scan_threads = scan_threads
+        self.log_file_path = log_file_path
+        self.manifest = ocr.CompletionManifest(os.path.join(log_dir, "ocr_manifest.sqlite"))
+        self.lock = threading.Lock()
+        self.candidates = {}  # real path (image or archive/PDF) -> [size, mtime_ns, detected, last change]
+        self.ready = queue.Queue()  # (relative path, size, mtime_ns) settled and not yet handed to main()
+        self.queued = {}  # relative path -> (size, mtime_ns, detected) until its result lands
+        self.changed_while_queued = {}  # relative path -> (image path, size, mtime_ns, detected)
+        self.failed = {}  # relative path -> (size, mtime_ns) of the attempt that failed
+        self.lags = deque(maxlen=LAG_WINDOW)
+        self.processed = 0
+        self.errors = 0
+        self.last_event = None
+        self.inotify = None
+        self.backend = "polling"
+        self.started = None
+        self.threads = []
+        self.stopping = threading.Event()
+        self.closed = threading.Event()
+
+    def start(self):
+        """Starts watching; called on the first items() so it runs with main()'s logging in place."""
+        self.started = time.time()
+        if self.use_inotify:
+            try:
+                self.inotify = Inotify()
+                self.backend = "inotify"
+            except (OSError, AttributeError) as e:  # AttributeError: no inotify_init1 in this libc
+                colored_output(f"[{get_beijing_time()}] inotify unavailable ({e}); rescanning every {self.poll_interval:.0f}s.", "yellow", self.log_file_path)
+        self.threads = [
+            threading.Thread(target=self._watch_loop, name="watch", daemon=True),
+            threading.Thread(target=self._status_loop, name="watch-status", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        colored_output(f"[{get_beijing_time()}] Watching {self.image_root} ({self.backend}), status in {self.status_path}", "green", self.log_file_path)
+
+    def items(self, pending_files, scan_progress):
+        if self.started is None:
+            self.start()
+        while not self.stopping.is_set():
+            try:
+                relative_path, size, mtime_ns = self.ready.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            pending_files[relative_path] = (size, mtime_ns)
+            scan_progress["found"] += 1
+            yield relative_path
+        scan_progress["done"] = True
+        scan_progress["time"] = time.time() - self.started
+
+    def complete(self, relative_path, success):
+        with self.lock:
+            size, mtime_ns, detected = self.queued.pop(relative_path)
+            self.processed += 1
+            self.lags.append(time.time() - detected)
+            if success:
+                self.manifest.mark_complete(ocr.manifest_key(self.image_root, relative_path), size, mtime_ns)
+                self.failed.pop(relative_path, None)
+            else:
+                self.errors += 1
+                self.failed[relative_path] = (size, mtime_ns)
+            changed = self.changed_while_queued.pop(relative_path, None)
+        if changed is not None:
+            self._enqueue(*changed)
+
+    def stop(self):
+        """Ends the item stream; main() finishes the images already dispatched and returns."""
+        self.stopping.set()
+
+    def close(self):
+        self.stopping.set()
+        self.closed.set()
+        for thread in self.threads:
+            thread.join(timeout=60)  # A rescan in progress stops at its next directory
+        if self.inotify is not None:
+            self.inotify.close()
+        self.write_status("stopped")
+        self.manifest.close()
+
+    # --- Discovery ---
+
+    def _watch_loop(self):
+        try:
+            self._rescan()
+            last_scan = time.time()
+            while not self.stopping.is_set():
+                inotify = self.inotify
+                if inotify is not None:
+                    for directory, name, mask in inotify.read(min(1.0, self.debounce / 2)):
+                        self._handle_event(directory, name, mask)
+                else:
+                    self.stopping.wait(min(1.0, self.debounce / 2))
+                    if time.time() - last_scan >= self.poll_interval:
+                        self._rescan()
+                        last_scan = time.time()
+                self._release_settled()
+        except Exception as e:
+            colored_output(f"[{get_beijing_time()}] Watcher failed, stopping: {e}", "red", self.log_file_path)
+            self.stopping.set()
+
+    def _rescan(self):
+        """Walks the whole tree; images old enough are queued at once, recent ones are debounced first."""
+        now = time.time()
+        for directory, files in ocr.scan_image_tree(self.image_root, self.scan_threads, self._add_watch):
+            if self.stopping.is_set():
+                return
+            for file, size, mtime_ns in files:
+                image_path = join_source_path(directory, file)
+                if now - mtime_ns / 1e9 < self.debounce:
+                    self._observe(split_virtual(image_path)[0] if is_virtual(image_path) else image_path, now)
+                else:
+                    self._enqueue(image_path, size, mtime_ns, now)
+
+    def _add_watch(self, directory):
+        inotify = self.inotify
+        if inotify is None:
+            return
+        try:
+            inotify.add_watch(directory)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                colored_output(f"[{get_beijing_time()}] Not watching {directory}: {e}", "yellow", self.log_file_path)
+                return
+            colored_output(
+                f"[{get_beijing_time()}] inotify watch limit reached (fs.inotify.max_user_watches); rescanning every {self.poll_interval:.0f}s instead.",
+                "yellow", self.log_file_path
+            )
+            self.inotify = None
+            self.backend = "polling"
+            inotify.close()
+
+    def _handle_event(self, directory, name, mask):
+        now = time.time()
+        self.last_event = now
+        if directory is None:
+            colored_output(f"[{get_beijing_time()}] inotify queue overflowed; rescanning {self.image_root}.", "yellow", self.log_file_path)
+            self._rescan()
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have landed before the watch did: everything found is debounced as new
+                for new_directory, files in ocr.scan_image_tree(path, self.scan_threads, self._add_watch):
+                    for file, _, _ in files:
+                        image_path = join_source_path(new_directory, file)
+                        self._observe(split_virtual(image_path)[0] if is_virtual(image_path) else image_path, now)
+            return
+        if name.lower().endswith(ocr.IMAGE_EXTENSIONS) or (ocr.SCAN_CONTAINERS and is_container(name)):
+            self._observe(path, now)
+
+    def _observe(self, path, now):
+        """Starts or restarts the debounce of a file that appeared or changed."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.candidates.pop(path, None)
+            return
+        candidate = self.candidates.get(path)
+        if candidate is None:
+            self.candidates[path] = [stat.st_size, stat.st_mtime_ns, now, now]
+        elif (candidate[0], candidate[1]) != (stat.st_size, stat.st_mtime_ns):
+            candidate[0], candidate[1], candidate[3] = stat.st_size, stat.st_mtime_ns, now
+
+    def _release_settled(self):
+        now = time.time()
+        for path in [path for path, candidate in self.candidates.items() if now - candidate[3] >= self.debounce]:
+            size, mtime_ns, detected, _ = self.candidates[path]
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.candidates[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.candidates[path] = [stat.st_size, stat.st_mtime_ns, detected, now]
+                continue
+            del self.candidates[path]
+            if is_container(path):
+                for directory, files in ocr.scan_container(path):
+                    for file, member_size, member_mtime_ns in files:
+                        self._enqueue(join_source_path(directory, file), member_size, member_mtime_ns, detected)
+            else:
+                self._enqueue(path, size, mtime_ns, detected)
+
+    def _enqueue(self, image_path, size, mtime_ns, detected):
+        """Queues an image unless it is done, failed unchanged, or already queued."""
+        directory, file = split_source_path(image_path)
+        relative_path = os.path.normpath(join_source_path(os.path.relpath(directory, self.image_root), file))
+        with self.lock:
+            queued = self.queued.get(relative_path)
+            if queued is not None:
+                if (queued[0], queued[1]) != (size, mtime_ns):  # Rewritten while being OCR'd: go again afterwards
+                    self.changed_while_queued[relative_path] = (image_path, size, mtime_ns, detected)
+                return
+            if self.failed.get(relative_path) == (size, mtime_ns):
+                return
+        if self.manifest.lookup(image_path) == (size, mtime_ns):
+            return
+        with self.lock:
+            self.queued[relative_path] = (size, mtime_ns, detected)
+        self.ready.put((relative_path, size, mtime_ns))
+
+    # --- Status ---
+
+    def _status_loop(self):
+        while not self.closed.wait(STATUS_INTERVAL):
+            self.manifest.flush()  # Completions of a quiet spell would otherwise wait for the next one
+            self.write_status("stopping" if self.stopping.is_set() else "watching")
+
+    def write_status(self, state):
+        now = time.time()
+        with self.lock:
+            oldest = min((detected for _, _, detected in self.queued.values()), default=None)
+            lags = sorted(self.lags)
+            status = {
+                "state": state,
+                "backend": self.backend,
+                "watched_directories": len(self.inotify.directories) if self.inotify is not None else None,
+                "debouncing": len(self.candidates),
+                "queue_depth": len(self.queued),
+                "waiting_for_dispatch": self.ready.qsize(),
+                "oldest_queued_seconds": now - oldest if oldest is not None else 0.0,
+                "lag_seconds": {
+                    "last": self.lags[-1] if self.lags else None,
+                    "p50": lags[len(lags) // 2] if lags else None,
+                    "max": lags[-1] if lags else None,
+                },
+                "processed": self.processed,
+                "errors": self.errors,
+                "failed_unchanged": len(self.failed),
+                "last_event_seconds_ago": now - self.last_event if self.last_event is not None else None,
+                "uptime_seconds": now - self.started if self.started is not None else 0.0,
+                "updated": get_beijing_time(),
+            }
+        try:
+            ocr.save_json_atomic(self.status_path, status)
+        except OSError as e:
+            colored_output(f"[{get_beijing_time()}] Error writing {self.status_path}: {e}", "red", self.log_file_path)
+
+def run_watch(image_root, output_root, log_dir, num_processes=None, debounce=DEBOUNCE_SECONDS, poll_interval=POLL_INTERVAL, use_inotify=True,
+              max_tasks_per_worker=None):
+    """Runs highocr3_f2.main() over a WatchWorkSource until SIGTERM or SIGINT; the pool and models stay loaded throughout.
+
+    Workers are not recycled unless ``max_tasks_per_worker`` is given (each recycle reloads the model).
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    log_file_path = os.path.join(log_dir, "ocr_log.txt")
+    source = WatchWorkSource(image_root, log_dir, os.path.join(log_dir, "ocr_watch_status.json"), debounce, poll_interval,
+                             use_inotify, log_file_path=log_file_path)
+
+    def stop(signum, frame):
+        colored_output(f"[{get_beijing_time()}] Signal {signum}: finishing the images already dispatched, then exiting.", "yellow", log_file_path)
+        source.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # No retry pass (it would only run at exit): a failed image waits until it changes or the next start
+    overrides = {"work_source": source, "retry_failed": False, "max_tasks_per_worker": max_tasks_per_worker,
+                 "worker_options": {"ignore_sigint": True}}
+    if num_processes:
+        overrides["num_processes"] = num_processes
+    try:
+        return ocr.main(image_root, output_root, log_dir, overrides)
+    finally:
+        source.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs highocr3_f2.py as a daemon that OCRs images as they arrive under the image root.")
+    parser.add_argument("--image-root", required=True)
+    parser.add_argument("--output-root", required=True)
+    parser.add_argument("--log-dir", required=True)
+    parser.add_argument("--processes", type=int, help="Worker processes (default: highocr3_f2 setting)")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE_SECONDS, help="Seconds a file must stay unchanged before it is OCR'd")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="Rescan interval without inotify")
+    parser.add_argument("--poll", action="store_true", help="Rescan periodically instead of using inotify (e.g. network filesystems)")
+    parser.add_argument("--max-tasks-per-worker", type=int, help="Recycle workers after this many tasks to cap memory growth (default: never)")
+    args = parser.parse_args()
+    run_watch(args.image_root, args.output_root, args.log_dir, args.processes, args.debounce, args.poll_interval, not args.poll, args.max_tasks_per_worker)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import fitz
-import json
 import os
 import re
 import time
@@ -10,10 +9,11 @@ import sys
 import concurrent.futures
 from datetime import datetime, timedelta
 from colorama import Fore, Style, init
-from natsort import natsorted, ns
 import logging
 import itertools
 import gc
+from ocr_result_store import COMPLETION_MARKER, RUN_MARKER, ShardResultIndex, load_result, read_marker, sort_pages
+from ocr_sources import SOURCE_SEPARATOR, find_container, is_virtual, join_source_path, list_container, read_source
 
 # Initialize colorama
 init(autoreset=True)
@@ -28,6 +28,8 @@ SAVE_ENHANCED_IMAGES = False
 ENHANCE_IMAGES = False
 ENHANCED_IMAGE_SUFFIX = "_enhanced"
 CHUNK_SIZE = 50  # Process images in chunks of this size.  Adjust as needed.
+FOLLOW_POLL_INTERVAL = 10  # Seconds between looks for new completion markers with --follow
+FOLLOW_MAX_ATTEMPTS = 3  # Builds of one directory that may fail (per marker) before --follow gives up on it
 # --- End Configuration Variables ---
 
 # --- Logging Setup ---
@@ -85,7 +87,7 @@ def print_with_time(message, color=Fore.WHITE, log_level=logging.INFO, logger=No
 def enhance_image(image_path, output_dir=None):
     """Enhances a single image, returning path or bytes, and closing the image."""
     try:
-        with Image.open(image_path) as img:  # Use context manager
+        with Image.open(io.BytesIO(read_source(image_path)) if is_virtual(image_path) else image_path) as img:  # Use context manager
             img = img.convert('L')
             img_np = np.array(img)
 
@@ -113,8 +115,62 @@ def enhance_image(image_path, output_dir=None):
     # Image is automatically closed here due to the 'with' statement
 
 
-def get_image_and_json_paths(enhanced_paths, enhanced_image_dir, json_dir, image_file):
-    """Helper function to get the correct image and JSON paths."""
+def add_text_page(doc, image_source, polygons, texts, y_offset=Y_OFFSET):
+    """Appends a page showing the image with the OCR text as an invisible layer.
+
+    ``image_source`` is an image path (possibly an archive/PDF member, see
+    ocr_sources.py) or the image bytes.  Shared with the fused OCR-to-PDF
+    mode of highocr3_f2.py, which renders pages in its workers.
+    """
+    if isinstance(image_source, str) and is_virtual(image_source):
+        image_source = read_source(image_source)
+    if isinstance(image_source, str):  # It's a path
+        with Image.open(image_source) as img:
+            img_width, img_height = img.size
+        page = doc.new_page(width=img_width, height=img_height)
+        page.insert_image(page.rect, filename=image_source)
+    else:  # It's image data (bytes)
+        with Image.open(io.BytesIO(image_source)) as img:
+            img_width, img_height = img.size
+        page = doc.new_page(width=img_width, height=img_height)
+        page.insert_image(page.rect, stream=image_source)
+
+    x_scale = 1.0
+    y_scale = 1.0
+
+    for i, polygon in enumerate(polygons):
+        text = texts[i]
+        if not text.strip():
+            continue
+
+        scaled_polygon = [
+            [int(p[0] * x_scale), int(p[1] * y_scale) + y_offset]
+            for p in polygon
+        ]
+        rect = fitz.Rect(scaled_polygon[0][0], scaled_polygon[0][1],
+                            scaled_polygon[2][0], scaled_polygon[2][1])
+
+        fontsize = rect.height * 0.9
+        while True:
+            text_width = fitz.get_text_length(text, fontname="china-s", fontsize=fontsize)
+            if text_width <= rect.width or fontsize <= 1:
+                break
+            fontsize -= 1
+        fontsize = max(1, min(fontsize, 100))
+
+        page.insert_text(rect.top_left, text, fontname="china-s", fontsize=fontsize,
+                            color=(0, 0, 0),
+                            fill=(1, 1, 1),
+                            render_mode=3)
+    return page
+
+
+def get_image_and_json_paths(enhanced_paths, enhanced_image_dir, json_dir, image_file, result_index=None):
+    """Helper function to get the correct image and JSON paths.
+
+    The JSON path may not exist on disk when results were written to
+    directory shards; load_result() resolves it from ``result_index``.
+    """
 
     if enhanced_image_dir:  # Using enhanced images (either saved or in-memory)
         enhanced_image_data = enhanced_paths[image_file]
@@ -132,6 +188,11 @@ def get_image_and_json_paths(enhanced_paths, enhanced_image_dir, json_dir, image
                 if f.startswith(base_image_name) and f.endswith('_result.json'):
                     json_file = f
                     break
+            if json_file is None and result_index is not None:
+                for name in result_index.names():
+                    if name.startswith(base_image_name):
+                        json_file = f"{name}_result.json"
+                        break
             if json_file:
                 json_path = os.path.join(json_dir, json_file)
             else:
@@ -167,16 +228,24 @@ def get_image_and_json_paths(enhanced_paths, enhanced_image_dir, json_dir, image
     return enhanced_image_data, json_path
 
 
+def list_image_files(image_dir):
+    """Image names in a directory, or at the top level of an archive or PDF that was OCR'd without extracting it."""
+    if os.path.isdir(image_dir):
+        return [f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    return [name for name, _, _ in list_container(image_dir, ('.png', '.jpg', '.jpeg')).get("", [])]
+
+
 def process_images_in_directory(image_dir, num_processes=NUM_PROCESSES, save_enhanced=SAVE_ENHANCED_IMAGES, logger=None):
 	"""Enhances images or returns original paths; handles multiprocessing."""
-	image_files = [f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+	image_files = list_image_files(image_dir)
+	source_dir = image_dir if os.path.isdir(image_dir) else image_dir + SOURCE_SEPARATOR
 	if not image_files:
 		print_with_time(f"No images found in {image_dir}", color=Fore.YELLOW, logger=logger, log_level=logging.WARNING)
 		return {}, None
 
 	if not ENHANCE_IMAGES:
 		print_with_time("Skipping image enhancement.  Using original images.", color=Fore.YELLOW, logger=logger)
-		return {image_file: os.path.join(image_dir, image_file) for image_file in image_files}, image_dir
+		return {image_file: join_source_path(source_dir, image_file) for image_file in image_files}, image_dir
 
 	enhanced_image_dir = os.path.join(os.path.dirname(image_dir), os.path.basename(image_dir) + ENHANCED_IMAGE_SUFFIX)
 	if save_enhanced:
@@ -192,7 +261,7 @@ def process_images_in_directory(image_dir, num_processes=NUM_PROCESSES, save_enh
 
 	with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
 		futures = {
-			executor.submit(enhance_image, os.path.join(image_dir, image_file), enhanced_image_dir if save_enhanced else None): image_file
+			executor.submit(enhance_image, join_source_path(source_dir, image_file), enhanced_image_dir if save_enhanced else None): image_file
 			for image_file in image_files
 		}
 
@@ -235,37 +304,41 @@ def process_images_in_directory(image_dir, num_processes=NUM_PROCESSES, save_enh
 	print_with_time(f"\nImage enhancement completed for {image_dir}. Speed: {final_speed:.2f} pages/s", color=Fore.GREEN, logger=logger)
 	return enhanced_paths, enhanced_image_dir
 
+def pdf_file_name(sub_dir_name, save_enhanced=SAVE_ENHANCED_IMAGES):
+    return f"{sub_dir_name}_searchable.pdf" if not save_enhanced else f"{sub_dir_name}_searchable_enhanced.pdf"
+
+def find_image_dir(image_base_dir, sub_dir_name):
+    """The image directory (or archive/PDF OCR'd in place by highocr3_f2.py) behind an OCR results directory, or None."""
+    image_dir = os.path.join(image_base_dir, sub_dir_name)
+    if not os.path.exists(image_dir):
+        image_dir = find_container(image_base_dir, sub_dir_name) or image_dir
+    return image_dir if os.path.exists(image_dir) else None
+
 def process_and_create_pdfs(sub_dir_name, sub_dir_path, image_dir, output_base_dir, y_offset=Y_OFFSET,
-                            save_enhanced=SAVE_ENHANCED_IMAGES, logger=None):
-    """Processes a single subdirectory, creating PDFs in chunks."""
+                            save_enhanced=SAVE_ENHANCED_IMAGES, logger=None, overwrite=False):
+    """Processes a single subdirectory, creating PDFs in chunks.
+
+    An existing PDF is skipped unless ``overwrite`` is set (follow mode
+    rebuilding a directory that was OCR'd again).
+    """
     start_time = time.time()
     json_dir = sub_dir_path
-    output_pdf_name = f"{sub_dir_name}_searchable.pdf" if not save_enhanced else f"{sub_dir_name}_searchable_enhanced.pdf"
-    output_pdf_path = os.path.join(output_base_dir, output_pdf_name)
+    output_pdf_path = os.path.join(output_base_dir, pdf_file_name(sub_dir_name, save_enhanced))
 
-    if os.path.exists(output_pdf_path):
+    if os.path.exists(output_pdf_path) and not overwrite:
         print_with_time(f"Skipping {sub_dir_name} (PDF already exists).", color=Fore.YELLOW, logger=logger)
         return 0, 0, 0, f"Skipped (PDF exists): {output_pdf_path}"
 
     enhanced_paths, enhanced_image_dir = process_images_in_directory(image_dir, save_enhanced=save_enhanced, logger=logger)
+    result_index = ShardResultIndex(json_dir)  # Empty unless highocr wrote result shards
 
     if enhanced_image_dir is None:
-        image_files = sorted([f for f in os.listdir(json_dir) if f.lower().endswith(('_result.json'))],
+        result_files = {f for f in os.listdir(json_dir) if f.lower().endswith(('_result.json'))}
+        result_files.update(f"{name}_result.json" for name in result_index.names())
+        image_files = sorted(result_files,
                             key=lambda x: int(re.search(r"page_(\d+)", x, re.IGNORECASE).group(1)))
     else:
-        def sort_key(filename):
-            filename_lower = filename.lower()
-            if filename_lower.startswith("bok"):		return (0, filename_lower)
-            elif filename_lower.startswith("leg"):	return (1, filename_lower)
-            elif filename_lower.startswith("fow"):	return (2, filename_lower)
-            elif filename_lower.startswith("!"):	return (3, filename_lower)
-            elif filename_lower[0].isdigit():
-                match = re.match(r"^\d+", filename_lower)
-                if match:	return (4, int(match.group(0)), filename_lower)
-                else:		return (4, 0, filename_lower)
-            elif filename_lower.startswith("cov"):	return (5, filename_lower)
-            else:			return (6, filename_lower)
-        image_files = natsorted(enhanced_paths.keys(),key=sort_key,alg=ns.IGNORECASE)
+        image_files = sort_pages(enhanced_paths.keys())
     if not image_files:
         error_message = f"No image files found in {'enhanced image dir' if enhanced_image_dir else 'json dir'}"
         print_with_time(error_message, color=Fore.YELLOW, logger=logger, log_level=logging.WARNING)
@@ -286,7 +359,7 @@ def process_and_create_pdfs(sub_dir_name, sub_dir_path, image_dir, output_base_d
 
             for image_file in chunk_files:
                 try:  # Inner try block
-                    enhanced_image_data, json_path = get_image_and_json_paths(enhanced_paths, enhanced_image_dir, json_dir, image_file)
+                    enhanced_image_data, json_path = get_image_and_json_paths(enhanced_paths, enhanced_image_dir, json_dir, image_file, result_index)
 
                     if not json_path or not enhanced_image_data:
                         errors += 1
@@ -295,16 +368,15 @@ def process_and_create_pdfs(sub_dir_name, sub_dir_path, image_dir, output_base_d
                         print_with_time(msg, color=Fore.RED, logger=logger, log_level=logging.ERROR)
                         continue
 
-                    if not os.path.exists(json_path):
+                    result_name = os.path.basename(json_path)[:-len("_result.json")]
+                    data = load_result(os.path.dirname(json_path), result_name, result_index)
+                    if data is None:
                         errors += 1
                         msg = f"Skipping (JSON file not found): {json_path}"
                         error_messages.append(msg)
                         print_with_time(msg, color=Fore.RED, logger=logger, log_level=logging.ERROR)
                         continue
 
-                    with open(json_path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-
                     if 'dt_polys' not in data or 'rec_text' not in data:
                         errors+=1
                         msg = f"Skipping (JSON missing data): {image_file}"
@@ -321,48 +393,11 @@ def process_and_create_pdfs(sub_dir_name, sub_dir_path, image_dir, output_base_d
                         print_with_time(msg, color=Fore.RED, logger=logger, log_level=logging.ERROR)
                         continue
 
-                    # Load the image (either from path or bytes)
-                    if isinstance(enhanced_image_data, str):  # It's a path
-                        with Image.open(enhanced_image_data) as img:
-                            img_width, img_height = img.size
-                            page = doc.new_page(width=img_width, height=img_height)
-                            page.insert_image(page.rect, filename=enhanced_image_data)
-                    else:  # It's image data (bytes)
-                        with Image.open(io.BytesIO(enhanced_image_data)) as img:
-                            img_width, img_height = img.size
-                            page = doc.new_page(width=img_width, height=img_height)
-                            page.insert_image(page.rect, stream=enhanced_image_data)
+                    add_text_page(doc, enhanced_image_data, polygons, texts, y_offset)
+                    if not isinstance(enhanced_image_data, str):
                         del enhanced_image_data  # Delete immediately
                         gc.collect()
 
-                    x_scale = 1.0
-                    y_scale = 1.0
-
-                    for i, polygon in enumerate(polygons):
-                        text = texts[i]
-                        if not text.strip():
-                            continue
-
-                        scaled_polygon = [
-                            [int(p[0] * x_scale), int(p[1] * y_scale) + y_offset]
-                            for p in polygon
-                        ]
-                        rect = fitz.Rect(scaled_polygon[0][0], scaled_polygon[0][1],
-                                            scaled_polygon[2][0], scaled_polygon[2][1])
-
-                        fontsize = rect.height * 0.9
-                        while True:
-                            text_width = fitz.get_text_length(text, fontname="china-s", fontsize=fontsize)
-                            if text_width <= rect.width or fontsize <= 1:
-                                break
-                            fontsize -= 1
-                        fontsize = max(1, min(fontsize, 100))
-
-                        page.insert_text(rect.top_left, text, fontname="china-s", fontsize=fontsize,
-                                            color=(0, 0, 0),
-                                            fill=(1, 1, 1),
-                                            render_mode=3)
-
                     processed_pages += 1
                     del polygons
                     del texts
@@ -432,7 +467,9 @@ def process_and_create_pdfs(sub_dir_name, sub_dir_path, image_dir, output_base_d
             if not os.listdir(intermediate_dir):
                 os.rmdir(intermediate_dir)
 
-        final_doc.save(output_pdf_path, garbage=4, deflate=True)
+        # Saved under a temporary name so a follower never sees a half-written PDF
+        final_doc.save(output_pdf_path + ".tmp", garbage=4, deflate=True)
+        os.replace(output_pdf_path + ".tmp", output_pdf_path)
         end_time = time.time()
         duration = end_time-start_time
         print_with_time(f"Final PDF created: {output_pdf_path} in {duration:.2f} seconds", color=Fore.GREEN, logger=logger)
@@ -510,8 +547,8 @@ def main(ocr_results_dir=OCR_RESULTS_DIR, image_base_dir=IMAGE_BASE_DIR, output_
     for sub_dir_name in os.listdir(ocr_results_dir):
         sub_dir_path = os.path.join(ocr_results_dir, sub_dir_name)
         if os.path.isdir(sub_dir_path):
-            image_dir = os.path.join(image_base_dir, sub_dir_name)
-            if os.path.exists(image_dir):
+            image_dir = find_image_dir(image_base_dir, sub_dir_name)
+            if image_dir is not None:
                 sub_dirs_to_process.append((sub_dir_name, sub_dir_path, image_dir))
 
     print_with_time(f"Subdirectories to process: {len(sub_dirs_to_process)}", color=Fore.CYAN, logger=main_logger)
@@ -528,7 +565,7 @@ def main(ocr_results_dir=OCR_RESULTS_DIR, image_base_dir=IMAGE_BASE_DIR, output_
                 total_image_count += 0
         else:
             # Count images directly in the image directory if not enhancing.
-            total_image_count += len([f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))])
+            total_image_count += len(list_image_files(image_dir))
 
     print_with_time(f"Total images to process: {total_image_count}", color=Fore.CYAN, logger=main_logger)
 
@@ -592,8 +629,104 @@ def main(ocr_results_dir=OCR_RESULTS_DIR, image_base_dir=IMAGE_BASE_DIR, output_
     print_with_time(f"Total processed pages: {total_processed_pages}", color=Fore.CYAN, logger=main_logger)
     print_with_time(f"Average speed: {average_speed:.2f} pages/s", color=Fore.CYAN, logger=main_logger)
 
+def follow(ocr_results_dir=OCR_RESULTS_DIR, image_base_dir=IMAGE_BASE_DIR, output_base_dir=OUTPUT_BASE_DIRECTORY,
+           y_offset=Y_OFFSET, num_processes=NUM_PROCESSES, save_enhanced_images=SAVE_ENHANCED_IMAGES,
+           poll_interval=FOLLOW_POLL_INTERVAL):
+    """Builds each directory's PDF as soon as highocr3_f2.py has written its completion marker.
+
+    Runs alongside the OCR instead of after it.  A PDF older than its
+    directory's marker is rebuilt, so a directory OCR'd again gets a fresh
+    PDF.  Stops once highocr3_f2.py has written its run marker and every
+    marked directory is built.
+    """
+    os.makedirs(output_base_dir, exist_ok=True)
+    log_dir = os.path.join(output_base_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    main_logger = setup_logger(log_dir, "main")
+    overall_start_time = time.time()
+    print_with_time(f"Following completion markers in {ocr_results_dir}.", color=Fore.CYAN, logger=main_logger)
+
+    built = {}  # sub_dir_name -> mtime_ns of the marker its PDF was built (or skipped) for
+    attempts = {}  # (sub_dir_name, marker mtime_ns) -> failed builds so far
+    running = {}  # future -> (sub_dir_name, marker mtime_ns, output PDF path)
+    total_processed_pages = 0
+    processed_pdfs = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        while True:
+            # Checked before the listing: every directory marker is written before the run marker
+            run_finished = os.path.exists(os.path.join(ocr_results_dir, RUN_MARKER))
+            busy = {sub_dir_name for sub_dir_name, _, _ in running.values()}
+            submitted = 0
+            for entry in os.scandir(ocr_results_dir) if os.path.isdir(ocr_results_dir) else []:
+                if not entry.is_dir() or entry.name in busy:
+                    continue
+                marker_path = os.path.join(entry.path, COMPLETION_MARKER)
+                try:
+                    marker_mtime = os.stat(marker_path).st_mtime_ns
+                except FileNotFoundError:
+                    continue  # Still being OCR'd
+                if built.get(entry.name) == marker_mtime:
+                    continue
+                output_pdf_path = os.path.join(output_base_dir, pdf_file_name(entry.name, save_enhanced_images))
+                if os.path.exists(output_pdf_path) and os.stat(output_pdf_path).st_mtime_ns >= marker_mtime:
+                    built[entry.name] = marker_mtime
+                    continue  # Built from these results already
+                image_dir = find_image_dir(image_base_dir, entry.name)
+                if image_dir is None:
+                    print_with_time(f"No images for {entry.name} in {image_base_dir}, skipped.", color=Fore.YELLOW, logger=main_logger,
+                                    log_level=logging.WARNING)
+                    built[entry.name] = marker_mtime
+                    continue
+                marker = read_marker(marker_path) or {}
+                if marker.get("failed"):
+                    print_with_time(f"{entry.name}: {len(marker['failed'])} of {marker['images']} pages failed OCR and will be missing.",
+                                    color=Fore.YELLOW, logger=main_logger, log_level=logging.WARNING)
+                future = executor.submit(process_and_create_pdfs, entry.name, entry.path, image_dir, output_base_dir, y_offset,
+                                         save_enhanced_images, setup_logger(log_dir, f"process_{entry.name}"), True)
+                running[future] = (entry.name, marker_mtime, output_pdf_path)
+                submitted += 1
+
+            if run_finished and not running and not submitted:
+                break
+            if not running:
+                time.sleep(poll_interval)
+                continue
+            done, _ = concurrent.futures.wait(running, timeout=poll_interval, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                sub_dir_name, marker_mtime, output_pdf_path = running.pop(future)
+                try:
+                    pages_in_pdf, _, _, _ = future.result()
+                    if not os.path.exists(output_pdf_path) or os.stat(output_pdf_path).st_mtime_ns < marker_mtime:
+                        raise RuntimeError(f"{output_pdf_path} was not written")
+                    total_processed_pages += pages_in_pdf
+                    processed_pdfs += 1
+                    built[sub_dir_name] = marker_mtime
+                except Exception as e:
+                    # Not recorded as built: the next poll tries again, up to FOLLOW_MAX_ATTEMPTS times for this marker
+                    failures = attempts[(sub_dir_name, marker_mtime)] = attempts.get((sub_dir_name, marker_mtime), 0) + 1
+                    if failures >= FOLLOW_MAX_ATTEMPTS:
+                        built[sub_dir_name] = marker_mtime
+                    outcome = "giving up until its next completion marker" if failures >= FOLLOW_MAX_ATTEMPTS else "will retry"
+                    print_with_time(f"Error in processing {sub_dir_name}: {e} ({outcome})", color=Fore.RED, logger=main_logger,
+                                    log_level=logging.ERROR)
+            elapsed_time = time.time() - overall_start_time
+            sys.stdout.write(
+                f"\r{get_timestamp()} - Following: {processed_pdfs} PDFs, {total_processed_pages} pages, {len(running)} building "
+                f"| Elapsed: {Fore.BLUE}{timedelta(seconds=int(elapsed_time))}{Style.RESET_ALL} "
+            )
+            sys.stdout.flush()
+
+    overall_duration = time.time() - overall_start_time
+    print_with_time(f"\nOCR run finished; followed it for {overall_duration:.2f} seconds", color=Fore.CYAN, logger=main_logger)
+    print_with_time(f"PDFs built: {processed_pdfs}, pages: {total_processed_pages}", color=Fore.CYAN, logger=main_logger)
+
 if __name__ == "__main__":
     try:
-        main()
+        if "--follow" in sys.argv:
+            follow()
+        else:
+            main()
     except KeyboardInterrupt:
         print_with_time("Interrupted by user. Exiting.", color=Fore.RED)
\ No newline at end of file
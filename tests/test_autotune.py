@@ -0,0 +1,33 @@
+import threading
+
+from highocr3_f2 import InflightGate, ThroughputMonitor
+
+
+def running_tasks(gate, workers):
+    """Tasks a pool of ``workers`` would run at once behind the gate (none of them finishing)."""
+    admitted = []
+    tasks = gate.wrap(iter(range(100)))
+    thread = threading.Thread(target=lambda: admitted.extend(tasks), daemon=True)
+    thread.start()
+    thread.join(0.2)
+    return min(len(admitted), workers)
+
+
+def test_one_backoff_step_removes_a_running_task():
+    gate = InflightGate(8, workers=4)
+    assert running_tasks(gate, 4) == 4
+    gate = InflightGate(8, workers=4)
+    monitor = ThroughputMonitor(gate, expected_rate=1e9, min_free_mb=0, log_file_path=None, interval=0.0)
+    monitor.update(0, True)
+    monitor.update(0, True)  # Second bad window: one step back
+    assert gate.limit == 3
+    assert running_tasks(gate, 4) == 3
+
+
+def test_recover_restores_the_queue():
+    gate = InflightGate(8, workers=4)
+    gate.back_off()
+    gate.back_off()
+    assert gate.limit == 2
+    assert gate.recover() == 3
+    assert gate.recover() == 8
@@ -0,0 +1,24 @@
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from highocr3_f2 import decode_image
+
+
+def exif_rotated_jpeg():
+    """A 400x200 landscape JPEG tagged "rotate 90 CW" (orientation 6): upright it is 200 wide, 400 tall."""
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new("RGB", (400, 200), "white").save(buffer, "JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_full_validation_applies_exif_orientation():
+    data = exif_rotated_jpeg()
+    upright = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert upright.shape == (400, 200, 3)
+    assert decode_image(data, "full").shape == upright.shape
+    assert decode_image(data, "header").shape == upright.shape
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+from PIL import Image
+
+import highocr3_f2
+from highocr3_f2 import TEMP_ENV_VARS, THREAD_ENV_VARS
+
+WATCHED = TEMP_ENV_VARS + THREAD_ENV_VARS
+
+
+@pytest.fixture
+def caller_env(monkeypatch):
+    for name in WATCHED:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("TMPDIR", "/tmp")
+    return {name: os.environ.get(name) for name in WATCHED}
+
+
+@pytest.fixture
+def mock_pipeline(tmp_path, monkeypatch):
+    config = tmp_path / "mock_config.yaml"  # Device slots write a pinned copy of the config
+    config.write_text("Global:\n  device: cpu\n")
+    monkeypatch.setenv(highocr3_f2.PIPELINE_FACTORY_ENV, "benchmark_highocr:create_mock_pipeline")
+    monkeypatch.setattr(highocr3_f2, "config_path", str(config))
+
+
+def test_run_restores_temp_and_thread_variables(tmp_path, caller_env, mock_pipeline):
+    os.makedirs(tmp_path / "images" / "a")
+    for number in range(2):
+        Image.new("RGB", (64, 48), "white").save(tmp_path / "images" / "a" / f"{number:03d}.png")
+
+    result = highocr3_f2.main(str(tmp_path / "images"), str(tmp_path / "output"), str(tmp_path / "logs"),
+                              {"num_processes": 1, "device_map": "cpu=1x1", "retry_failed": False})
+
+    assert result["processed"] == 2
+    assert {name: os.environ.get(name) for name in WATCHED} == caller_env
+
+
+def test_failed_run_restores_the_environment(tmp_path, monkeypatch, caller_env, mock_pipeline):
+    def broken_manifest(path):
+        raise RuntimeError("manifest unavailable")
+
+    monkeypatch.setattr(highocr3_f2, "CompletionManifest", broken_manifest)
+    with pytest.raises(RuntimeError, match="manifest unavailable"):
+        highocr3_f2.main(str(tmp_path / "images"), str(tmp_path / "output"), str(tmp_path / "logs"),
+                         {"num_processes": 1, "device_map": "cpu=1x1"})
+    assert {name: os.environ.get(name) for name in WATCHED} == caller_env
@@ -0,0 +1,44 @@
+import io
+import tarfile
+import zipfile
+
+from ocr_sources import close_containers, list_container, member_name, output_relative_path, read_source
+
+
+def test_member_name_normalises_and_refuses_escapes():
+    assert member_name("./scans/p1.png") == "scans/p1.png"
+    assert member_name("scans/../p1.png") == "p1.png"
+    assert member_name("/abs/evil.png") is None
+    assert member_name("../../escape.png") is None
+    assert member_name("scans/../../escape.png") is None
+
+
+def test_crafted_zip_stays_inside_the_container(tmp_path):
+    path = tmp_path / "vol1.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("./scans/p1.png", b"one")
+        archive.writestr("/abs/evil.png", b"evil")
+        archive.writestr("../../escape.png", b"escape")
+    skipped = []
+    groups = list_container(str(path), (".png",), skipped)
+    assert sorted(skipped) == ["../../escape.png", "/abs/evil.png"]
+    assert list(groups) == ["scans"]
+    assert [name for name, _, _ in groups["scans"]] == ["p1.png"]
+    assert output_relative_path("books/vol1.zip::scans/p1.png") == "books/vol1/scans/p1.png"
+    try:
+        assert read_source(f"{path}::scans/p1.png") == b"one"
+    finally:
+        close_containers()
+
+
+def test_tar_members_are_refused_like_zip_members(tmp_path):
+    path = tmp_path / "vol1.tar"
+    with tarfile.open(path, "w") as archive:
+        for name in ("./a/p1.png", "/abs/evil.png", "../escape.png"):
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            archive.addfile(info, io.BytesIO(b"abc"))
+    skipped = []
+    groups = list_container(str(path), (".png",), skipped)
+    assert sorted(skipped) == ["../escape.png", "/abs/evil.png"]
+    assert list(groups) == ["a"]
@@ -0,0 +1,15 @@
+import highocr3_f2
+import pdf_creator_with_text_layer6
+from ocr_result_store import sort_pages
+
+FILES = ["dup.png", "003.png", "cov001.png", "001.png", "bok001.png", "002.png"]
+
+
+def test_book_order():
+    assert sort_pages(FILES) == ["bok001.png", "001.png", "002.png", "003.png", "cov001.png", "dup.png"]
+    assert sort_pages(["10.png", "9.png", "Leg2.png", "leg10.png", "!note.png", "fow1.png"]) == [
+        "Leg2.png", "leg10.png", "fow1.png", "!note.png", "9.png", "10.png"]
+
+
+def test_fused_mode_and_creator_share_the_page_order():
+    assert highocr3_f2.sort_pages is pdf_creator_with_text_layer6.sort_pages is sort_pages
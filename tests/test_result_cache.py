@@ -0,0 +1,24 @@
+import sqlite3
+
+from highocr3_f2 import ResultCache
+
+KEY = "p" + "0123456789abcdef" * 4
+
+
+def test_reputting_a_hash_keeps_one_band_row_per_band(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    for _ in range(3):  # Three runs meeting the same page
+        cache = ResultCache(path, 1 << 20)
+        cache.put(KEY, 100, 200, {"rec_text": ["a"]})
+        cache.close()
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT band, value, key, COUNT(*) FROM bands GROUP BY band, value, key").fetchall()
+    conn.close()
+    assert rows and all(count == 1 for *_, count in rows)
+
+
+def test_pending_entries_are_found_before_they_are_committed(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), 1 << 20, commit_interval=3600)
+    cache.put(KEY, 100, 200, {"rec_text": ["a"]})
+    assert cache.get(KEY, 100, 200) == (100, 200, {"rec_text": ["a"]})
+    cache.close()
@@ -0,0 +1,45 @@
+import numpy as np
+
+import highocr3_f2
+from highocr3_f2 import DEFAULT_WORKER_OPTIONS, join_seam_text, predict_tiled
+
+CHUNK = 20  # Pixels per character of the synthetic line
+
+
+class LinePipeline:
+    """Stand-in pipeline: reads the one dark line of a crop, one character per CHUNK columns.
+
+    Channel 1 of the line's pixels holds the character of its column, so a
+    piece of the line reads the same characters wherever it is cropped.
+    """
+    def predict(self, crops):
+        for crop in crops:
+            ys, xs = np.nonzero(crop[:, :, 0] == 0)
+            if not xs.size:
+                yield {"dt_polys": [], "rec_text": [], "rec_score": []}
+                continue
+            x0, x1, y0, y1 = xs.min(), xs.max(), ys.min(), ys.max()
+            row = crop[y0, x0:x1 + 1, 1]
+            text = "".join(dict.fromkeys(chr(value) for value in row))
+            yield {"dt_polys": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1]]], "rec_text": [text], "rec_score": [0.9]}
+
+
+def test_line_longer_than_the_overlap_is_joined(monkeypatch):
+    image = np.full((600, 1400, 3), 255, dtype=np.uint8)
+    x_start, x_end = 10, 1310
+    image[100:131, x_start:x_end + 1, 0] = 0
+    image[100:131, x_start:x_end + 1, 1] = [48 + x // CHUNK for x in range(x_start, x_end + 1)]
+    expected = "".join(dict.fromkeys(chr(48 + x // CHUNK) for x in range(x_start, x_end + 1)))
+    monkeypatch.setattr(highocr3_f2, "global_pipeline", LinePipeline(), raising=False)
+    monkeypatch.setattr(highocr3_f2, "worker_options", {**DEFAULT_WORKER_OPTIONS, "tile_size": 512, "tile_overlap": 64, "tile_batch": 4}, raising=False)
+
+    record = predict_tiled(image)
+
+    assert record["tiles"]["count"] == 6
+    assert record["rec_text"] == [expected]
+    assert record["dt_polys"] == [[[x_start, 100], [x_end, 100], [x_end, 130], [x_start, 130]]]
+
+
+def test_join_seam_text_keeps_the_overlap_once():
+    assert join_seam_text("tile one rea", "reads on") == "tile one reads on"
+    assert join_seam_text("abc", "def") == "abcdef"